@@ -0,0 +1,437 @@
+"""
+End-to-end checkout flows for the checkout_benchmark command. Each flow
+drives the real views with a simulated shopper against whatever database is
+configured, using the fake processor instead of the payment gateway.
+"""
+import gc
+import json
+import math
+import os
+import sys
+import time
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.messages.storage import default_storage
+from django.db import connection
+from django.template.base import TemplateDoesNotExist
+from django.template.loader import BaseLoader
+from django.test.client import RequestFactory
+from django.utils.importlib import import_module
+
+from checkout import models, views
+from checkout.processors import fake_processor
+from checkout.settings import CHECKOUT
+
+
+class QueryCounter(object):
+    """
+    Counts the queries run inside a ``with`` block
+    """
+
+    def __enter__(self):
+        self.debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        return self
+
+    def __exit__(self, *args):
+        self.count = len(connection.queries) - self.start
+        connection.use_debug_cursor = self.debug_cursor
+
+
+def make_request(path="/"):
+    request = RequestFactory().get(path)
+    engine = import_module(settings.SESSION_ENGINE)
+    request.session = engine.SessionStore()
+    request.user = AnonymousUser()
+    return request
+
+
+def allocations():
+    """
+    Live allocations: memory blocks where Python counts them, otherwise
+    objects tracked by the garbage collector. With the collector off,
+    garbage in reference cycles (most of what a request leaves behind)
+    stays counted until the next collection.
+    """
+    if hasattr(sys, "getallocatedblocks"):
+        return sys.getallocatedblocks()
+    return len(gc.get_objects())
+
+
+# just enough template to make the views' lazy querysets run
+TEMPLATES = {
+    "checkout/form.html":
+        "{{ form.as_p }}{{ order.total }}"
+        "{% for item in order.items.all %}{{ item.description }}{% endfor %}",
+    "checkout/confirm.html":
+        "{{ order.total }}{{ transaction.last_four }}"
+        "{% for item in order.items.all %}{{ item.description }}{% endfor %}",
+    "checkout/order_list.html":
+        "{% for o in orders %}{{ o.key }}{{ o.total }}"
+        "{% if not summary %}{% for i in o.items.all %}{{ i.description }}{% endfor %}"
+        "{{ o.latest_transaction.last_four }}{% endif %}{% endfor %}{{ next_cursor }}",
+    "checkout/order_detail.html":
+        "{{ order.key }}{{ transaction.last_four }}"
+        "{% for item in items %}{{ item.description }}{{ item.total }}{% endfor %}",
+    "404.html": "Not found",
+    "500.html": "Server error",
+}
+
+
+class TemplateLoader(BaseLoader):
+    is_usable = True
+
+    def load_template_source(self, template_name, template_dirs=None):
+        if template_name in TEMPLATES:
+            return TEMPLATES[template_name], "benchmark:" + template_name
+        raise TemplateDoesNotExist(template_name)
+
+
+class Shopper(object):
+    """
+    A visitor with a session that persists across requests
+    """
+
+    def __init__(self, user=None):
+        engine = import_module(settings.SESSION_ENGINE)
+        self.session = engine.SessionStore()
+        self.user = user or AnonymousUser()
+        self.factory = RequestFactory()
+
+    def request(self, view, method="get", path="/", data=None, **kwargs):
+        request = getattr(self.factory, method)(path, data or {})
+        request.session = self.session
+        request.user = self.user
+        request._messages = default_storage(request)
+        response = view(request, **kwargs)
+        if hasattr(response, "render") and not response.is_rendered:
+            response.render()
+        return response
+
+    def add_item(self, amount="25.00"):
+        return self.request(views.CheckoutView.as_view(), "post", data={
+            "item_description": "Benchmark item",
+            "item_amount": amount,
+        })
+
+    def subscribe(self):
+        return self.request(views.SubscribeView.as_view(), "post", data={
+            "subscription": "benchmark",
+            "custom_amount": "29",
+        })
+
+    def submit_payment(self, view=None):
+        return self.request(view or views.CheckoutView.as_view(), "post", data={
+            "amount": "25.00",
+            "token": "tok_benchmark",
+            "email": "shopper@example.com",
+            "billing_first_name": "Bench",
+            "billing_last_name": "Mark",
+            "billing_address1": "1 Main St",
+            "billing_city": "Springfield",
+            "billing_region": "IL",
+            "billing_postal_code": "62701",
+            "billing_country": "US",
+            "expiration_date_0": "12",
+            "expiration_date_1": str(date.today().year + 1),
+        })
+
+    def fill_cart(self, items=3):
+        from cart.cart import Cart
+
+        cart = Cart(self.request_for_cart())
+        for i in range(items):
+            cart.add(customer(), Decimal("10.00"), 1)
+
+    def request_for_cart(self):
+        request = self.factory.get("/")
+        request.session = self.session
+        return request
+
+    def confirm(self, view=None):
+        return self.request(view or views.ConfirmView.as_view(), "post")
+
+
+def customer():
+    user = User(username="bench{0}".format(time.time()).replace(".", ""))
+    user.save()
+    return user
+
+
+def completed_orders(user, count=25, items=3):
+    for i in range(count):
+        total = Decimal("10.00") * items
+        order = models.Order(user=user, status=models.Order.COMPLETE,
+            subtotal=total, total=total)
+        order.save()
+        for j in range(items):
+            models.LineItem(
+                order=order,
+                description="Item {0}".format(j),
+                item_price=Decimal("10.00"),
+                total=Decimal("10.00")
+            ).save()
+        models.OrderTransaction(
+            order=order,
+            status=models.OrderTransaction.COMPLETE,
+            amount=total,
+            last_four="4242"
+        ).save()
+
+
+def flows():
+    """
+    ``(name, setup, run)`` for each flow. ``setup`` returns the state
+    ``run`` needs, and only ``run`` is measured. Flows for apps that
+    aren't installed have no ``setup`` or ``run``.
+    """
+
+    def shopper_with_item():
+        shopper = Shopper()
+        shopper.add_item()
+        return shopper
+
+    def shopper_ready_to_confirm():
+        shopper = shopper_with_item()
+        shopper.submit_payment()
+        return shopper
+
+    def subscriber_ready_to_confirm():
+        shopper = Shopper()
+        shopper.subscribe()
+        shopper.submit_payment(views.SubscribeView.as_view())
+        return shopper
+
+    def shopper_with_orders():
+        user = customer()
+        completed_orders(user)
+        return Shopper(user)
+
+    def discount_shopper():
+        code = "BENCH{0}".format(models.Discount.objects.count())
+        models.Discount(code=code, amount=Decimal("5.00")).save()
+        shopper = shopper_with_item()
+        shopper.discount_code = code
+        return shopper
+
+    def order_key():
+        shopper = shopper_ready_to_confirm()
+        key = models.OrderTransaction.objects.latest().order.key
+        shopper.confirm()
+        return Shopper(), key
+
+    def shopper_with_cart():
+        shopper = Shopper()
+        shopper.fill_cart()
+        return shopper
+
+    def cart_ready_to_confirm():
+        shopper = shopper_with_cart()
+        shopper.request(views.CartCheckoutView.as_view())
+        shopper.submit_payment(views.CartCheckoutView.as_view())
+        return shopper
+
+    cart = [
+        ("cart_checkout_get", shopper_with_cart,
+            lambda shopper: shopper.request(views.CartCheckoutView.as_view())),
+        ("cart_confirm", cart_ready_to_confirm,
+            lambda shopper: shopper.confirm(views.CartConfirmView.as_view())),
+    ]
+    if "cart" not in settings.INSTALLED_APPS:
+        cart = [(name, None, None) for name, setup, run in cart]
+
+    return [
+        ("checkout_add_item", Shopper, lambda shopper: shopper.add_item()),
+        ("checkout_get", shopper_with_item,
+            lambda shopper: shopper.request(views.CheckoutView.as_view())),
+        ("checkout_submit", shopper_with_item,
+            lambda shopper: shopper.submit_payment()),
+        ("subscribe_add_plan", Shopper, lambda shopper: shopper.subscribe()),
+        ("confirm_charge", shopper_ready_to_confirm,
+            lambda shopper: shopper.confirm()),
+        ("confirm_subscription", subscriber_ready_to_confirm,
+            lambda shopper: shopper.confirm()),
+        ("order_list", shopper_with_orders,
+            lambda shopper: shopper.request(views.order_list)),
+        ("order_list_summary", shopper_with_orders,
+            lambda shopper: shopper.request(views.order_list, summary=True)),
+        ("order_details", order_key,
+            lambda state: state[0].request(views.order_details, key=state[1])),
+        ("lookup_discount_code", discount_shopper,
+            lambda shopper: shopper.request(views.lookup_discount_code, "post",
+                data={"discount_code": shopper.discount_code})),
+    ] + cart
+
+
+def measure(setup, run, repeat=10):
+    """
+    Runs the flow once to warm up, then ``repeat`` times. Returns the
+    queries of one run, the median wall time in ms and the allocations
+    made by one run, counted before the garbage collector frees them.
+    """
+    run(setup())
+
+    timings = []
+    queries = None
+    objects = None
+    for i in range(repeat):
+        state = setup()
+        gc.collect()
+        gc.disable()
+        try:
+            before = allocations()
+            with QueryCounter() as counter:
+                start = time.time()
+                run(state)
+                timings.append((time.time() - start) * 1000)
+            if queries is None:
+                queries = counter.count
+                objects = allocations() - before
+        finally:
+            gc.enable()
+    timings.sort()
+    return {
+        "queries": queries,
+        "ms": round(timings[len(timings) // 2], 2),
+        "allocations": objects,
+    }
+
+
+BUDGETS = os.path.join(os.path.dirname(__file__), "benchmark_budgets.json")
+
+# wall time and allocations vary between machines and runs, so their
+# budgets get room to spare; query counts must not grow at all
+TIME_HEADROOM = 3
+ALLOCATION_HEADROOM = 1.5
+
+
+def load_budgets(path=BUDGETS):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_budgets(results, path=BUDGETS):
+    """
+    Replaces the budgets of the flows in ``results``, keeping the others
+    """
+    budgets = load_budgets(path)
+    for name, result in results.items():
+        budgets[name] = {
+            "queries": result["queries"],
+            "ms": round(result["ms"] * TIME_HEADROOM, 1),
+            "allocations": int(math.ceil(
+                max(result["allocations"], 0) * ALLOCATION_HEADROOM
+            )),
+        }
+    with open(path, "w") as f:
+        json.dump(budgets, f, indent=4, sort_keys=True, separators=(",", ": "))
+        f.write("\n")
+
+
+def over_budget(result, budget):
+    """
+    The measurements in ``result`` that exceed ``budget``
+    """
+    return [
+        "{0} {1} > {2}".format(key, result[key], budget[key])
+        for key in ("queries", "ms", "allocations")
+        if key in budget and result[key] > budget[key]
+    ]
+
+
+
+def hot_queries():
+    """
+    The lookups the checkout schema is indexed for, as
+    ``(name, queryset, forbidden plan fragments)``
+    """
+    scan = ("SCAN",)
+    ordered = scan + ("TEMP B-TREE",)
+    return [
+        ("order by key", models.Order.objects.filter(key="x"), scan),
+        ("orders by status", models.Order.objects.incomplete(), scan),
+        ("stale orders (reap_abandoned_orders)",
+            models.Order.objects.stale(models.Order.INCOMPLETE, datetime.now()),
+            ordered),
+        ("order_list",
+            models.Order.objects.filter(user=1).order_by("-creation_date"),
+            ordered),
+        ("line items by product",
+            models.LineItem.objects.filter(
+                order=1, content_type=1, object_id__in=[1, 2]
+            ), scan),
+        ("transactions by payment method",
+            models.OrderTransaction.objects.filter(
+                order=1, payment_method=models.OrderTransaction.DISCOUNT
+            ), ordered),
+        ("transactions by status",
+            models.OrderTransaction.objects.filter(
+                order=1, status=models.OrderTransaction.COMPLETE
+            ), ordered),
+    ]
+
+
+def explain(queryset):
+    """
+    SQLite's query plan for ``queryset``, one step per line
+    """
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    return [row[-1] for row in cursor.fetchall()]
+
+
+def unindexed(plan, forbidden):
+    """
+    The steps of ``plan`` containing one of the ``forbidden`` fragments
+    """
+    return [step for step in plan if any(f in step for f in forbidden)]
+
+class benchmark_environment(object):
+    """
+    Swaps in the benchmark templates, the fake processor and the CHECKOUT
+    options the flows need, for the duration of a ``with`` block
+    """
+    OPTIONS = {
+        "ANONYMOUS_CHECKOUT": True,
+        "ALLOW_PLAN_CREATION": True,
+        "PAYMENT_PROCESSOR": fake_processor.__name__,
+    }
+    # an instant gateway that never fails, so only checkout is measured
+    INSTANT = {
+        "seed": 0,
+        "latency": {},
+        "decline_rate": 0,
+        "timeout_rate": 0,
+        "lost_response_rate": 0,
+    }
+
+    def __init__(self, gateway=INSTANT):
+        """
+        ``gateway`` overrides CHECKOUT["FAKE_PROCESSOR"] for the fake
+        gateway, as keyword arguments to ``fake_processor.configure``
+        """
+        self.gateway_options = gateway
+
+    def __enter__(self):
+        from django.test.utils import override_settings
+        self.settings = override_settings(TEMPLATE_LOADERS=(
+            "checkout.benchmark.TemplateLoader",
+        ))
+        self.settings.enable()
+        self.options = dict((k, CHECKOUT[k]) for k in self.OPTIONS)
+        CHECKOUT.update(self.OPTIONS)
+        self.gateway = fake_processor.gateway
+        fake_processor.configure(**self.gateway_options)
+        return self
+
+    def __exit__(self, *args):
+        fake_processor.gateway = self.gateway
+        CHECKOUT.update(self.options)
+        self.settings.disable()
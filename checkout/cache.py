@@ -0,0 +1,128 @@
+import copy
+import hashlib
+import random
+import threading
+import time
+
+from django.core.cache import cache
+from django.utils.datastructures import SortedDict
+
+
+class LookupCache(object):
+    """
+    Caches ``loader(key)`` in a small in-process LRU in front of Django's
+    cache framework.
+
+    Lookups that find nothing are cached as well (for ``negative_timeout``
+    seconds) so repeated guesses don't reach the database. Entries in the
+    in-process LRU live for at most ``local_timeout`` seconds, which bounds
+    how long another process's ``invalidate`` can go unnoticed.
+
+    Cached values are tagged with a per-key version that ``invalidate``
+    bumps, so a value loaded before a concurrent ``invalidate`` is never
+    served after it.
+    """
+
+    def __init__(self, prefix, loader, size=1000, timeout=300,
+                 negative_timeout=60, local_timeout=5):
+        self.prefix = prefix
+        self.loader = loader
+        self.size = size
+        self.timeout = timeout
+        self.negative_timeout = negative_timeout
+        self.local_timeout = local_timeout
+        self.local = SortedDict()
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def cache_key(self, key):
+        # user input may contain characters memcached won't accept
+        return "checkout:{0}:{1}".format(
+            self.prefix, hashlib.md5(key.encode("utf-8")).hexdigest()
+        )
+
+    def version_key(self, key):
+        return self.cache_key(key) + ":version"
+
+    def current_version(self, key, version):
+        if version is None:
+            # a random start so entries tagged before the version key was
+            # evicted can't match the new one
+            version = random.getrandbits(31)
+            if not cache.add(self.version_key(key), version, self.timeout):
+                version = cache.get(self.version_key(key))
+        return version
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.local.pop(key, None)
+            if entry is not None and entry[0] > now:
+                self.local[key] = entry
+                self.local_hits += 1
+                if entry[1] is None:
+                    self.negative_hits += 1
+                return copy.deepcopy(entry[1])
+
+        cached = cache.get_many([self.cache_key(key), self.version_key(key)])
+        version = cached.get(self.version_key(key))
+        entry = cached.get(self.cache_key(key))
+        if entry is not None and version is not None and entry[1] == version:
+            value = entry[0]
+            with self.lock:
+                self.hits += 1
+                if value is None:
+                    self.negative_hits += 1
+        else:
+            # the version is read before loading: if invalidate() runs in
+            # between, what is stored below is already out of date
+            version = self.current_version(key, version)
+            value = self.loader(key)
+            cache.set(
+                self.cache_key(key),
+                (value, version),
+                self.timeout if value is not None else self.negative_timeout
+            )
+            with self.lock:
+                self.misses += 1
+
+        local_timeout = self.local_timeout
+        if value is None:
+            local_timeout = min(local_timeout, self.negative_timeout)
+        with self.lock:
+            self.local[key] = (now + local_timeout, value)
+            while len(self.local) > self.size:
+                del self.local[next(iter(self.local))]
+        return copy.deepcopy(value)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.local.pop(key, None)
+        try:
+            cache.incr(self.version_key(key))
+        except ValueError:
+            # no version yet, so nothing cached is valid
+            pass
+
+    def clear(self):
+        with self.lock:
+            self.local.clear()
+
+    def reset_stats(self):
+        self.local_hits = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """
+        Counters for this process. ``negative_hits`` is the subset of
+        ``local_hits`` and ``hits`` that found a cached miss.
+        """
+        return {
+            "local_hits": self.local_hits,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "size": len(self.local),
+        }
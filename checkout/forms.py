@@ -6,14 +6,12 @@ from django.utils.translation import ugettext as _
 
 from form_utils.forms import BetterForm
 
+from . import registry
 from .fields import CreditCardField, ExpiryDateField, VerificationValueField
 from .settings import CHECKOUT
 from .utils import import_from_string
 
 
-BaseSignupForm = import_from_string(CHECKOUT["BASE_SIGNUP_FORM"])
-
-
 class CustomItemForm(forms.Form):
 
     item_description = forms.CharField(max_length=250)
@@ -171,8 +169,8 @@ class PaymentForm(BillingInfoPaymentForm):
         if code:
             from checkout.models import Discount
 
-            if Discount.objects.filter(code__iexact=code):
-                discount = Discount.objects.get(code__iexact=code)
+            discount = Discount.objects.lookup(code)
+            if discount:
                 try:
                     valid = discount.is_valid(self.user)
                 except:
@@ -184,5 +182,42 @@ class PaymentForm(BillingInfoPaymentForm):
         return code
 
 
-class PaymentSignupForm(BaseSignupForm, PaymentForm):
-    pass
+def payment_signup_form():
+    """
+    PaymentForm combined with CHECKOUT["BASE_SIGNUP_FORM"], the default
+    SIGNUP_FORM. It is built when first needed (see checkout.registry),
+    so the base form isn't imported with this module.
+    """
+    base = import_from_string(CHECKOUT["BASE_SIGNUP_FORM"])
+    return type("PaymentSignupForm", (base, PaymentForm), {"__module__": __name__})
+
+
+class LazySignupFormType(type):
+    """
+    Makes PaymentSignupForm stand in for the class payment_signup_form()
+    builds, building it on first use
+    """
+
+    def __call__(cls, *args, **kwargs):
+        return signup_form()(*args, **kwargs)
+
+    def __getattr__(cls, name):
+        return getattr(signup_form(), name)
+
+    def __instancecheck__(cls, instance):
+        return isinstance(instance, signup_form())
+
+
+class PaymentSignupForm(object):
+    """
+    The old name for payment_signup_form()'s class. It can be instantiated,
+    have its attributes read and be used with isinstance, but subclasses
+    should be built on payment_signup_form() instead.
+    """
+    __metaclass__ = LazySignupFormType
+
+
+def signup_form():
+    return registry.load(
+        ("form", __name__ + ".payment_signup_form"), payment_signup_form
+    )
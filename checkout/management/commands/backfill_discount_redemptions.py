@@ -0,0 +1,51 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from checkout.models import DiscountRedemption, Order
+
+
+class Command(BaseCommand):
+
+    help = ("Rebuilds the per-user discount redemption counts from orders "
+            "that have been through checkout")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size",
+            dest="batch_size",
+            type="int",
+            default=1000,
+            help="Number of rows per INSERT"
+        ),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        counts = Order.objects.filter(
+            discount__isnull=False,
+            user__isnull=False
+        ).exclude(
+            status__in=(Order.INCOMPLETE, Order.PENDING_PAYMENT)
+        ).order_by().values("discount", "user").annotate(count=Count("id"))
+
+        created = 0
+        with transaction.commit_on_success():
+            DiscountRedemption.objects.all().delete()
+            batch = []
+            for row in counts.iterator():
+                batch.append(DiscountRedemption(
+                    discount_id=row["discount"],
+                    user_id=row["user"],
+                    count=row["count"]
+                ))
+                if len(batch) >= batch_size:
+                    DiscountRedemption.objects.bulk_create(batch)
+                    created += len(batch)
+                    batch = []
+            if batch:
+                DiscountRedemption.objects.bulk_create(batch)
+                created += len(batch)
+
+        self.stdout.write("{0} redemption counts written\n".format(created))
@@ -0,0 +1,126 @@
+from decimal import Decimal
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from checkout import benchmark
+from checkout.benchmark import QueryCounter, make_request
+from checkout.order import Order
+
+
+def bench_add_many(size):
+    order_obj = Order(make_request())
+    order_obj.persist()
+    lines = [{
+        "item_price": Decimal("9.99"),
+        "quantity": 2,
+        "description": "Item {0}".format(i)
+    } for i in range(size)]
+    with QueryCounter() as counter:
+        order_obj.add_many(lines)
+    return counter.count
+
+
+class Command(BaseCommand):
+
+    help = ("Reports the query count of checkout operations as the order "
+            "grows, checks the hot lookups use an index (SQLite only) and "
+            "measures the checkout flows against their budgets")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--sizes",
+            dest="sizes",
+            default="1,10,40,100",
+            help="Comma separated line item counts to benchmark"
+        ),
+        make_option("--flows",
+            dest="flows",
+            default=None,
+            help="Comma separated flows to measure (default: all)"
+        ),
+        make_option("--repeat",
+            dest="repeat",
+            type="int",
+            default=10,
+            help="Runs per flow; the median wall time is reported"
+        ),
+        make_option("--budgets",
+            dest="budgets",
+            default=benchmark.BUDGETS,
+            help="JSON file of per flow budgets"
+        ),
+        make_option("--update-budgets",
+            action="store_true",
+            dest="update_budgets",
+            default=False,
+            help="Write this run's measurements as the new budgets"
+        ),
+    )
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options["sizes"].split(",")]
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            for size in sizes:
+                self.stdout.write("add_many {0:>5} lines: {1} queries\n".format(
+                    size, bench_add_many(size)
+                ))
+            if connection.vendor == "sqlite":
+                self.check_query_plans()
+            self.check_flows(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def check_query_plans(self):
+        failures = []
+        for name, queryset, forbidden in benchmark.hot_queries():
+            plan = benchmark.explain(queryset)
+            ok = not benchmark.unindexed(plan, forbidden)
+            self.stdout.write("plan {0}: {1}\n    {2}\n".format(
+                name, "ok" if ok else "FAIL", "\n    ".join(plan)
+            ))
+            if not ok:
+                failures.append(name)
+        if failures:
+            raise CommandError("Unindexed query plans: {0}".format(
+                ", ".join(failures)
+            ))
+
+    def check_flows(self, options):
+        names = options["flows"] and options["flows"].split(",")
+        budgets = benchmark.load_budgets(options["budgets"])
+        results = {}
+        failures = []
+        with benchmark.benchmark_environment():
+            for name, setup, run in benchmark.flows():
+                if names and name not in names:
+                    continue
+                if setup is None:
+                    self.stdout.write("flow {0}: skipped\n".format(name))
+                    continue
+                result = results[name] = benchmark.measure(
+                    setup, run, repeat=options["repeat"]
+                )
+                over = benchmark.over_budget(result, budgets.get(name, {}))
+                self.stdout.write(
+                    "flow {0}: {1} queries, {2} ms, {3} allocations{4}\n".format(
+                        name, result["queries"], result["ms"],
+                        result["allocations"],
+                        " FAIL ({0})".format(", ".join(over)) if over else ""
+                    )
+                )
+                if over:
+                    failures.append(name)
+
+        if options["update_budgets"]:
+            benchmark.save_budgets(results, options["budgets"])
+            self.stdout.write("Budgets written to {0}\n".format(options["budgets"]))
+        elif failures:
+            raise CommandError("Flows over budget: {0}".format(
+                ", ".join(failures)
+            ))
@@ -0,0 +1,415 @@
+import math
+import os
+import random
+import shutil
+import string
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from optparse import make_option
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import requests
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.signals import got_request_exception
+from django.core.servers.basehttp import (WSGIRequestHandler, WSGIServer,
+    get_internal_wsgi_application)
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from checkout import benchmark, models
+from checkout.processors import fake_processor
+
+
+STEPS = ("add_item", "checkout", "confirm")
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted ``values``
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class ThreadedWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer(object):
+    """
+    Serves the project in a background thread on a free local port
+    """
+
+    def __init__(self, host="127.0.0.1"):
+        self.httpd = ThreadedWSGIServer((host, 0), QuietRequestHandler)
+        self.httpd.set_app(get_internal_wsgi_application())
+        self.url = "http://{0}:{1}".format(host, self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class LockMonitor(object):
+    """
+    Samples the database for sessions waiting on a lock, per table, while
+    the load test runs. Only PostgreSQL exposes lock waits; elsewhere
+    they show up as "database is locked" errors or slow steps.
+    """
+    QUERY = (
+        "SELECT COALESCE(c.relname, l.locktype) FROM pg_locks l "
+        "LEFT JOIN pg_class c ON c.oid = l.relation WHERE NOT l.granted"
+    )
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.supported = connection.vendor == "postgresql"
+        self.samples = 0
+        self.waits = defaultdict(int)
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        if self.supported:
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.supported:
+            self.thread.join()
+
+    def run(self):
+        from django.db import connections
+        # this thread's own connection
+        cursor = connections["default"].cursor()
+        try:
+            while not self.stopped.is_set():
+                cursor.execute(self.QUERY)
+                waiting = [row[0] for row in cursor.fetchall()]
+                self.samples += 1
+                self.peak = max(self.peak, len(waiting))
+                for name in waiting:
+                    self.waits[name] += 1
+                self.stopped.wait(self.interval)
+        finally:
+            connections["default"].close()
+
+
+class Results(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+        self.server_errors = defaultdict(int)
+        self.completed = 0
+
+    def record(self, step, seconds, error=None):
+        with self.lock:
+            if error:
+                self.errors[step][error] += 1
+            else:
+                self.timings[step].append(seconds)
+
+    def complete(self):
+        with self.lock:
+            self.completed += 1
+
+    def server_error(self, sender, **kwargs):
+        # e.g. "database is locked" under SQLite
+        error = sys.exc_info()[1]
+        with self.lock:
+            self.server_errors["{0}: {1}".format(
+                error.__class__.__name__, str(error)[:100]
+            )] += 1
+
+
+class Shopper(threading.Thread):
+    """
+    Checks out ``checkouts`` times in a row, each time as a new visitor
+    """
+
+    def __init__(self, command, results, checkouts, seed):
+        super(Shopper, self).__init__()
+        self.daemon = True
+        self.command = command
+        self.results = results
+        self.checkouts = checkouts
+        self.random = random.Random(seed)
+
+    def run(self):
+        for i in range(self.checkouts):
+            self.checkout()
+
+    def step(self, name, session, path, data, expect):
+        start = time.time()
+        try:
+            response = session.post(self.command.url + path, data=data,
+                headers={"X-CSRFToken": session.cookies[settings.CSRF_COOKIE_NAME]},
+                allow_redirects=False,
+                timeout=self.command.timeout
+            )
+        except requests.exceptions.RequestException as e:
+            self.results.record(name, time.time() - start, e.__class__.__name__)
+            return None
+        elapsed = time.time() - start
+        if response.status_code not in expect:
+            self.results.record(name, elapsed,
+                "unexpected HTTP {0}".format(response.status_code))
+            return None
+        self.results.record(name, elapsed)
+        return response
+
+    def checkout(self):
+        session = requests.Session()
+        # any token works as long as the cookie and the header agree
+        session.cookies[settings.CSRF_COOKIE_NAME] = "".join(
+            self.random.choice(string.ascii_letters) for i in range(32)
+        )
+        think = self.command.think
+
+        if not self.step("add_item", session, self.command.checkout_path, {
+            "item_description": "Load test item",
+            "item_amount": "25.00",
+        }, (200,)):
+            return
+        time.sleep(think)
+
+        payment = {
+            "amount": "25.00",
+            "token": "tok_loadtest",
+            "email": "shopper@example.com",
+            "billing_first_name": "Load",
+            "billing_last_name": "Test",
+            "billing_address1": "1 Main St",
+            "billing_city": "Springfield",
+            "billing_region": "IL",
+            "billing_postal_code": "62701",
+            "billing_country": "US",
+        }
+        if self.command.discount:
+            payment["discount_code"] = self.command.discount
+        if not self.step("checkout", session, self.command.checkout_path,
+                         payment, (302,)):
+            return
+        time.sleep(think)
+
+        if self.random.random() < self.command.double_clicks:
+            # a second click while the first is being processed; one of
+            # them gets "in progress", and the order must be charged once
+            responses = []
+            other = threading.Thread(target=lambda: responses.append(self.step(
+                "confirm (double click)", session, self.command.confirm_path,
+                {}, (200, 302)
+            )))
+            other.start()
+            responses.append(self.step("confirm", session,
+                self.command.confirm_path, {}, (200, 302)))
+            other.join()
+        else:
+            responses = [self.step("confirm", session,
+                self.command.confirm_path, {}, (302,))]
+        if any(r is not None and r.status_code == 302 for r in responses):
+            self.results.complete()
+
+
+class Command(BaseCommand):
+
+    help = ("Runs concurrent simulated shoppers through add item, checkout "
+            "and confirm, and reports throughput, latency per step, error "
+            "rates and database lock waits")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--shoppers",
+            dest="shoppers",
+            type="int",
+            default=10,
+            help="Concurrent shoppers"
+        ),
+        make_option("--checkouts",
+            dest="checkouts",
+            type="int",
+            default=20,
+            help="Checkouts per shopper"
+        ),
+        make_option("--think",
+            dest="think",
+            type="float",
+            default=0,
+            help="Seconds a shopper waits between steps"
+        ),
+        make_option("--discount",
+            dest="discount",
+            default=None,
+            help="Discount code every shopper uses, to load its row"
+        ),
+        make_option("--double-clicks",
+            dest="double_clicks",
+            type="float",
+            default=0,
+            help="Share of confirms submitted twice at once"
+        ),
+        make_option("--seed",
+            dest="seed",
+            type="int",
+            default=None,
+            help="Seed for the shoppers and the fake processor"
+        ),
+        make_option("--timeout",
+            dest="timeout",
+            type="float",
+            default=60,
+            help="Seconds before a request counts as failed"
+        ),
+        make_option("--url",
+            dest="url",
+            default=None,
+            help=("Base URL of a running server, configured with the fake "
+                  "processor, instead of a local server on a test database")
+        ),
+    )
+
+    def handle(self, *args, **options):
+        self.think = options["think"]
+        self.discount = options["discount"]
+        self.double_clicks = options["double_clicks"]
+        self.timeout = options["timeout"]
+        self.checkout_path = reverse("checkout")
+        self.confirm_path = reverse("checkout_confirm")
+
+        if options["url"]:
+            self.url = options["url"].rstrip("/")
+            self.run_shoppers(options, LockMonitor())
+            return
+
+        setup_test_environment()
+        directory = None
+        if connection.vendor == "sqlite":
+            # server threads can't share an in-memory database
+            directory = tempfile.mkdtemp()
+            connection.settings_dict["TEST_NAME"] = os.path.join(
+                directory, "loadtest.sqlite3"
+            )
+        old_name = connection.creation.create_test_db(verbosity=0)
+        server = None
+        try:
+            if self.discount:
+                models.Discount(code=self.discount, amount=1).save()
+            # a fake gateway with the latencies and failure rates of
+            # CHECKOUT["FAKE_PROCESSOR"]
+            with benchmark.benchmark_environment({"seed": options["seed"]}):
+                server = LocalServer()
+                server.start()
+                self.url = server.url
+                self.run_shoppers(options, LockMonitor())
+                self.check_charges()
+        finally:
+            if server is not None:
+                server.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            if directory:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def run_shoppers(self, options, monitor):
+        results = Results()
+        seeds = random.Random(options["seed"])
+        shoppers = [
+            Shopper(self, results, options["checkouts"], seeds.random())
+            for i in range(options["shoppers"])
+        ]
+        # the local server's threads need the test database committed
+        connection.close()
+
+        got_request_exception.connect(results.server_error)
+        monitor.start()
+        start = time.time()
+        for shopper in shoppers:
+            shopper.start()
+        for shopper in shoppers:
+            shopper.join()
+        elapsed = time.time() - start
+        monitor.stop()
+        got_request_exception.disconnect(results.server_error)
+
+        self.report(results, monitor, elapsed,
+            options["shoppers"] * options["checkouts"])
+
+    def report(self, results, monitor, elapsed, attempted):
+        self.stdout.write("{0} of {1} checkouts completed in {2:.1f}s: "
+            "{3:.1f} checkouts/s\n".format(
+                results.completed, attempted, elapsed,
+                results.completed / elapsed
+            ))
+        steps = list(STEPS) + sorted(
+            (set(results.timings) | set(results.errors)) - set(STEPS)
+        )
+        self.stdout.write("{0:<24}{1:>8}{2:>8}{3:>10}{4:>10}{5:>10}\n".format(
+            "step", "ok", "errors", "p50 ms", "p95 ms", "p99 ms"
+        ))
+        for step in steps:
+            timings = sorted(results.timings[step])
+            errors = sum(results.errors[step].values())
+            self.stdout.write("{0:<24}{1:>8}{2:>8}{3:>10}{4:>10}{5:>10}\n".format(
+                step, len(timings), errors, *[
+                    "-" if percentile(timings, p) is None else
+                    "{0:.1f}".format(percentile(timings, p) * 1000)
+                    for p in (50, 95, 99)
+                ]
+            ))
+            for error, count in sorted(results.errors[step].items()):
+                total = len(timings) + errors
+                self.stdout.write("    {0}: {1} ({2:.1%})\n".format(
+                    error, count, float(count) / total
+                ))
+
+        for error, count in sorted(results.server_errors.items()):
+            self.stdout.write("server error {0}: {1}\n".format(error, count))
+
+        if not monitor.supported:
+            self.stdout.write("lock waits: not sampled on {0}\n".format(
+                connection.vendor
+            ))
+        elif monitor.samples:
+            self.stdout.write("lock waits: peak {0} sessions, {1} samples\n".format(
+                monitor.peak, monitor.samples
+            ))
+            for name, count in sorted(monitor.waits.items(), key=lambda i: -i[1]):
+                self.stdout.write("    {0}: waiting in {1:.1%} of samples\n".format(
+                    name, float(count) / monitor.samples
+                ))
+
+    def check_charges(self):
+        charges = len([
+            charge for charge in fake_processor.gateway.charges.values()
+            if charge["paid"]
+        ])
+        orders = models.Order.objects.filter(status=models.Order.COMPLETE).count()
+        self.stdout.write("{0} paid charges for {1} completed orders{2}\n".format(
+            charges, orders, " - CHARGED MORE THAN ONCE" if charges > orders else ""
+        ))
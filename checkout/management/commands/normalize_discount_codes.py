@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from checkout.models import Discount
+
+
+class Command(BaseCommand):
+
+    help = "Fills in normalized_code for discounts created before it existed"
+
+    def handle(self, *args, **options):
+        count = 0
+        for discount in Discount.objects.filter(normalized_code__isnull=True):
+            discount.save()
+            count += 1
+        self.stdout.write("{0} discount codes normalized\n".format(count))
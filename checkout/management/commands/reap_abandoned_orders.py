@@ -0,0 +1,163 @@
+import time
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from checkout.models import LineItem, Order, OrderRevision, OrderTransaction
+from checkout.settings import CHECKOUT
+
+
+STATUSES = {
+    "incomplete": Order.INCOMPLETE,
+    "pending": Order.PENDING_PAYMENT,
+}
+
+
+class Command(BaseCommand):
+
+    help = ("Releases discount uses held by payments that never finished, "
+            "and deletes incomplete and pending payment orders older than "
+            "--age hours, with their line items, transactions and revisions, "
+            "in small batches so it can run alongside live traffic")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--age",
+            dest="age",
+            type="float",
+            default=72,
+            help="Minimum order age in hours"
+        ),
+        make_option("--statuses",
+            dest="statuses",
+            default="incomplete,pending",
+            help="Comma separated statuses to reap: incomplete, pending"
+        ),
+        make_option("--batch-size",
+            dest="batch_size",
+            type="int",
+            default=200,
+            help="Orders deleted per transaction"
+        ),
+        make_option("--sleep",
+            dest="sleep",
+            type="float",
+            default=0.5,
+            help="Seconds to pause between batches"
+        ),
+        make_option("--limit",
+            dest="limit",
+            type="int",
+            default=0,
+            help="Stop after this many orders (0 for no limit)"
+        ),
+        make_option("--dry-run",
+            action="store_true",
+            dest="dry_run",
+            default=False,
+            help="Count matching orders without deleting them"
+        ),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            statuses = [STATUSES[s.strip()] for s in options["statuses"].split(",")]
+        except KeyError as e:
+            raise CommandError("Unknown status {0}".format(e))
+        batch_size = options["batch_size"]
+        limit = options["limit"]
+        dry_run = options["dry_run"]
+        verbosity = int(options.get("verbosity", 1))
+        cutoff = datetime.now() - timedelta(hours=options["age"])
+
+        released = self.release_discounts(dry_run)
+        if released or verbosity:
+            self.stdout.write("{0} {1} stale discount reservations\n".format(
+                "Found" if dry_run else "Released", released
+            ))
+
+        reaped = 0
+        start = time.time()
+        # a status at a time, so each scan is a range of the
+        # (status, creation_date) index
+        for status in statuses:
+            stale = Order.objects.stale(status, cutoff)
+            last = None
+            while not limit or reaped < limit:
+                batch = stale
+                if last:
+                    batch = batch.filter(
+                        Q(creation_date__gt=last[0]) |
+                        Q(creation_date=last[0], pk__gt=last[1])
+                    )
+                size = batch_size if not limit else min(batch_size, limit - reaped)
+                rows = list(batch.values_list("creation_date", "pk")[:size])
+                if not rows:
+                    break
+                last = rows[-1]
+                pks = [pk for creation_date, pk in rows]
+
+                if dry_run:
+                    reaped += len(pks)
+                else:
+                    reaped += self.delete_orders(pks, statuses, cutoff)
+
+                if verbosity:
+                    elapsed = time.time() - start
+                    self.stdout.write("{0} {1} orders ({2:.0f}/s), {3} up to {4}\n".format(
+                        "found" if dry_run else "reaped",
+                        reaped, reaped / elapsed if elapsed else 0, status, last[0]
+                    ))
+                if options["sleep"] and not dry_run:
+                    time.sleep(options["sleep"])
+
+        self.stdout.write("{0} {1} orders older than {2}\n".format(
+            "Found" if dry_run else "Reaped", reaped, cutoff
+        ))
+
+    def delete_orders(self, pks, statuses, cutoff):
+        """
+        Deletes the orders in ``pks`` that are still stale, returning how
+        many were
+        """
+        with transaction.commit_on_success():
+            # re-check the status in case an order moved on since the scan
+            pks = list(Order.objects.filter(
+                pk__in=pks,
+                status__in=statuses,
+                creation_date__lt=cutoff
+            ).values_list("pk", flat=True))
+            if not pks:
+                return 0
+            for order in Order.objects.filter(
+                pk__in=pks, discount_reserved_date__isnull=False
+            ).select_related("discount"):
+                order.release_discount()
+            LineItem.objects.filter(order__in=pks).delete()
+            OrderRevision.objects.filter(order__in=pks).delete()
+            Order.objects.filter(pk__in=pks).update(latest_transaction=None)
+            OrderTransaction.objects.filter(order__in=pks).delete()
+            # anything else pointing at the orders (e.g. shipping
+            # addresses) is cascaded by the ORM
+            Order.objects.filter(pk__in=pks).delete()
+        return len(pks)
+
+    def release_discounts(self, dry_run):
+        """
+        Releases the discount uses held for payments that should have
+        finished by now, i.e. by requests that died
+        """
+        held = Order.objects.filter(
+            discount_reserved_date__lt=datetime.now() - timedelta(
+                seconds=CHECKOUT["PAYMENT_ATTEMPT_TIMEOUT"]
+            )
+        )
+        if dry_run:
+            return held.count()
+        released = 0
+        for order in held.select_related("discount").iterator():
+            order.release_discount()
+            released += 1
+        return released
@@ -0,0 +1,51 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from checkout.models import Order
+
+
+class Command(BaseCommand):
+
+    help = ("Recomputes the denormalized item_count, has_subscription and "
+            "latest_transaction columns on checkout orders")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size",
+            dest="batch_size",
+            type="int",
+            default=500,
+            help="Number of orders loaded per query"
+        ),
+        make_option("--dry-run",
+            action="store_true",
+            dest="dry_run",
+            default=False,
+            help="Report drifted orders without writing"
+        ),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        commit = not options["dry_run"]
+        verbosity = int(options.get("verbosity", 1))
+
+        checked = repaired = 0
+        last_pk = 0
+        while True:
+            batch = list(
+                Order.objects.filter(pk__gt=last_pk).order_by("pk")[:batch_size]
+            )
+            if not batch:
+                break
+            for order in batch:
+                if order.refresh_summary(commit=commit):
+                    repaired += 1
+                    if verbosity > 1:
+                        self.stdout.write("{0}\n".format(order))
+            checked += len(batch)
+            last_pk = batch[-1].pk
+
+        self.stdout.write("{0} of {1} orders {2}\n".format(
+            repaired, checked, "repaired" if commit else "out of date"
+        ))
@@ -0,0 +1,105 @@
+import threading
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, DatabaseError
+
+from checkout.models import Discount
+
+
+class Command(BaseCommand):
+
+    help = ("Redeems a temporary discount from concurrent threads and checks "
+            "that its usage limit holds exactly. Needs a database that "
+            "allows concurrent writers (e.g. PostgreSQL or MySQL).")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--threads",
+            dest="threads",
+            type="int",
+            default=10,
+            help="Number of concurrent redeemers"
+        ),
+        make_option("--attempts",
+            dest="attempts",
+            type="int",
+            default=20,
+            help="Redemption attempts per thread"
+        ),
+        make_option("--limit",
+            dest="limit",
+            type="int",
+            default=50,
+            help="Global usage limit of the temporary discount"
+        ),
+        make_option("--release-every",
+            dest="release_every",
+            type="int",
+            default=0,
+            help="Release instead of commit every Nth reservation, "
+                 "as a failed payment would"
+        ),
+    )
+
+    def handle(self, *args, **options):
+        discount = Discount(
+            description="stress_discount_redemption",
+            amount=1,
+            uses_limit=options["limit"]
+        )
+        discount.save()
+
+        results = {"committed": 0, "released": 0, "rejected": 0, "errors": 0}
+        lock = threading.Lock()
+
+        def redeem():
+            count = 0
+            try:
+                for i in range(options["attempts"]):
+                    outcome = "rejected"
+                    try:
+                        d = Discount.objects.get(pk=discount.pk)
+                        if d.reserve():
+                            count += 1
+                            if (options["release_every"] and
+                                count % options["release_every"] == 0):
+                                d.release()
+                                outcome = "released"
+                            else:
+                                d.commit()
+                                outcome = "committed"
+                    except DatabaseError:
+                        outcome = "errors"
+                    with lock:
+                        results[outcome] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=redeem) for i in range(options["threads"])]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        discount = Discount.objects.get(pk=discount.pk)
+        discount.delete()
+
+        attempts = options["threads"] * options["attempts"]
+        self.stdout.write(
+            "{0} attempts in {1:.2f}s ({2:.0f}/s): {3[committed]} committed, "
+            "{3[released]} released, {3[rejected]} rejected, "
+            "{3[errors]} errors\n".format(
+                attempts, elapsed, attempts / elapsed, results
+            )
+        )
+        self.stdout.write("times_used={0} reserved={1} limit={2}\n".format(
+            discount.times_used, discount.reserved, options["limit"]
+        ))
+
+        if (discount.times_used != results["committed"] or
+            discount.times_used > options["limit"] or
+            discount.reserved != 0):
+            raise CommandError("Usage limit was not enforced exactly")
@@ -2,15 +2,17 @@ import os
 import base64
 import binascii
 import pytz
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q
 from django.utils.translation import ugettext_lazy as _
 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User
 
+from checkout.cache import LookupCache
 from checkout.settings import CHECKOUT
 
 
@@ -34,6 +36,16 @@ class OrderManager(models.Manager):
     def canceled(self):
         return self.filter(status=Order.CANCELED)
 
+    def stale(self, status, before):
+        """
+        Orders with ``status`` created before ``before``, oldest first.
+        Served by the (status, creation_date) index.
+        """
+        return self.filter(
+            status=status,
+            creation_date__lt=before
+        ).order_by("creation_date", "pk")
+
 
 class Order(models.Model):
 
@@ -44,9 +56,10 @@ class Order(models.Model):
     REFUNDED = "refunded"
     CANCELED = "canceled"
 
-    key = models.CharField(max_length=20, editable=False)
+    key = models.CharField(max_length=20, editable=False, unique=True)
 
-    user = models.ForeignKey(User, null=True, related_name="orders")
+    # indexed by the (user, creation_date) index in Meta
+    user = models.ForeignKey(User, null=True, related_name="orders", db_index=False)
     customer_id = models.CharField(max_length=50, blank=True, null=True)
     email = models.EmailField(blank=True, null=True)
     notes = models.TextField(_("Notes"), blank=True, null=True)
@@ -68,8 +81,22 @@ class Order(models.Model):
 
     referral = models.ForeignKey("Referral", blank=True, null=True)
 
+    # indexed by the (status, creation_date) index in Meta
     status = models.CharField(_("Status"), max_length=20, blank=True)
 
+    # denormalized summary, maintained by LineItem and OrderTransaction
+    # (see refresh_summary and the repair_order_summaries command)
+    item_count = models.PositiveIntegerField(_("Item count"),
+        default=0, editable=False)
+    has_subscription = models.BooleanField(default=False, editable=False)
+    latest_transaction = models.ForeignKey("OrderTransaction",
+        blank=True, null=True, editable=False, related_name="+",
+        on_delete=models.SET_NULL)
+    # when a use of the discount was reserved for paying this order; holds
+    # left by requests that died are released by reap_abandoned_orders
+    discount_reserved_date = models.DateTimeField(blank=True, null=True,
+        editable=False, db_index=True)
+
     objects = OrderManager()
 
     def __unicode__(self):
@@ -79,10 +106,6 @@ class Order(models.Model):
     def get_absolute_url(self):
         return ("checkout_order_details", (self.key, ))
 
-    @property
-    def item_count(self):
-        return self.items.count()
-
     def save(self, *args, **kwargs):
         if not self.pk and not self.creation_date:
             self.creation_date = datetime.now()
@@ -103,14 +126,94 @@ class Order(models.Model):
 
     @property
     def is_subscription(self):
-        for item in self.items.all():
-            if item.subscription_plan:
-                return True
-        return False
+        return self.has_subscription
+
+    def refresh_summary(self, commit=True):
+        """
+        Recompute item_count, has_subscription and latest_transaction
+        from the related rows. Returns True if any of them changed.
+        """
+        item_count = self.items.count()
+        has_subscription = self.items.exclude(
+            subscription_plan__isnull=True
+        ).exclude(subscription_plan="").exists()
+        try:
+            latest_transaction_id = self.transactions.latest().pk
+        except OrderTransaction.DoesNotExist:
+            latest_transaction_id = None
+
+        changed = (
+            item_count != self.item_count or
+            has_subscription != self.has_subscription or
+            latest_transaction_id != self.latest_transaction_id
+        )
+        self.item_count = item_count
+        self.has_subscription = has_subscription
+        self.latest_transaction_id = latest_transaction_id
+        if changed and commit:
+            Order.objects.filter(pk=self.pk).update(
+                item_count=item_count,
+                has_subscription=has_subscription,
+                latest_transaction=latest_transaction_id
+            )
+        return changed
+
+    def reserve_discount(self):
+        """
+        Hold a use of the discount while the order is paid for. Returns
+        True if this call holds a use, None if another request holds one
+        for the order, and False if the discount is used up. A hold older
+        than CHECKOUT["PAYMENT_ATTEMPT_TIMEOUT"] was left by a request
+        that died, and is taken over.
+        """
+        # whole seconds, so the stamp compares equal on every backend
+        now = datetime.now().replace(microsecond=0)
+        stale = now - timedelta(seconds=CHECKOUT["PAYMENT_ATTEMPT_TIMEOUT"])
+        orders = Order.objects.filter(pk=self.pk)
+        if not orders.filter(discount_reserved_date__lt=stale).update(
+            discount_reserved_date=now
+        ):
+            if not orders.filter(discount_reserved_date__isnull=True).update(
+                discount_reserved_date=now
+            ):
+                return None
+            if not self.discount.reserve():
+                orders.filter(discount_reserved_date=now).update(
+                    discount_reserved_date=None
+                )
+                return False
+        self.discount_reserved_date = now
+        return True
+
+    def release_discount(self):
+        """
+        Give back the use held by reserve_discount(), unless another
+        request has taken it over
+        """
+        if self.discount_reserved_date and Order.objects.filter(
+            pk=self.pk, discount_reserved_date=self.discount_reserved_date
+        ).update(discount_reserved_date=None):
+            self.discount.release()
+        self.discount_reserved_date = None
+
+    def commit_discount(self):
+        """
+        Record the redemption of the discount, converting the use held for
+        the order if there is one
+        """
+        held = Order.objects.filter(
+            pk=self.pk, discount_reserved_date__isnull=False
+        ).update(discount_reserved_date=None)
+        self.discount_reserved_date = None
+        self.discount.commit(reserved=bool(held))
 
     class Meta:
         get_latest_by = "creation_date"
         ordering = ("-creation_date",)
+        index_together = [
+            ("user", "creation_date"),
+            ("status", "creation_date"),
+        ]
 
 
 class LineItemManager(models.Manager):
@@ -123,7 +226,8 @@ class LineItemManager(models.Manager):
 
 
 class LineItem(models.Model):
-    order = models.ForeignKey(Order, related_name="items")
+    # indexed by the (order, content_type, object_id) index in Meta
+    order = models.ForeignKey(Order, related_name="items", db_index=False)
     content_type = models.ForeignKey(ContentType, null=True)
     object_id = models.PositiveIntegerField(null=True)
     description = models.CharField(max_length=250, blank=True, null=True)
@@ -136,16 +240,59 @@ class LineItem(models.Model):
 
     objects = LineItemManager()
 
+    class Meta:
+        index_together = [
+            ("order", "content_type", "object_id"),
+        ]
+
     def __unicode__(self):
         return self.description or self.product.name
 
-    # product
+    def save(self, *args, **kwargs):
+        created = not self.pk
+        super(LineItem, self).save(*args, **kwargs)
+
+        updates = {}
+        if created:
+            updates["item_count"] = F("item_count") + 1
+        if self.subscription_plan:
+            updates["has_subscription"] = True
+        if updates:
+            Order.objects.filter(pk=self.order_id).update(**updates)
+            order = getattr(self, "_order_cache", None)
+            if order is not None:
+                if created:
+                    order.item_count += 1
+                if self.subscription_plan:
+                    order.has_subscription = True
+
+    def delete(self, *args, **kwargs):
+        super(LineItem, self).delete(*args, **kwargs)
+
+        updates = {"item_count": F("item_count") - 1}
+        if self.subscription_plan:
+            updates["has_subscription"] = LineItem.objects.filter(
+                order=self.order_id
+            ).exclude(
+                subscription_plan__isnull=True
+            ).exclude(subscription_plan="").exists()
+        Order.objects.filter(pk=self.order_id).update(**updates)
+        order = getattr(self, "_order_cache", None)
+        if order is not None:
+            order.item_count -= 1
+            if "has_subscription" in updates:
+                order.has_subscription = updates["has_subscription"]
+
+    # product, which checkout.products.resolve_products can fetch in bulk
     def get_product(self):
-        return self.content_type.get_object_for_this_type(id=self.object_id)
+        if not hasattr(self, "_product_cache"):
+            self._product_cache = self.content_type.get_object_for_this_type(id=self.object_id)
+        return self._product_cache
 
     def set_product(self, product):
         self.content_type = ContentType.objects.get_for_model(type(product))
         self.object_id = product.pk
+        self._product_cache = product
 
     product = property(get_product, set_product)
 
@@ -171,10 +318,13 @@ class OrderRevision(models.Model):
 class OrderTransaction(models.Model):
 
     INCOMPLETE = "incomplete"
+    PROCESSING = "processing"
     FAILED = "failed"
     COMPLETE = "complete"
     VOIDED = "voided"
     REFUNDED = "refunded"
+    PARTIALLY_REFUNDED = "partially refunded"
+    DISPUTED = "disputed"
 
     CREDIT = CHECKOUT["CREDIT"]
     CHECK = CHECKOUT["CHECK"]
@@ -182,7 +332,8 @@ class OrderTransaction(models.Model):
 
     METHOD_CHOICES = CHECKOUT["PAYMENT_METHOD_CHOICES"]
 
-    order = models.ForeignKey(Order, related_name="transactions")
+    # indexed by the (order, ...) indexes in Meta
+    order = models.ForeignKey(Order, related_name="transactions", db_index=False)
 
     creation_date = models.DateTimeField()
     status = models.CharField(max_length=20)
@@ -193,7 +344,15 @@ class OrderTransaction(models.Model):
 
     last_four = models.CharField(max_length=4, blank=True, null=True)
     reference_number = models.CharField(max_length=32, blank=True, null=True)
+    # the gateway's id for the charge or subscription, set once it succeeds
+    gateway_reference = models.CharField(max_length=50, blank=True, null=True,
+        db_index=True, editable=False)
     details = models.CharField(max_length=250, blank=True, null=True)
+    # payment attempts, see begin_attempt
+    attempts = models.PositiveIntegerField(default=0, editable=False)
+    attempt_date = models.DateTimeField(blank=True, null=True, editable=False)
+    idempotency_key = models.CharField(max_length=64, unique=True,
+        blank=True, null=True, editable=False)
     received_data = models.TextField(blank=True, null=True)
 
     billing_first_name = models.CharField(max_length=50, blank=True)
@@ -208,6 +367,11 @@ class OrderTransaction(models.Model):
     class Meta:
         get_latest_by = "creation_date"
         ordering = ('-creation_date',)
+        # creation_date last, so the default ordering comes from the index
+        index_together = [
+            ("order", "payment_method", "creation_date"),
+            ("order", "status", "creation_date"),
+        ]
 
     def save(self, **kwargs):
         if not self.pk:
@@ -216,12 +380,189 @@ class OrderTransaction(models.Model):
         if not self.status:
             self.status = self.INCOMPLETE
 
+        created = not self.pk
         super(OrderTransaction, self).save(**kwargs)
 
+        if created:
+            Order.objects.filter(pk=self.order_id).update(
+                latest_transaction=self
+            )
+            order = getattr(self, "_order_cache", None)
+            if order is not None:
+                order.latest_transaction = self
+
+    def begin_attempt(self, order_key):
+        """
+        Claim the transaction for a payment attempt and return the attempt's
+        idempotency key, which the processor passes on to the gateway.
+        Returns None if another request is processing or has completed it.
+
+        A new attempt (and key) starts after a failed one. An attempt that
+        was interrupted, or has been processing for longer than
+        CHECKOUT["PAYMENT_ATTEMPT_TIMEOUT"] seconds, is retried with the
+        same key so the gateway can't charge twice.
+        """
+        now = datetime.now()
+        stale = now - timedelta(seconds=CHECKOUT["PAYMENT_ATTEMPT_TIMEOUT"])
+        transactions = OrderTransaction.objects.filter(pk=self.pk)
+
+        key = "{0}-{1}-{2}".format(order_key, self.pk, self.attempts + 1)
+        if transactions.filter(
+            status__in=[self.INCOMPLETE, self.FAILED],
+            attempts=self.attempts
+        ).update(
+            status=self.PROCESSING,
+            attempts=F("attempts") + 1,
+            attempt_date=now,
+            idempotency_key=key
+        ):
+            self.attempts += 1
+        elif self.idempotency_key and transactions.filter(
+            Q(attempt_date__isnull=True) | Q(attempt_date__lt=stale),
+            status=self.PROCESSING,
+            idempotency_key=self.idempotency_key
+        ).update(attempt_date=now):
+            key = self.idempotency_key
+        else:
+            return None
+
+        self.status = self.PROCESSING
+        self.attempt_date = now
+        self.idempotency_key = key
+        return key
+
+    def interrupt_attempt(self):
+        """
+        The gateway call failed without an answer, so the charge may or may
+        not have gone through. The next attempt retries the same key.
+        """
+        OrderTransaction.objects.filter(
+            pk=self.pk, idempotency_key=self.idempotency_key
+        ).update(attempt_date=None)
+        self.attempt_date = None
+
+    def fail_attempt(self, error=None):
+        """
+        The gateway call failed in a way that can't have charged (a decline,
+        a rejected request), so the next attempt starts with a new key.
+        """
+        OrderTransaction.objects.filter(
+            pk=self.pk, status=self.PROCESSING, idempotency_key=self.idempotency_key
+        ).update(status=self.FAILED, received_data=error)
+        self.status = self.FAILED
+        self.received_data = error
+
+    def delete(self, *args, **kwargs):
+        order_id = self.order_id
+        pk = self.pk
+        # Order.latest_transaction is nulled on delete, so point it back
+        # at the next most recent transaction
+        super(OrderTransaction, self).delete(*args, **kwargs)
+        try:
+            latest = OrderTransaction.objects.filter(order=order_id).latest()
+        except OrderTransaction.DoesNotExist:
+            latest = None
+        Order.objects.filter(pk=order_id, latest_transaction__isnull=True).update(
+            latest_transaction=latest
+        )
+        order = getattr(self, "_order_cache", None)
+        if order is not None and order.latest_transaction_id in (pk, None):
+            order.latest_transaction = latest
+
+
+class SubscriptionManager(models.Manager):
+
+    def record(self, reference_id, customer_id, **fields):
+        """
+        Create or update the local copy of gateway subscription
+        ``reference_id``
+        """
+        fields["customer_id"] = customer_id
+        if self.filter(reference_id=reference_id).update(
+            modified_date=datetime.now(), **fields
+        ):
+            return
+        sid = transaction.savepoint()
+        try:
+            self.create(reference_id=reference_id, **fields)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # recorded concurrently
+            transaction.savepoint_rollback(sid)
+            self.filter(reference_id=reference_id).update(
+                modified_date=datetime.now(), **fields
+            )
+
+    def active(self, customer_id):
+        return self.filter(customer_id=customer_id, status=self.model.ACTIVE)
+
+
+class Subscription(models.Model):
+    """
+    Local index of gateway subscriptions so finding a customer's
+    subscription doesn't have to search their payment history
+    """
+    ACTIVE = "active"
+    CANCELED = "canceled"
+    PAST_DUE = "past_due"
+    PENDING = "pending"
+    EXPIRED = "expired"
+
+    # indexed by the (customer_id, status) index in Meta
+    customer_id = models.CharField(max_length=50, db_index=False)
+    reference_id = models.CharField(max_length=50, unique=True)
+    plan_id = models.CharField(max_length=100, blank=True)
+    status = models.CharField(max_length=20)
+    price = models.DecimalField(max_digits=18, decimal_places=2, blank=True, null=True)
+    next_billing_date = models.DateField(blank=True, null=True)
+
+    creation_date = models.DateTimeField()
+    modified_date = models.DateTimeField()
+
+    objects = SubscriptionManager()
+
+    class Meta:
+        index_together = [
+            ("customer_id", "status"),
+        ]
+
+    def __unicode__(self):
+        return u"{0} ({1}) for {2}".format(
+            self.reference_id, self.status, self.customer_id
+        )
+
+    def save(self, **kwargs):
+        self.modified_date = datetime.now()
+        if not self.pk:
+            self.creation_date = self.modified_date
+        super(Subscription, self).save(**kwargs)
+
+
+class DiscountManager(models.Manager):
+
+    def lookup(self, code):
+        """
+        Find a discount by user-entered code, ignoring case and
+        surrounding whitespace. Returns None if there is no match.
+        Results, including misses, are cached (see discount_cache).
+        """
+        if not code:
+            return None
+        return discount_cache.get(Discount.normalize_code(code))
+
+    def lookup_uncached(self, normalized_code):
+        try:
+            return self.get(normalized_code=normalized_code)
+        except Discount.DoesNotExist:
+            return None
+
 
 class Discount(models.Model):
 
     code = models.CharField(max_length=20, unique=True)
+    # canonical form of code, so lookups are an exact index probe
+    normalized_code = models.CharField(max_length=20, unique=True,
+        null=True, editable=False)
     description = models.CharField(max_length=100, blank=True, null=True)
     active = models.BooleanField(default=True)
     amount = models.DecimalField(decimal_places=2, max_digits=8, blank=True, null=True)
@@ -231,14 +572,22 @@ class Discount(models.Model):
     uses_limit = models.IntegerField(_("Global usage limit"), blank=True, null=True)
     individual_use_limit = models.IntegerField(_("Individual usage limit"), default=1)
     times_used = models.IntegerField(default=0)
+    # uses held by orders between reserve() and commit()/release()
+    reserved = models.IntegerField(default=0, editable=False)
     user = models.ForeignKey(User, blank=True, null=True)
     active_date = models.DateTimeField(blank=True, null=True)
     expire_date = models.DateTimeField(blank=True, null=True)
 
+    objects = DiscountManager()
+
     def __unicode__(self):
         return self.code
 
-    def is_valid(self, user=None):
+    @staticmethod
+    def normalize_code(code):
+        return code.strip().upper()
+
+    def in_date_range(self):
         if self.active_date:
             if (self.active_date.tzinfo and datetime.now(pytz.utc) < self.active_date) or (
                 not self.active_date.tzinfo and
@@ -251,31 +600,158 @@ class Discount(models.Model):
                 datetime.now() > self.expire_date
             ):
                 return False
-        if self.uses_limit > 0 and self.times_used >= self.uses_limit:
+        return True
+
+    def is_valid(self, user=None):
+        if not self.in_date_range():
+            return False
+        if self.uses_limit > 0 and self.times_used + self.reserved >= self.uses_limit:
             return False
         if not self.active:
             return False
         if user:
             if self.user and user != self.user:
                 return False
-            elif user.orders.filter(discount=self).count() >= self.individual_use_limit:
+            elif self.redemption_count(user) >= self.individual_use_limit:
                 # if user has met the usage limit of this discount
                 return False
         return True
 
+    def redemption_count(self, user):
+        counts = DiscountRedemption.objects.filter(
+            discount=self, user=user
+        ).values_list("count", flat=True)
+        return counts[0] if counts else 0
+
+    def reserve(self):
+        """
+        Hold one use of the discount for an order about to be paid for.
+        The global usage limit is checked in the same UPDATE, so
+        concurrent checkouts can't overshoot it. Returns False if the
+        limit has been reached.
+        """
+        reserved = Discount.objects.filter(
+            Q(uses_limit__isnull=True) | Q(uses_limit__lte=0) |
+            Q(uses_limit__gt=F("times_used") + F("reserved")),
+            pk=self.pk
+        ).update(reserved=F("reserved") + 1)
+        if reserved:
+            self.reserved += 1
+            # cached copies would still offer the held use
+            discount_cache.invalidate(self.normalized_code)
+        return bool(reserved)
+
+    def release(self):
+        """
+        Give back a use held by reserve(), e.g. when the payment failed
+        """
+        if Discount.objects.filter(pk=self.pk, reserved__gt=0).update(
+            reserved=F("reserved") - 1
+        ):
+            discount_cache.invalidate(self.normalized_code)
+        self.reserved = max(self.reserved - 1, 0)
+
+    def commit(self, reserved=True):
+        """
+        Record a redemption, converting a use held by reserve() unless
+        ``reserved`` is False. Single-user discounts and discounts that
+        are used up or expired are deactivated.
+        """
+        updates = {"times_used": F("times_used") + 1}
+        queryset = Discount.objects.filter(pk=self.pk)
+        if reserved:
+            updates["reserved"] = F("reserved") - 1
+            queryset = queryset.filter(reserved__gt=0)
+        if not queryset.update(**updates) and reserved:
+            # the reservation has gone; count the use anyway
+            Discount.objects.filter(pk=self.pk).update(
+                times_used=F("times_used") + 1
+            )
+        self.times_used += 1
+        if reserved:
+            self.reserved = max(self.reserved - 1, 0)
+
+        used_up = Discount.objects.filter(
+            pk=self.pk,
+            uses_limit__gt=0,
+            times_used__gte=F("uses_limit")
+        )
+        if self.user or not self.in_date_range():
+            Discount.objects.filter(pk=self.pk).update(active=False)
+            self.active = False
+        elif used_up.update(active=False):
+            self.active = False
+        discount_cache.invalidate(self.normalized_code)
+
     def associated_orders(self):
         return self.order_set.all()
 
     def save(self, *args, **kwargs):
         if not self.code:
             self.code = base64.b16encode(os.urandom(8))
+        previous_code = self.normalized_code
+        self.normalized_code = self.normalize_code(self.code)
 
         super(Discount, self).save(*args, **kwargs)
 
+        discount_cache.invalidate(self.normalized_code)
+        if previous_code and previous_code != self.normalized_code:
+            discount_cache.invalidate(previous_code)
+
+    def delete(self, *args, **kwargs):
+        super(Discount, self).delete(*args, **kwargs)
+        discount_cache.invalidate(self.normalized_code)
+
     class Meta:
         ordering = ("active_date", "expire_date", "code")
 
 
+class DiscountRedemptionManager(models.Manager):
+
+    def record(self, discount, user):
+        """
+        Count one more redemption of ``discount`` by ``user``
+        """
+        if self.filter(discount=discount, user=user).update(count=F("count") + 1):
+            return
+        sid = transaction.savepoint()
+        try:
+            self.create(discount=discount, user=user, count=1)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # created concurrently
+            transaction.savepoint_rollback(sid)
+            self.filter(discount=discount, user=user).update(count=F("count") + 1)
+
+
+class DiscountRedemption(models.Model):
+    """
+    Number of completed orders for which a user redeemed a discount, so
+    the individual usage limit is a single row lookup
+    """
+    # indexed by unique_together in Meta
+    discount = models.ForeignKey(Discount, related_name="redemptions", db_index=False)
+    user = models.ForeignKey(User, related_name="discount_redemptions")
+    count = models.PositiveIntegerField(default=0)
+
+    objects = DiscountRedemptionManager()
+
+    class Meta:
+        unique_together = ("discount", "user")
+
+    def __unicode__(self):
+        return u"{0} x{1} by {2}".format(self.discount, self.count, self.user)
+
+
+discount_cache = LookupCache("discount",
+    Discount.objects.lookup_uncached,
+    size=CHECKOUT["DISCOUNT_CACHE_SIZE"],
+    timeout=CHECKOUT["DISCOUNT_CACHE_TIMEOUT"],
+    negative_timeout=CHECKOUT["DISCOUNT_NEGATIVE_CACHE_TIMEOUT"],
+    local_timeout=CHECKOUT["DISCOUNT_LOCAL_CACHE_TIMEOUT"]
+)
+
+
 class Referral(models.Model):
     source = models.CharField(max_length=100)
 
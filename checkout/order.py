@@ -1,9 +1,13 @@
 import datetime
 import models
 
+from django.db import transaction
+from django.db.models import F, Q
+
 from django.contrib.contenttypes.models import ContentType
 
 from checkout.settings import CHECKOUT
+from checkout.totals import OrderTotals, to_decimal
 
 ORDER_ID = CHECKOUT["COOKIE_KEY_ORDER"]
 
@@ -21,12 +25,38 @@ class OrderException(Exception):
 
 
 class Order:
-    def __init__(self, request):
+    """
+    Session-bound wrapper around the current ``models.Order``.
+
+    With ``deferred=True`` the wrapper acts as a unit of work: line items
+    are loaded once, changes to the order row and its lines are kept in
+    memory and ``flush`` writes them in a single UPDATE plus batched line
+    writes. Views using this mode must call ``flush`` before returning.
+
+    A visitor without an order gets an unsaved draft, which is only
+    inserted on the first real change (``add``, ``apply_discount`` or
+    ``add_referral``).
+    """
+
+    def __init__(self, request, deferred=False):
+        self.request = request
+        self.deferred = deferred
+        self._lines = None
+        self._totals = None
+        self._new_lines = []
+        self._dirty_lines = {}
+        self._dirty_fields = set()
+        self._discount_reserved = False
+        # inserted by this request, so no other request can add to it yet
+        self._created = False
+
         order_id = request.session.get(ORDER_ID, None)
         order = None
         if order_id:
             try:
-                order = models.Order.objects.get(pk=order_id, status__in=(
+                order = models.Order.objects.select_related(
+                    "latest_transaction"
+                ).get(pk=order_id, status__in=(
                     models.Order.INCOMPLETE, models.Order.PENDING_PAYMENT
                 ))
             except models.Order.DoesNotExist:
@@ -40,13 +70,126 @@ class Order:
         self.order = order
         if request.user.is_authenticated() and not self.order.user:
             self.order.user = request.user
-            self.order.save()
-        request.session[ORDER_ID] = self.order.pk
+            self.save("user")
+        if not self.order.pk:
+            if ORDER_ID in request.session:
+                del request.session[ORDER_ID]
+        elif order_id != self.order.pk:
+            request.session[ORDER_ID] = self.order.pk
 
     def __iter__(self):
-        for item in self.order.items.all():
+        for item in self.lines:
             yield item
 
+    @property
+    def lines(self):
+        if self._lines is None:
+            if self.order.pk:
+                self._lines = list(self.order.items.all())
+            else:
+                self._lines = []
+        return self._lines
+
+    @property
+    def is_draft(self):
+        return not self.order.pk
+
+    def persist(self):
+        """
+        Insert a draft order and remember it in the session
+        """
+        if not self.order.pk:
+            self.order.save()
+            self._created = True
+            self._dirty_fields = set()
+            # a new order has no lines yet
+            if self._lines is None:
+                self._lines = []
+            self.request.session[ORDER_ID] = self.order.pk
+
+    @property
+    def totals(self):
+        """
+        Running line item sums, maintained as lines are added and
+        rebuilt from the cached lines or a single aggregate query when
+        they have been invalidated
+        """
+        if self._totals is None:
+            if self._lines is not None:
+                self._totals = OrderTotals.from_lines(self._lines)
+            else:
+                self._totals = OrderTotals.from_database(self.order)
+        return self._totals
+
+    @property
+    def item_count(self):
+        return self.order.item_count
+
+    @property
+    def is_subscription(self):
+        return self.order.has_subscription
+
+    def save(self, *fields):
+        """
+        Persist ``fields`` of the order, or the whole row if none are
+        given. In deferred mode the write is postponed until ``flush``.
+        """
+        if not self.order.pk:
+            # a draft is written in full by persist()
+            return
+        if self.deferred:
+            self._dirty_fields.update(fields or [
+                f.name for f in self.order._meta.fields if not f.primary_key
+            ])
+        elif fields:
+            self.order.save(update_fields=fields)
+        else:
+            self.order.save()
+
+    def flush(self):
+        """
+        Write pending line items and dirty order fields.
+        """
+        with transaction.commit_on_success():
+            self._flush_lines()
+            if self._dirty_fields:
+                self.order.save(update_fields=list(self._dirty_fields))
+                self._dirty_fields = set()
+
+    def _flush_lines(self):
+        if self._new_lines:
+            models.LineItem.objects.bulk_create(self._new_lines)
+            # bulk_create skips LineItem.save, so keep the order's summary
+            # the way it does, with increments that concurrent adds to the
+            # order can't overwrite. An order this request created can
+            # take the counts with its other fields.
+            if self._created:
+                self._dirty_fields.update(["item_count", "has_subscription"])
+            else:
+                summary = {"item_count": F("item_count") + len(self._new_lines)}
+                if any(line.subscription_plan for line in self._new_lines):
+                    summary["has_subscription"] = True
+                models.Order.objects.filter(pk=self.order.pk).update(**summary)
+            # bulk_create does not set primary keys on every backend
+            self._lines = None
+
+        # group updates by their new values so each distinct price point
+        # costs one UPDATE rather than one per line
+        grouped = {}
+        for pk, item in self._dirty_lines.items():
+            grouped.setdefault(
+                (item.item_price, item.item_tax, item.total), []
+            ).append(pk)
+        for (item_price, item_tax, total), pks in grouped.items():
+            models.LineItem.objects.filter(pk__in=pks).update(
+                item_price=item_price,
+                item_tax=item_tax,
+                total=total
+            )
+
+        self._new_lines = []
+        self._dirty_lines = {}
+
     @property
     def pk(self):
         try:
@@ -69,6 +212,8 @@ class Order:
         return self.get_status() == models.Order.PENDING_PAYMENT
 
     def get_transactions(self):
+        if not self.order.pk:
+            return models.OrderTransaction.objects.none()
         return self.order.transactions.all()
 
     def new(self, request):
@@ -78,56 +223,166 @@ class Order:
         )
         if request.user.is_authenticated():
             order.user = request.user
-        order.save()
-        request.session[ORDER_ID] = order.pk
         return order
 
     def add(self, item_price, item_tax=0, quantity=1, **kwargs):
-        product = kwargs.get("product", None)
-        description = kwargs.get("description", "")
-        subscription_plan = kwargs.get("subscription_plan", "")
-        total = quantity * item_price
-        if item_tax:
-            total += quantity * item_tax
-        if product:
-            product_content_type = ContentType.objects.get_for_model(product)
-            item_search = models.LineItem.objects.filter(
-                order=self.order,
-                content_type__pk=product_content_type.id,
-                object_id=product.pk,
-                description=description,
-                subscription_plan=subscription_plan
-            )
-        else:
-            item_search = models.LineItem.objects.filter(
-                order=self.order,
-                description=description,
-                subscription_plan=subscription_plan
+        kwargs.update({
+            "item_price": item_price,
+            "item_tax": item_tax,
+            "quantity": quantity,
+        })
+        self.add_many([kwargs])
+
+    def add_many(self, items):
+        """
+        Bulk version of ``add``. ``items`` is an iterable of dicts holding
+        the keyword arguments ``add`` accepts. Existing lines are loaded
+        with a single query and new lines are written with bulk_create.
+        """
+        self.persist()
+        content_types = {}
+        existing = {}
+        has_items = False
+        is_subscription = False
+        for line in self.lines:
+            has_items = True
+            if line.subscription_plan:
+                is_subscription = True
+            key = (line.description or "", line.subscription_plan or "")
+            existing.setdefault(
+                key + (line.content_type_id, line.object_id), line
             )
-        if not item_search.count():
-            if self.order.items.count() and self.order.is_subscription:
-                return
-            item = models.LineItem()
-            item.order = self.order
+            existing.setdefault(key, line)
+
+        for data in items:
+            data = dict(data)
+            item_price = to_decimal(data.pop("item_price"))
+            item_tax = to_decimal(data.pop("item_tax", 0))
+            quantity = data.pop("quantity", 1)
+            product = data.get("product", None)
+            description = data.get("description", "")
+            subscription_plan = data.get("subscription_plan", "")
+            total = quantity * item_price
+            if item_tax:
+                total += quantity * item_tax
+            key = (description or "", subscription_plan or "")
             if product:
-                item.product = product
-            if kwargs.get("attributes"):
-                item.attributes = kwargs.get("attributes")
-            item.subscription_plan = subscription_plan
-            item.item_price = item_price
-            item.item_tax = item_tax
-            item.total = total
-            item.quantity = quantity
-            item.description = description
-            item.save()
-        elif item_search[0].total != total:
-            item = item_search[0]
-            item.item_price = item_price
-            item.item_tax = item_tax
-            item.total = total
-            item.save()
+                model = type(product)
+                if model not in content_types:
+                    content_types[model] = ContentType.objects.get_for_model(product)
+                key += (content_types[model].pk, product.pk)
+            item = existing.get(key)
+            if item is None:
+                if has_items and is_subscription:
+                    continue
+                item = models.LineItem(order=self.order)
+                if product:
+                    item.content_type = content_types[type(product)]
+                    item.object_id = product.pk
+                if data.get("attributes"):
+                    item.attributes = data.get("attributes")
+                item.subscription_plan = subscription_plan
+                item.item_price = item_price
+                item.item_tax = item_tax
+                item.total = total
+                item.quantity = quantity
+                item.description = description
+                if self._totals is not None:
+                    self._totals.add(item)
+                self._new_lines.append(item)
+                self._lines.append(item)
+                existing[key] = item
+                existing.setdefault(key[:2], item)
+                has_items = True
+                if subscription_plan:
+                    is_subscription = True
+            elif item.total != total:
+                if self._totals is not None:
+                    self._totals.remove(item)
+                item.item_price = item_price
+                item.item_tax = item_tax
+                item.total = total
+                if self._totals is not None:
+                    self._totals.add(item)
+                if item.pk:
+                    self._dirty_lines[item.pk] = item
+
+        # the columns are incremented when the new lines are written
+        self.order.item_count = len(self._lines)
+        self.order.has_subscription = is_subscription
+
+        if not self.deferred:
+            self.flush()
+
+    def _product_lookup(self, products):
+        lookup = Q()
+        by_model = {}
+        for product in products:
+            by_model.setdefault(type(product), []).append(product.pk)
+        for model, pks in by_model.items():
+            content_type = ContentType.objects.get_for_model(model)
+            lookup |= Q(content_type=content_type, object_id__in=pks)
+        return lookup
+
+    def _find_many(self, products):
+        products = list(products)
+        if not products:
+            return {}
+        if not self.order.pk:
+            raise LineItemDoesNotExist
+        lines = models.LineItem.objects.filter(
+            self._product_lookup(products),
+            order=self.order
+        )
+        found = dict(
+            ((line.content_type_id, line.object_id), line.pk)
+            for line in lines
+        )
+        for product in products:
+            content_type = ContentType.objects.get_for_model(type(product))
+            if (content_type.pk, product.pk) not in found:
+                raise LineItemDoesNotExist
+        return found
+
+    def update_many(self, items):
+        """
+        Bulk version of ``update``. ``items`` is an iterable of
+        ``(product, quantity)`` pairs. Lines sharing a quantity are
+        updated with a single UPDATE.
+        """
+        items = list(items)
+        self.flush()
+        found = self._find_many(product for product, quantity in items)
+        grouped = {}
+        for product, quantity in items:
+            content_type = ContentType.objects.get_for_model(type(product))
+            grouped.setdefault(quantity, []).append(
+                found[(content_type.pk, product.pk)]
+            )
+        with transaction.commit_on_success():
+            for quantity, pks in grouped.items():
+                models.LineItem.objects.filter(pk__in=pks).update(
+                    quantity=quantity,
+                    total=(F("item_price") + F("item_tax")) * quantity
+                )
+        self._lines = None
+        self._totals = None
+
+    def remove_many(self, products):
+        """
+        Bulk version of ``remove``. Raises ``LineItemDoesNotExist``
+        without deleting anything if any product is not in the order.
+        """
+        self.flush()
+        found = self._find_many(products)
+        if found:
+            models.LineItem.objects.filter(pk__in=found.values()).delete()
+            self.order.refresh_summary()
+        self._lines = None
+        self._totals = None
 
     def remove(self, product):
+        self.flush()
         try:
             item = models.LineItem.objects.get(
                 order=self.order,
@@ -136,9 +391,13 @@ class Order:
         except models.LineItem.DoesNotExist:
             raise LineItemDoesNotExist
         else:
+            item.order = self.order
             item.delete()
+        self._lines = None
+        self._totals = None
 
     def update(self, product, quantity, unit_price=None):
+        self.flush()
         try:
             item = models.LineItem.objects.get(
                 order=self.order,
@@ -151,89 +410,108 @@ class Order:
             item.save()
         except models.LineItem.DoesNotExist:
             raise LineItemDoesNotExist
+        self._lines = None
+        self._totals = None
 
     def update_totals(self):
-        subtotal = 0
-        total = 0
-        shipping_waiver = False
-        tax_waiver = False
-        if self.order.discount and self.order.discount.free_shipping:
-            shipping_waiver = True
-        if self.order.discount and self.order.discount.no_tax:
-            tax_waiver = True
-        for item in self:
-            subtotal += item.quantity * item.item_price
-            total += item.total
-        self.order.subtotal = subtotal
-        if self.order.discount_amount:
-            total = float(subtotal) - float(self.order.discount_amount)
-            if total < 0:
-                total = 0
-        if self.order.tax and not tax_waiver:
-            total += self.order.tax
-        if self.order.shipping and not shipping_waiver:
-            total += self.order.shipping
-        self.order.subtotal = subtotal
-        self.order.total = total
-        self.order.save()
+        self.totals.apply(self.order)
+        self.save("subtotal", "total")
 
     def update_status(self, status):
         self.order.status = status
-        self.order.save()
+        self.save("status")
 
         if self.order.status == self.order.COMPLETE:
             self.complete_order()
 
     def apply_discount(self, discount=None, amount=None):
+        # a draft is only inserted once there is a discount to record, so
+        # bad or used up codes don't create orders
         if discount:
-            try:
-                discount_obj = models.Discount.objects.get(code__iexact=discount)
-            except:
+            discount_obj = models.Discount.objects.lookup(discount)
+            if not discount_obj or not discount_obj.is_valid(self.order.user):
                 return
-            if discount_obj.is_valid(self.order.user):
-                self.order.discount = discount_obj
-                if discount_obj.amount and discount_obj.amount > 0:
-                    self.order.discount_amount = discount_obj.amount
-                elif discount_obj.percentage:
-                    self.order.discount_amount = float(self.total) * (float(discount_obj.percentage) / 100.00)
-                elif discount_obj.no_tax:
-                    self.order.discount_amount = self.order.tax
-                elif discount_obj.free_shipping:
-                    self.order.discount_amount = self.order.shipping
-                transaction, created = models.OrderTransaction.objects.get_or_create(
-                    order=self.order,
-                    payment_method=models.OrderTransaction.DISCOUNT
+            self.persist()
+            self.order.discount = discount_obj
+            if discount_obj.amount and discount_obj.amount > 0:
+                self.order.discount_amount = discount_obj.amount
+            elif discount_obj.percentage:
+                self.order.discount_amount = to_decimal(
+                    to_decimal(self.total) * discount_obj.percentage / 100
                 )
-                if (transaction.amount != self.order.discount_amount or
-                    transaction.reference_number != discount_obj.code):
-                    transaction.amount = self.order.discount_amount
-                    transaction.reference_number = discount_obj.code
-                    transaction.save()
+            elif discount_obj.no_tax:
+                self.order.discount_amount = self.order.tax
+            elif discount_obj.free_shipping:
+                self.order.discount_amount = self.order.shipping
+            transaction, created = models.OrderTransaction.objects.get_or_create(
+                order=self.order,
+                payment_method=models.OrderTransaction.DISCOUNT
+            )
+            if (transaction.amount != self.order.discount_amount or
+                transaction.reference_number != discount_obj.code):
+                transaction.amount = self.order.discount_amount
+                transaction.reference_number = discount_obj.code
+                transaction.save()
         elif amount:
+            self.persist()
             self.order.discount_amount = amount
-        self.order.save()
+        else:
+            return
+        self.save("discount", "discount_amount")
         self.update_totals()
 
     def add_referral(self, referral_text):
+        self.persist()
         referral, created = models.Referral.objects.get_or_create(
             source=referral_text
         )
         self.order.referral = referral
-        self.order.save()
+        self.save("referral")
+
+    def reserve_discount(self):
+        """
+        Hold a use of the order's discount while payment is taken.
+        Returns False if the discount has been used up in the meantime.
+        """
+        if not self.order.discount or self._discount_reserved:
+            return True
+        held = self.order.reserve_discount()
+        self._discount_reserved = bool(held)
+        return held is not False
+
+    def release_discount(self):
+        if self._discount_reserved:
+            self.order.release_discount()
+            self._discount_reserved = False
 
     def complete_order(self):
         self.order.status = models.Order.COMPLETE
-        self.order.save()
+        self.save("status")
         if self.order.discount:
-            self.order.discount.times_used += 1
-            if self.order.discount.user or not self.order.discount.is_valid():
-                self.order.discount.active = False
-            self.order.discount.save()
+            self.order.commit_discount()
+            self._discount_reserved = False
+            if self.order.user:
+                models.DiscountRedemption.objects.record(
+                    self.order.discount, self.order.user
+                )
 
     def clear(self):
-        self.order.items.all().delete()
-        self.order.transactions.all().delete()
+        if self.order.pk:
+            self.order.items.all().delete()
+            self.order.transactions.all().delete()
+            # now, with the delete, so lines added before the next flush
+            # are counted from zero
+            models.Order.objects.filter(pk=self.order.pk).update(
+                item_count=0, has_subscription=False
+            )
+        self._lines = []
+        self._totals = OrderTotals()
+        self._new_lines = []
+        self._dirty_lines = {}
+        self.order.item_count = 0
+        self.order.has_subscription = False
+        self.order.latest_transaction = None
         self.order.discount = None
         self.order.discount_amount = 0
         self.order.status = models.Order.INCOMPLETE
-        self.order.save()
+        self.save("discount", "discount_amount", "status")
@@ -0,0 +1,48 @@
+# Processor methods that don't talk to the gateway, left alone by the
+# processor wrappers
+LOCAL_METHODS = (
+    "get_card_last4", "parse_webhook", "webhook_details", "webhook_challenge",
+)
+
+
+class ProcessorUnavailable(Exception):
+    """
+    The payment gateway couldn't be reached in time, or has been failing
+    and the circuit breaker is open
+    """
+
+
+class ProcessorResult(object):
+    """
+    The outcome of a payment processor call.
+
+    ``reference_id`` is the gateway's id for what was created or acted on
+    (customer, charge, subscription ...). Card details are filled in when
+    the gateway response includes them, so callers don't need a second
+    request to look them up. ``raw`` is the untouched SDK response.
+    """
+
+    def __init__(self, success, reference_id=None, error=None, error_code=None,
+                 card_brand=None, card_last4=None, card_exp_month=None,
+                 card_exp_year=None, raw=None):
+        self.success = bool(success)
+        self.reference_id = reference_id
+        self.error = error
+        self.error_code = error_code
+        self.card_brand = card_brand
+        self.card_last4 = card_last4
+        self.card_exp_month = card_exp_month
+        self.card_exp_year = card_exp_year
+        self.raw = raw
+
+    def __nonzero__(self):
+        return self.success
+
+    def __repr__(self):
+        if self.success:
+            return "<ProcessorResult success {0}>".format(self.reference_id)
+        return "<ProcessorResult failed {0!r}>".format(self.error)
+
+    @classmethod
+    def failure(cls, error, error_code=None, raw=None):
+        return cls(False, error=error, error_code=error_code, raw=raw)
@@ -1,26 +1,201 @@
+import calendar
+import hashlib
+import json
 import logging
+from datetime import datetime
 from decimal import Decimal
 
 from django.conf import settings
+from django.core.cache import cache
 
 import braintree
+from braintree.util.http import Http
 
+from checkout.models import Subscription
+from checkout.processors.base import ProcessorResult
+from checkout.processors.transport import transport
 from checkout.settings import CHECKOUT
 
 logger = logging.getLogger("checkout.processors.braintree_processor")
 
-# Configure Braintree
-braintree.Configuration.configure(
-    braintree.Environment.Production if settings.IS_PROD else braintree.Environment.Sandbox,
-    settings.BRAINTREE_MERCHANT_ID,
-    settings.BRAINTREE_PUBLIC_KEY,
-    settings.BRAINTREE_PRIVATE_KEY
+
+
+class PooledHttp(Http):
+    """
+    Braintree's HTTP strategy, over the shared keep-alive transport
+    """
+
+    def http_do(self, http_verb, path, headers, request_body):
+        data, files = request_body, None
+        if isinstance(request_body, tuple):
+            data, files = request_body
+        response = transport.request(http_verb, path,
+            headers=headers,
+            data=data,
+            files=files,
+            verify=self.environment.ssl_certificate
+        )
+        return [response.status_code, response.text]
+
+
+configured = False
+
+
+def configure():
+    """
+    Configures the Braintree SDK, in the sandbox unless settings.IS_PROD.
+    Done by the first Processor rather than on import.
+    """
+    global configured
+    if not configured:
+        braintree.Configuration.configure(
+            braintree.Environment.Production if getattr(settings, "IS_PROD", False)
+                else braintree.Environment.Sandbox,
+            settings.BRAINTREE_MERCHANT_ID,
+            settings.BRAINTREE_PUBLIC_KEY,
+            settings.BRAINTREE_PRIVATE_KEY,
+            http_strategy=PooledHttp
+        )
+        configured = True
+
+# errors worth retrying, see checkout.processors.resilience
+TRANSIENT_ERRORS = (
+    braintree.exceptions.ServerError,
+    braintree.exceptions.DownForMaintenanceError,
+)
+# errors after which a payment can't have been taken, so the next attempt
+# may use a new idempotency key; after any other error it must not
+DEFINITE_ERRORS = (
+    braintree.exceptions.AuthenticationError,
+    braintree.exceptions.AuthorizationError,
+    braintree.exceptions.NotFoundError,
 )
 
+# how long results are kept for calls made with an idempotency key
+REPLAY_TIMEOUT = 60 * 60 * 24
+IN_FLIGHT = "in-flight"
+
+# notification kinds checkout.webhooks acts on
+WEBHOOK_ACTIONS = {
+    "subscription_charged_successfully": "subscription_charged",
+    "subscription_charged_unsuccessfully": "subscription_updated",
+    "subscription_went_active": "subscription_updated",
+    "subscription_went_past_due": "subscription_updated",
+    "subscription_expired": "subscription_updated",
+    "subscription_canceled": "subscription_canceled",
+    "dispute_opened": "disputed",
+}
+
+
+def card_details(card):
+    if not card:
+        return {}
+    return {
+        "card_brand": card.card_type,
+        "card_last4": card.last_4,
+        "card_exp_month": card.expiration_month,
+        "card_exp_year": card.expiration_year,
+    }
+
+
+def default_card(customer):
+    for card in customer.credit_cards:
+        if card.default:
+            return card
+    if customer.credit_cards:
+        return customer.credit_cards[0]
+    return None
+
+
+def error_result(result, default=None):
+    """
+    A failed ProcessorResult from a Braintree error response
+    """
+    errors = result.errors.deep_errors
+    if errors:
+        return ProcessorResult.failure(
+            ", ".join(e.message for e in errors),
+            error_code=errors[0].code,
+            raw=result
+        )
+    transaction = getattr(result, "transaction", None)
+    if transaction:
+        return ProcessorResult.failure(
+            transaction.processor_response_text,
+            error_code=transaction.processor_response_code,
+            raw=result
+        )
+    return ProcessorResult.failure(default or result.message, raw=result)
+
+
+def customer_result(customer, raw=None):
+    # the customer response already carries its cards, so there is no
+    # need to retrieve them again
+    return ProcessorResult(True,
+        reference_id=customer.id,
+        raw=raw or customer,
+        **card_details(default_card(customer))
+    )
+
+
+def subscription_status(sub):
+    # "Past Due" -> "past_due"
+    return sub.status.lower().replace(" ", "_")
+
+
+def index_subscription(sub, customer_id=None):
+    """
+    Update the local Subscription index from a gateway subscription. Without
+    ``customer_id`` only subscriptions already in the index are updated.
+    """
+    fields = {
+        "status": subscription_status(sub),
+        "plan_id": sub.plan_id or "",
+        "price": sub.price,
+        "next_billing_date": sub.next_billing_date,
+    }
+    if customer_id:
+        Subscription.objects.record(sub.id, customer_id, **fields)
+    else:
+        Subscription.objects.filter(reference_id=sub.id).update(
+            modified_date=datetime.now(), **fields
+        )
+
+
+def replay_cache_key(idempotency_key):
+    return "checkout:braintree:replay:{0}".format(idempotency_key)
+
+
+def begin_replayable(idempotency_key):
+    """
+    Braintree has no idempotency keys, so calls made with one go through
+    Django's cache. Returns the stored result of an earlier call with the
+    same key, IN_FLIGHT if an earlier call started but its result was never
+    stored (it timed out or the worker died), or None for a first call.
+    """
+    if not idempotency_key:
+        return None
+    key = replay_cache_key(idempotency_key)
+    if cache.add(key, IN_FLIGHT, REPLAY_TIMEOUT):
+        return None
+    stored = cache.get(key)
+    if stored is None or stored == IN_FLIGHT:
+        return IN_FLIGHT
+    return ProcessorResult(**stored)
+
+
+def store_replayable(idempotency_key, result):
+    if idempotency_key:
+        stored = dict(result.__dict__)
+        del stored["raw"]
+        cache.set(replay_cache_key(idempotency_key), stored, REPLAY_TIMEOUT)
+    return result
+
 
 class Processor:
 
     def __init__(self, **kwargs):
+        configure()
 
         if kwargs.get("user", None):
             self.user = kwargs.pop("user")
@@ -60,7 +235,7 @@ class Processor:
                         "credit_card": credit_card_data
                     })
                 else:
-                    return True, customer_id, None, cust
+                    return customer_result(cust)
             except:
                 pass
         try:
@@ -74,32 +249,24 @@ class Processor:
                     "credit_card": credit_card_data
                 })
         except:
-            return False, None, "An exception occurred while creating the customer record", None
+            return ProcessorResult.failure("An exception occurred while creating the customer record")
 
         if not result.is_success:
-            if len(result.errors.deep_errors):  # this shouldn't be necessary
-                error = result.errors.deep_errors[0]
-            else:
-                error = "The payment information is not valid"
-        else:
-            customer_id = result.customer.id
-            error = None
-        return result.is_success, customer_id, error, result
+            return error_result(result, "The payment information is not valid")
+        return customer_result(result.customer, raw=result)
 
     def get_customer(self, customer_id):
         return braintree.Customer.find(customer_id)
 
     def delete_customer(self, customer_id):
         result = braintree.Customer.delete(customer_id)
-        return result.is_success
+        if not result.is_success:
+            return error_result(result)
+        return ProcessorResult(True, reference_id=customer_id, raw=result)
 
     def get_customer_card(self, customer_id):
         try:
-            customer = self.get_customer(customer_id)
-            for card in customer.credit_cards:
-                if card.default:
-                    return card
-            return customer.credit_cards[0]
+            return default_card(self.get_customer(customer_id))
         except:
             return None
 
@@ -117,10 +284,7 @@ class Processor:
 
     def handle_billing_info(self, data, customer_id=None, payment_token=None, **kwargs):
 
-        #default response items
-        success = False
         result = None
-        error = None
 
         # expiration date is date due to different formatting requirements
         formatted_expire_date = data.get("expiration_date").strftime("%m/%Y")
@@ -219,18 +383,18 @@ class Processor:
                 }
             })
 
-        if result:
-            success = result.is_success
-            if not success:  # this will be from the Transaction class, not Customer
-                error = result.message
-                logger.warning("Payment profile save failed for {0} {1} ({2})".format(
-                    data.get("billing_first_name"), data.get("billing_last_name"), error
-                ))
-                reference_id = None
-            else:
-                reference_id = result.transaction.id
-
-        return success, reference_id, error, result
+        if not result.is_success:  # this will be from the Transaction class, not Customer
+            logger.warning("Payment profile save failed for {0} {1} ({2})".format(
+                data.get("billing_first_name"), data.get("billing_last_name"), result.message
+            ))
+            return error_result(result)
+        if getattr(result, "transaction", None):
+            return ProcessorResult(True,
+                reference_id=result.transaction.id,
+                raw=result,
+                **card_details(result.transaction.credit_card_details)
+            )
+        return customer_result(result.customer, raw=result)
 
     def submit_for_settlement(self, amount=None, data=None, reference_id=None):
 
@@ -257,60 +421,92 @@ class Processor:
             })
 
         if result:
-            return result.is_success, result
+            return self.transaction_result(result)
+
+        return ProcessorResult.failure("No transaction id or data provided")
 
-        return False, "No transaction id or data provided"
+    def transaction_result(self, result):
+        if not result.is_success:
+            return error_result(result)
+        return ProcessorResult(True,
+            reference_id=result.transaction.id,
+            raw=result,
+            **card_details(result.transaction.credit_card_details)
+        )
 
-    def charge(self, amount, customer_id=None, payment_method_token=None):
+    def charge(self, amount, customer_id=None, payment_method_token=None,
+               idempotency_key=None):
         if payment_method_token:
-            result = braintree.Transaction.sale({
+            data = {
                 "amount": amount,
                 "payment_method_token": payment_method_token,
                 "options": {
                     "submit_for_settlement": True
                 }
-            })
+            }
         elif customer_id:
-            result = braintree.Transaction.sale({
+            data = {
                 "amount": amount,
                 "customer_id": customer_id,
                 "payment_method_token": payment_method_token,
                 "options": {
                     "submit_for_settlement": True
                 }
-            })
+            }
         else:
-            return False, None
-        if not result.is_success:
-            if result.errors.deep_errors:
-                errors = ", ".join(result.errors.deep_errors)
-            else:
-                errors = result.transaction.processor_response_text
-            return False, errors
-        return result.is_success, result
+            return ProcessorResult.failure("No customer id or payment method provided")
+
+        replayed = begin_replayable(idempotency_key)
+        if replayed == IN_FLIGHT:
+            replayed = self.find_charge(idempotency_key)
+        if replayed is not None:
+            return replayed
+
+        if idempotency_key:
+            # lets find_charge tell whether an interrupted attempt went through
+            data["order_id"] = idempotency_key
+        result = braintree.Transaction.sale(data)
+        return store_replayable(idempotency_key, self.transaction_result(result))
+
+    def find_charge(self, idempotency_key):
+        """
+        The result of an earlier charge made with ``idempotency_key``, or
+        None if it never reached Braintree
+        """
+        search_results = braintree.Transaction.search(
+            braintree.TransactionSearch.order_id == idempotency_key
+        )
+        for transaction in search_results.items:
+            if transaction.status in (
+                braintree.Transaction.Status.Authorized,
+                braintree.Transaction.Status.SubmittedForSettlement,
+                braintree.Transaction.Status.Settling,
+                braintree.Transaction.Status.Settled
+            ):
+                return store_replayable(idempotency_key, ProcessorResult(True,
+                    reference_id=transaction.id,
+                    raw=transaction,
+                    **card_details(transaction.credit_card_details)
+                ))
+        return None
 
     def refund(self, reference_id, amount=None):
-        transaction = braintree.Transaction.find(reference_id)
+        try:
+            transaction = braintree.Transaction.find(reference_id)
+        except braintree.exceptions.NotFoundError:
+            transaction = None
         if transaction:
             if amount:
-                    transaction = braintree.Transaction.refund(transaction.id, amount)
+                result = braintree.Transaction.refund(transaction.id, amount)
             else:
                 result = braintree.Transaction.refund(transaction.id)
+            return self.transaction_result(result)
 
-            if not result.is_success:
-                errors = result.errors.deep_errors
-
-            return result.is_success or False, errors
-
-        return False, "Transaction could not be found"
+        return ProcessorResult.failure("Transaction could not be found")
 
     def void(self, reference_id):
         result = braintree.Transaction.void(reference_id)
-
-        if not result.is_success:
-            errors = result.errors.deep_errors
-
-        return result.is_success or False, errors
+        return self.transaction_result(result)
 
     def update_card(self, payment_token, data):
         formatted_expire_date = data.get("expiration_date").strftime("%m/%Y")
@@ -322,25 +518,36 @@ class Processor:
         }
 
         result = braintree.CreditCard.update(payment_token, credit_card_data)
+        if not result.is_success:
+            return error_result(result)
+        return ProcessorResult(True,
+            reference_id=payment_token,
+            raw=result,
+            **card_details(result.credit_card)
+        )
 
-        return result.is_success or False
+    def create_subscription(self, customer_id, plan_id, price, start_date=None,
+                            idempotency_key=None):
+        replayed = begin_replayable(idempotency_key)
+        if replayed is not None and replayed != IN_FLIGHT:
+            return replayed
 
-    def create_subscription(self, customer_id, plan_id, price, start_date=None):
         customer = braintree.Customer.find(customer_id)
         token = customer.credit_cards[0].token
-        # could finding a customer's subscription BE any more awkward?!
-        search_results = braintree.Transaction.search(
-            braintree.TransactionSearch.customer_id == customer_id
-        )
-        existing = None
-        for result in search_results.items:
-            if result.subscription_id:
-                sub = braintree.Subscription.find(result.subscription_id)
-                if sub.status is braintree.Subscription.Status.Active:
-                    existing = sub.id
-                    continue
+        if replayed == IN_FLIGHT:
+            # an interrupted attempt may have created the subscription
+            for sub in customer.credit_cards[0].subscriptions:
+                if (sub.plan_id == plan_id and
+                    sub.status == braintree.Subscription.Status.Active):
+                    index_subscription(sub, customer_id)
+                    return store_replayable(idempotency_key,
+                        ProcessorResult(True, reference_id=sub.id, raw=sub)
+                    )
+        existing = self.find_subscription_id(customer_id)
         if existing and CHECKOUT["ALLOW_PRERENEWAL"]:
-            return self.extend_subscription(existing, price, CHECKOUT["PRERENEWAL_DISCOUNT_CODE"])
+            return store_replayable(idempotency_key, self.extend_subscription(
+                existing, price, CHECKOUT["PRERENEWAL_DISCOUNT_CODE"]
+            ))
 
         data = {
             "payment_method_token": token,
@@ -351,24 +558,56 @@ class Processor:
             data["first_billing_date"] = start_date
         sub_result = braintree.Subscription.create(data)
         if not sub_result.is_success:
-            if sub_result.errors.deep_errors:
-                return False, ", ".join(sub_result.errors.deep_errors)
-            else:
-                return False, sub_result.transaction.processor_response_text
-        return sub_result.is_success, sub_result
+            return store_replayable(idempotency_key, error_result(sub_result))
+        index_subscription(sub_result.subscription, customer_id)
+        return store_replayable(idempotency_key, ProcessorResult(True,
+            reference_id=sub_result.subscription.id,
+            raw=sub_result
+        ))
 
     can_prerenew = True
 
     def get_subscription(self, customer_id, status="active"):
+        subscription_id = self.find_subscription_id(customer_id,
+            active=status == "active")
+        if subscription_id:
+            return braintree.Subscription.find(subscription_id)
+        return None
+
+    def find_subscription_id(self, customer_id, active=True):
+        """
+        The id of the customer's (active) subscription, from the local
+        Subscription index. When the index has no match, which may just
+        mean it is stale, the customer's transactions are searched and
+        whatever is found is indexed.
+        """
+        if active:
+            subscriptions = Subscription.objects.active(customer_id)
+        else:
+            subscriptions = Subscription.objects.filter(customer_id=customer_id)
+        indexed = subscriptions.order_by("-creation_date").values_list(
+            "reference_id", flat=True)[:1]
+        if indexed:
+            return indexed[0]
+        for reference_id, status in self.index_customer_subscriptions(customer_id):
+            if not active or status == Subscription.ACTIVE:
+                return reference_id
+        return None
+
+    def index_customer_subscriptions(self, customer_id):
+        # could finding a customer's subscription BE any more awkward?!
         search_results = braintree.Transaction.search(
             braintree.TransactionSearch.customer_id == customer_id
         )
+        found = []
+        seen = set()
         for result in search_results.items:
-            if result.subscription_id:
+            if result.subscription_id and result.subscription_id not in seen:
+                seen.add(result.subscription_id)
                 sub = braintree.Subscription.find(result.subscription_id)
-                if status != "active" or sub.status == "Active":
-                    return sub
-        return None
+                index_subscription(sub, customer_id)
+                found.append((sub.id, subscription_status(sub)))
+        return found
 
     def extend_subscription(self, subscription_id, amount, discount_code, billing_cycles=1):
         sub = braintree.Subscription.find(subscription_id)
@@ -399,8 +638,70 @@ class Processor:
                     ]
                 }
             })
-        return update_result
+        if not update_result.is_success:
+            return error_result(update_result)
+        index_subscription(update_result.subscription)
+        return ProcessorResult(True, reference_id=subscription_id, raw=update_result)
 
     def cancel_subscription(self, subscription_id):
         result = braintree.Subscription.cancel(subscription_id)
-        return result.is_success
+        if not result.is_success:
+            return error_result(result)
+        index_subscription(result.subscription)
+        return ProcessorResult(True, reference_id=subscription_id, raw=result)
+
+    def webhook_challenge(self, request):
+        return braintree.WebhookNotification.verify(request.GET.get("bt_challenge"))
+
+    def parse_webhook(self, request):
+        """
+        ``(event id, event type, payload)`` of a webhook request, or None if
+        its signature doesn't check out
+        """
+        signature = request.POST.get("bt_signature", "")
+        payload = request.POST.get("bt_payload", "")
+        try:
+            notification = braintree.WebhookNotification.parse(signature, payload)
+        except braintree.exceptions.InvalidSignatureError:
+            return None
+        # notifications have no id of their own, a redelivery has the
+        # same payload
+        event_id = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+        return event_id, notification.kind, json.dumps({
+            "bt_signature": signature,
+            "bt_payload": payload,
+        })
+
+    def webhook_details(self, event_type, payload):
+        action = WEBHOOK_ACTIONS.get(event_type)
+        if not action:
+            return None
+        data = json.loads(payload)
+        notification = braintree.WebhookNotification.parse(
+            data["bt_signature"], data["bt_payload"]
+        )
+
+        if action == "disputed":
+            dispute = notification.dispute
+            return {
+                "action": action,
+                "transaction_id": dispute.transaction.id,
+                "amount": dispute.amount,
+            }
+
+        sub = notification.subscription
+        details = {
+            "action": action,
+            "subscription_id": sub.id,
+            "status": subscription_status(sub),
+            "plan_id": sub.plan_id,
+        }
+        if action == "subscription_charged" and sub.transactions:
+            # the newest transaction comes first
+            details["transaction_id"] = sub.transactions[0].id
+            details["amount"] = sub.transactions[0].amount
+            # in UTC
+            details["charged"] = datetime.fromtimestamp(
+                calendar.timegm(sub.transactions[0].created_at.utctimetuple())
+            )
+        return details
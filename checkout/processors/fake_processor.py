@@ -0,0 +1,460 @@
+"""
+An in-memory payment gateway, for load tests and offline development. Point
+CHECKOUT["PAYMENT_PROCESSOR"] here and configure it with
+CHECKOUT["FAKE_PROCESSOR"].
+
+Calls take a latency drawn from the configured distributions, and charges
+can be declined, time out, or go through with the response lost. With a
+SEED the same sequence of calls gets the same latencies and outcomes.
+Cards ending in 0002 and the token "tok_chargeDeclined" are always
+declined.
+"""
+import hashlib
+import hmac
+import json
+import math
+import random
+import threading
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+import requests
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.crypto import constant_time_compare
+
+from checkout.processors.base import ProcessorResult
+from checkout.processors.transport import DeadlineExceeded, transport
+from checkout.settings import CHECKOUT
+
+
+class GatewayTimeout(requests.exceptions.ReadTimeout):
+    pass
+
+
+class NotFound(Exception):
+    pass
+
+
+# errors worth retrying, see checkout.processors.resilience
+TRANSIENT_ERRORS = (GatewayTimeout,)
+# errors after which no payment can have been taken
+DEFINITE_ERRORS = (NotFound,)
+
+DECLINED_TOKENS = ("tok_chargeDeclined",)
+DECLINED_SUFFIX = "0002"
+BILLING_PERIOD = timedelta(days=30)
+
+# event types checkout.webhooks acts on; events look like Stripe's
+WEBHOOK_ACTIONS = {
+    "charge.refunded": "refunded",
+    "charge.dispute.created": "disputed",
+    "invoice.payment_succeeded": "subscription_charged",
+    "customer.subscription.updated": "subscription_updated",
+    "customer.subscription.deleted": "subscription_canceled",
+}
+
+
+class FakeGateway(object):
+    """
+    The gateway's state and randomness, shared by every Processor in the
+    process
+    """
+
+    def __init__(self, seed=None, latency=None, decline_rate=0, timeout_rate=0,
+                 lost_response_rate=0, timeout=30):
+        self.random = random.Random(seed)
+        self.latency = latency or {}
+        self.decline_rate = decline_rate
+        self.timeout_rate = timeout_rate
+        self.lost_response_rate = lost_response_rate
+        self.timeout = timeout
+        self.lock = threading.RLock()
+        self.counter = 0
+        self.tokens = {}
+        self.customers = {}
+        self.charges = {}
+        self.plans = {}
+        self.subscriptions = {}
+        self.replays = {}
+
+    @classmethod
+    def from_settings(cls, **overrides):
+        options = dict(
+            (key.lower(), value)
+            for key, value in CHECKOUT["FAKE_PROCESSOR"].items()
+        )
+        options.update(overrides)
+        return cls(**options)
+
+    def next_id(self, prefix):
+        self.counter += 1
+        return "{0}_{1:08d}".format(prefix, self.counter)
+
+    def sample_latency(self, method):
+        spec = self.latency.get(method, self.latency.get("default", 0))
+        if isinstance(spec, (int, float)):
+            return spec
+        kind, params = spec[0], spec[1:]
+        if kind == "constant":
+            return params[0]
+        if kind == "uniform":
+            return self.random.uniform(*params)
+        if kind == "exponential":
+            return self.random.expovariate(1.0 / params[0])
+        if kind == "lognormal":
+            return self.random.lognormvariate(math.log(params[0]), params[1])
+        raise ImproperlyConfigured(
+            "Unknown FAKE_PROCESSOR latency distribution {0!r}".format(kind)
+        )
+
+    def declines(self):
+        return self.decline_rate and self.random.random() < self.decline_rate
+
+    def wait(self, seconds, method):
+        # like a real request, give up at the caller's deadline
+        remaining = transport.remaining()
+        if remaining is not None and seconds > remaining:
+            time.sleep(max(remaining, 0))
+            raise DeadlineExceeded("Deadline passed during {0}".format(method))
+        time.sleep(seconds)
+
+    def call(self, method, apply, idempotency_key=None):
+        """
+        Runs ``apply`` (which changes the gateway's state and returns the
+        result) as a gateway call: after a latency, subject to timeouts
+        and lost responses, and only once per ``idempotency_key``
+        """
+        with self.lock:
+            fate = self.random.random()
+            latency = self.sample_latency(method)
+
+        if fate < self.timeout_rate:
+            self.wait(self.timeout, method)
+            raise GatewayTimeout("{0} timed out".format(method))
+        self.wait(latency, method)
+
+        with self.lock:
+            if idempotency_key and idempotency_key in self.replays:
+                return self.replays[idempotency_key]
+            result = apply()
+            if idempotency_key:
+                self.replays[idempotency_key] = result
+
+        if fate < self.timeout_rate + self.lost_response_rate:
+            raise GatewayTimeout("{0} response lost".format(method))
+        return result
+
+    def card(self, number=None, exp_month=None, exp_year=None, token=None):
+        if token in self.tokens:
+            return dict(self.tokens[token])
+        if token:
+            # tokens from a client-side form the fake never saw
+            number = "4000000000000002" if token in DECLINED_TOKENS else "4242424242424242"
+        number = str(number or "4242424242424242")
+        return {
+            "type": "Visa",
+            "last4": number[-4:],
+            "exp_month": exp_month or 12,
+            "exp_year": exp_year or date.today().year + 1,
+            "declined": number.endswith(DECLINED_SUFFIX),
+        }
+
+
+gateway = FakeGateway.from_settings()
+
+
+def configure(**options):
+    """
+    Replaces the gateway with a new, empty one. ``options`` override
+    CHECKOUT["FAKE_PROCESSOR"], in lowercase (``seed=1, decline_rate=0.1``).
+    """
+    global gateway
+    gateway = FakeGateway.from_settings(**options)
+    return gateway
+
+
+def card_details(card):
+    return {
+        "card_brand": card["type"],
+        "card_last4": card["last4"],
+        "card_exp_month": card["exp_month"],
+        "card_exp_year": card["exp_year"],
+    }
+
+
+def customer_result(customer):
+    return ProcessorResult(True,
+        reference_id=customer["id"],
+        raw=customer,
+        **card_details(customer["active_card"])
+    )
+
+
+def declined(reference_id=None, raw=None):
+    return ProcessorResult(False,
+        reference_id=reference_id,
+        error="Your card was declined.",
+        error_code="card_declined",
+        raw=raw
+    )
+
+
+def sign(payload):
+    """
+    The X-Fake-Signature header for a webhook ``payload``
+    """
+    return hmac.new(settings.SECRET_KEY.encode("utf-8"), payload,
+        hashlib.sha256).hexdigest()
+
+
+def find(records, reference_id):
+    try:
+        return records[reference_id]
+    except KeyError:
+        raise NotFound("No such object: {0}".format(reference_id))
+
+
+class Processor:
+
+    def __init__(self, **kwargs):
+
+        if kwargs.get("user", None):
+            self.user = kwargs.pop("user")
+
+    def create_plan(self, interval, amount, id, name, currency="usd"):
+        def apply():
+            if id not in gateway.plans:
+                gateway.plans[id] = {
+                    "id": id,
+                    "name": name,
+                    "amount": amount,
+                    "interval": interval,
+                    "currency": currency,
+                }
+            return dict(gateway.plans[id])
+        return gateway.call("create_plan", apply)
+
+    def create_token(self, number, exp_month, exp_year, cvc, currency=None, **kwargs):
+        def apply():
+            token = gateway.next_id("tok")
+            gateway.tokens[token] = gateway.card(number, exp_month, exp_year)
+            return {"id": token, "card": dict(gateway.tokens[token])}
+        return gateway.call("create_token", apply)
+
+    def create_customer(self, data, customer_id=None):
+        expiration_date = data.get("expiration_date")
+        card = gateway.card(
+            number=data.get("card_number"),
+            exp_month=expiration_date and expiration_date.month,
+            exp_year=expiration_date and expiration_date.year,
+            token=data.get("token")
+        )
+
+        def apply():
+            customer = gateway.customers.get(customer_id)
+            if customer is None:
+                customer = {
+                    "id": gateway.next_id("cus"),
+                    "email": data.get("email"),
+                    "subscriptions": [],
+                }
+                gateway.customers[customer["id"]] = customer
+            customer["active_card"] = card
+            return customer_result(customer)
+        return gateway.call("create_customer", apply)
+
+    def get_customer(self, customer_id):
+        return gateway.call("get_customer",
+            lambda: find(gateway.customers, customer_id))
+
+    def delete_customer(self, customer_id):
+        def apply():
+            if gateway.customers.pop(customer_id, None) is None:
+                return ProcessorResult.failure("No such customer")
+            return ProcessorResult(True, reference_id=customer_id)
+        return gateway.call("delete_customer", apply)
+
+    def get_customer_card(self, customer_id):
+        try:
+            return self.get_customer(customer_id)["active_card"]
+        except NotFound:
+            return None
+
+    def get_payment_details(self, token):
+        return gateway.call("get_payment_details",
+            lambda: gateway.tokens.get(token))
+
+    def get_card_last4(self, card_obj):
+        return card_obj["last4"]
+
+    def get_transaction(self, transaction_id):
+        return gateway.call("get_transaction",
+            lambda: find(gateway.charges, transaction_id))
+
+    def charge(self, amount, customer_id=None, payment_token=None,
+               idempotency_key=None, **kwargs):
+        def apply():
+            if customer_id:
+                card = find(gateway.customers, customer_id)["active_card"]
+            elif payment_token:
+                card = gateway.card(token=payment_token)
+            else:
+                return ProcessorResult.failure("No customer id or payment method provided")
+
+            charge = {
+                "id": gateway.next_id("ch"),
+                "amount": Decimal(amount),
+                "amount_refunded": Decimal("0"),
+                "customer": customer_id,
+                "card": card,
+            }
+            charge["paid"] = not (card["declined"] or gateway.declines())
+            gateway.charges[charge["id"]] = charge
+            if not charge["paid"]:
+                return declined(charge["id"], raw=charge)
+            return ProcessorResult(True,
+                reference_id=charge["id"],
+                raw=charge,
+                **card_details(card)
+            )
+        return gateway.call("charge", apply, idempotency_key)
+
+    def refund(self, reference_id, amount=None):
+        def apply():
+            charge = gateway.charges.get(reference_id)
+            if charge is None:
+                return ProcessorResult.failure("Transaction not found")
+            remaining = charge["amount"] - charge["amount_refunded"]
+            if not charge["paid"] or remaining <= 0:
+                return ProcessorResult.failure("Transaction already refunded")
+            charge["amount_refunded"] += min(Decimal(amount or remaining), remaining)
+            return ProcessorResult(True, reference_id=reference_id, raw=charge)
+        return gateway.call("refund", apply)
+
+    def void(self, reference_id):
+        return self.refund(reference_id)
+
+    def update_card(self, payment_token, data):
+        expiration_date = data.get("expiration_date")
+
+        def apply():
+            card = gateway.card(
+                number=data.get("card_number"),
+                exp_month=expiration_date and expiration_date.month,
+                exp_year=expiration_date and expiration_date.year
+            )
+            gateway.tokens[payment_token] = card
+            return ProcessorResult(True, reference_id=payment_token,
+                **card_details(card))
+        return gateway.call("update_card", apply)
+
+    def create_subscription(self, customer_id, plan_id, price=None, start_date=None,
+                            idempotency_key=None, **kwargs):
+        def apply():
+            customer = gateway.customers.get(customer_id)
+            if customer is None:
+                return ProcessorResult.failure("No matching customer found")
+            if customer["active_card"]["declined"] or gateway.declines():
+                return declined()
+            subscription = {
+                "id": gateway.next_id("sub"),
+                "customer": customer_id,
+                "plan_id": plan_id,
+                "price": price,
+                "status": "active",
+                "next_billing_date": start_date or date.today() + BILLING_PERIOD,
+            }
+            gateway.subscriptions[subscription["id"]] = subscription
+            customer["subscriptions"].append(subscription["id"])
+            return ProcessorResult(True, reference_id=subscription["id"],
+                raw=subscription)
+        return gateway.call("create_subscription", apply, idempotency_key)
+
+    can_prerenew = False
+
+    def get_subscription(self, customer_id, status="active"):
+        def apply():
+            customer = find(gateway.customers, customer_id)
+            for subscription_id in reversed(customer["subscriptions"]):
+                subscription = gateway.subscriptions[subscription_id]
+                if subscription["status"] == status:
+                    return subscription
+            return None
+        return gateway.call("get_subscription", apply)
+
+    def extend_subscription(self, subscription_id, amount, discount_code, billing_cycles=1):
+        def apply():
+            subscription = gateway.subscriptions.get(subscription_id)
+            if subscription is None:
+                return ProcessorResult.failure("No such subscription")
+            subscription["price"] = amount
+            subscription["next_billing_date"] += BILLING_PERIOD * billing_cycles
+            return ProcessorResult(True, reference_id=subscription_id,
+                raw=subscription)
+        return gateway.call("extend_subscription", apply)
+
+    def cancel_subscription(self, subscription_id):
+        def apply():
+            subscription = gateway.subscriptions.get(subscription_id)
+            if subscription is None:
+                # like Stripe, a customer id cancels the customer's subscription
+                customer = gateway.customers.get(subscription_id, {})
+                for sub_id in customer.get("subscriptions", ()):
+                    if gateway.subscriptions[sub_id]["status"] == "active":
+                        subscription = gateway.subscriptions[sub_id]
+            if subscription is None:
+                return ProcessorResult.failure("No such subscription")
+            subscription["status"] = "canceled"
+            return ProcessorResult(True, reference_id=subscription_id,
+                raw=subscription)
+        return gateway.call("cancel_subscription", apply)
+
+    def webhook_challenge(self, request):
+        return request.GET.get("challenge", "")
+
+    def parse_webhook(self, request):
+        """
+        ``(event id, event type, payload)`` of a webhook request, or None if
+        its X-Fake-Signature header (see ``sign``) doesn't check out
+        """
+        payload = request.body
+        if not constant_time_compare(
+            sign(payload), request.META.get("HTTP_X_FAKE_SIGNATURE", "")
+        ):
+            return None
+        try:
+            event = json.loads(payload)
+            return event["id"], event["type"], payload
+        except (ValueError, KeyError):
+            return None
+
+    def webhook_details(self, event_type, payload):
+        action = WEBHOOK_ACTIONS.get(event_type)
+        if not action:
+            return None
+        obj = json.loads(payload)["data"]["object"]
+
+        if action in ("refunded", "disputed"):
+            amount = obj.get("amount_refunded", obj.get("amount"))
+            return {
+                "action": action,
+                "transaction_id": obj.get("charge") or obj["id"],
+                "customer_id": obj.get("customer"),
+                "amount": amount and Decimal(str(amount)),
+            }
+        details = {
+            "action": action,
+            "subscription_id": obj["subscription"],
+            "customer_id": obj.get("customer"),
+            "status": obj.get("status"),
+            "plan_id": obj.get("plan_id"),
+        }
+        if action == "subscription_charged":
+            details["transaction_id"] = obj.get("charge")
+            details["amount"] = obj.get("amount") and Decimal(str(obj["amount"]))
+            if "billing_reason" in obj:
+                details["initial"] = obj["billing_reason"] == "subscription_create"
+        return details
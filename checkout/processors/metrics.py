@@ -0,0 +1,181 @@
+import bisect
+import threading
+import time
+
+from checkout import signals
+from checkout.processors.base import LOCAL_METHODS, ProcessorUnavailable
+from checkout.settings import CHECKOUT
+
+
+SUCCESS = "success"
+FAILURE = "failure"  # the gateway said no, e.g. a declined card
+ERROR = "error"
+UNAVAILABLE = "unavailable"
+
+
+class Histogram(object):
+    """
+    Cumulative latency histogram with fixed upper bounds, in seconds
+    """
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        ``(upper bound, count)`` pairs, ending with ``("+Inf", count)``
+        """
+        total = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            total += count
+            yield bound, total
+
+
+class ProcessorMetrics(object):
+    """
+    Latency histograms of processor calls for this process, per processor,
+    method and outcome
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, processor, method, outcome, seconds):
+        key = (processor, method, outcome)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.buckets)
+            self.histograms[key].observe(seconds)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def snapshot(self):
+        with self.lock:
+            return sorted(
+                (key, list(h.cumulative()), h.sum, h.count)
+                for key, h in self.histograms.items()
+            )
+
+
+metrics = ProcessorMetrics(CHECKOUT["PROCESSOR_LATENCY_BUCKETS"])
+
+
+class InstrumentedProcessor(object):
+    """
+    Wraps a Processor (or another wrapper) and times every gateway call
+    into ``metrics``, sending a processor_call signal for other sinks
+    """
+
+    def __init__(self, processor, name=None):
+        self.processor = processor
+        self.name = name or getattr(processor, "name", None) or \
+            processor.__class__.__module__
+
+    def __getattr__(self, name):
+        attr = getattr(self.processor, name)
+        if name.startswith("_") or name in LOCAL_METHODS or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self.call(name, attr, *args, **kwargs)
+        return call
+
+    def call(self, method_name, method, *args, **kwargs):
+        outcome = ERROR
+        start = time.time()
+        try:
+            result = method(*args, **kwargs)
+            # action methods return a ProcessorResult, getters SDK objects
+            outcome = SUCCESS if getattr(result, "success", True) else FAILURE
+            return result
+        except ProcessorUnavailable:
+            outcome = UNAVAILABLE
+            raise
+        finally:
+            duration = time.time() - start
+            metrics.observe(self.name, method_name, outcome, duration)
+            signals.processor_call.send(
+                sender=self.__class__,
+                processor=self.name,
+                method=method_name,
+                outcome=outcome,
+                duration=duration
+            )
+
+
+def instrument(processor):
+    return InstrumentedProcessor(processor)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def labels(**values):
+    return ",".join(
+        '{0}="{1}"'.format(k, escape(v)) for k, v in sorted(values.items())
+    )
+
+
+def render_prometheus():
+    """
+    This process's processor, transport and cache metrics in the
+    Prometheus text format
+    """
+    # imported here so rendering doesn't depend on the import order
+    from checkout.models import discount_cache
+    from checkout.processors.resilience import breakers
+    from checkout.processors.transport import transport
+
+    lines = [
+        "# HELP checkout_processor_call_seconds Payment processor call latency",
+        "# TYPE checkout_processor_call_seconds histogram",
+    ]
+    for (processor, method, outcome), buckets, total, count in metrics.snapshot():
+        names = dict(processor=processor, method=method, outcome=outcome)
+        for bound, cumulative in buckets:
+            lines.append("checkout_processor_call_seconds_bucket{{{0}}} {1}".format(
+                labels(le=bound, **names), cumulative
+            ))
+        lines.append("checkout_processor_call_seconds_sum{{{0}}} {1}".format(
+            labels(**names), total
+        ))
+        lines.append("checkout_processor_call_seconds_count{{{0}}} {1}".format(
+            labels(**names), count
+        ))
+
+    lines += [
+        "# HELP checkout_circuit_breaker_open Whether calls to a processor fail fast",
+        "# TYPE checkout_circuit_breaker_open gauge",
+    ]
+    for name, breaker in sorted(breakers.items()):
+        lines.append("checkout_circuit_breaker_open{{{0}}} {1}".format(
+            labels(processor=name), int(breaker.state != breaker.CLOSED)
+        ))
+
+    for key, value in sorted(transport.stats().items()):
+        lines += [
+            "# TYPE checkout_http_{0}_total counter".format(key),
+            "checkout_http_{0}_total {1}".format(key, value),
+        ]
+
+    for key, value in sorted(discount_cache.stats().items()):
+        kind = "gauge" if key == "size" else "counter"
+        suffix = "" if key == "size" else "_total"
+        lines += [
+            "# TYPE checkout_discount_cache_{0}{1} {2}".format(key, suffix, kind),
+            "checkout_discount_cache_{0}{1} {2}".format(key, suffix, value),
+        ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,187 @@
+import collections
+import logging
+import random
+import threading
+import time
+
+import requests
+
+from checkout import signals
+from checkout.processors.base import LOCAL_METHODS, ProcessorUnavailable
+from checkout.processors.transport import transport
+from checkout.settings import CHECKOUT
+
+logger = logging.getLogger("checkout.processors.resilience")
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a gateway that keeps failing. Once ``threshold`` of the
+    last ``window`` calls failed, calls fail fast for ``reset_timeout``
+    seconds; then a single trial call decides whether to close again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, window=20, min_calls=10, threshold=0.5,
+                 reset_timeout=30):
+        self.name = name
+        self.min_calls = min_calls
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.outcomes = collections.deque(maxlen=window)
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        changed = False
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                changed = True
+            # half open: one trial call at a time
+            allowed = not self.trial
+            self.trial = True
+        if changed:
+            self.changed(self.HALF_OPEN)
+        return allowed
+
+    def record(self, ok):
+        with self.lock:
+            previous = self.state
+            if self.state == self.HALF_OPEN:
+                self.trial = False
+                self.outcomes.clear()
+                if ok:
+                    self.state = self.CLOSED
+                else:
+                    self.open()
+            elif self.state == self.CLOSED:
+                self.outcomes.append(ok)
+                failures = self.outcomes.count(False)
+                if (len(self.outcomes) >= self.min_calls and
+                    failures >= self.threshold * len(self.outcomes)):
+                    self.open()
+            state = self.state
+        if state != previous:
+            self.changed(state)
+
+    def open(self):
+        self.state = self.OPEN
+        self.opened_at = time.time()
+        self.outcomes.clear()
+
+    def changed(self, state):
+        logger.warning("Circuit breaker for {0} is {1}".format(self.name, state))
+        signals.circuit_breaker.send(sender=self, state=state)
+
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    with breakers_lock:
+        if name not in breakers:
+            breakers[name] = CircuitBreaker(name,
+                window=CHECKOUT["CIRCUIT_BREAKER_WINDOW"],
+                min_calls=CHECKOUT["CIRCUIT_BREAKER_MIN_CALLS"],
+                threshold=CHECKOUT["CIRCUIT_BREAKER_THRESHOLD"],
+                reset_timeout=CHECKOUT["CIRCUIT_BREAKER_RESET"]
+            )
+        return breakers[name]
+
+
+class ResilientProcessor(object):
+    """
+    Wraps a Processor so every gateway call has a deadline, calls that are
+    safe to repeat are retried with jittered backoff, and a gateway that
+    keeps failing is cut off by a circuit breaker shared by the process.
+
+    Errors in ``transient_errors`` (and ``requests`` errors) raise
+    ProcessorUnavailable once they can't be retried.
+    """
+
+    def __init__(self, processor, name=None, transient_errors=()):
+        self.processor = processor
+        self.name = name or processor.__class__.__module__
+        self.breaker = get_breaker(self.name)
+        self.transient_errors = (requests.exceptions.RequestException,) + \
+            tuple(transient_errors)
+
+    def __getattr__(self, name):
+        attr = getattr(self.processor, name)
+        if name.startswith("_") or name in LOCAL_METHODS or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self.call(name, attr, *args, **kwargs)
+        return call
+
+    def deadline(self, name):
+        deadlines = CHECKOUT["PROCESSOR_DEADLINES"]
+        return deadlines.get(name, deadlines.get("default"))
+
+    def call(self, method_name, method, *args, **kwargs):
+        if not self.breaker.allow():
+            raise ProcessorUnavailable(
+                "{0} is failing, not calling {1}".format(self.name, method_name)
+            )
+
+        safe = method_name in CHECKOUT["PROCESSOR_SAFE_METHODS"] or \
+            kwargs.get("idempotency_key")
+        seconds = self.deadline(method_name)
+        deadline = time.time() + seconds if seconds else float("inf")
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                with transport.deadline(deadline):
+                    result = method(*args, **kwargs)
+            except self.transient_errors as e:
+                self.breaker.record(False)
+                # full jitter, so retries from many workers spread out
+                delay = random.uniform(0,
+                    CHECKOUT["PROCESSOR_RETRY_BACKOFF"] * 2 ** (attempt - 1))
+                if (not safe or attempt > CHECKOUT["PROCESSOR_RETRIES"] or
+                    time.time() + delay >= deadline or
+                    not self.breaker.allow()):
+                    logger.warning("{0}.{1} failed after {2} attempts: {3}".format(
+                        self.name, method_name, attempt, e
+                    ))
+                    raise ProcessorUnavailable(
+                        "{0}.{1} failed: {2}".format(self.name, method_name, e)
+                    )
+                signals.processor_retry.send(
+                    sender=self.processor.__class__,
+                    method=method_name,
+                    attempt=attempt,
+                    error=e
+                )
+                time.sleep(delay)
+            except Exception:
+                # the gateway answered, so it is up
+                self.breaker.record(True)
+                raise
+            else:
+                self.breaker.record(True)
+                return result
+
+
+def resilient_processor(payment_module):
+    """
+    The payment module's Processor, wrapped in a ResilientProcessor that
+    knows the module's TRANSIENT_ERRORS
+    """
+    return ResilientProcessor(
+        payment_module.Processor(),
+        name=payment_module.__name__,
+        transient_errors=getattr(payment_module, "TRANSIENT_ERRORS", ())
+    )
@@ -1,20 +1,120 @@
+import hashlib
+import hmac
+import json
 import logging
+import time
+from datetime import datetime
+from decimal import Decimal
 
 from django.conf import settings
+from django.utils.crypto import constant_time_compare
 from django.utils.translation import ugettext_lazy as _
 
+import requests
 import stripe
 
+from checkout.processors.base import ProcessorResult
+from checkout.processors.transport import transport
+
 logger = logging.getLogger("checkout.processors.stripe_processor")
 
-# Configure Stripe
-stripe.api_key = settings.STRIPE_SECRET
+
+
+class PooledHTTPClient(stripe.http_client.HTTPClient):
+    """
+    Sends Stripe API requests over the shared keep-alive transport
+    """
+    name = "checkout"
+
+    def request(self, method, url, headers, post_data=None):
+        try:
+            response = transport.request(method, url,
+                headers=headers,
+                data=post_data,
+                verify=self._verify_ssl_certs
+            )
+        except requests.exceptions.RequestException as e:
+            raise stripe.error.APIConnectionError(
+                "Could not connect to Stripe ({0})".format(e)
+            )
+        return response.content, response.status_code, response.headers
+
+
+configured = False
+
+
+def configure():
+    """
+    Points the Stripe SDK at our account and the shared transport. Done by
+    the first Processor rather than on import.
+    """
+    global configured
+    if not configured:
+        stripe.api_key = settings.STRIPE_SECRET
+        stripe.default_http_client = PooledHTTPClient()
+        configured = True
+
+
 PRORATE = getattr(settings, "STRIPE_PRORATE", True)
+WEBHOOK_SECRET = getattr(settings, "STRIPE_WEBHOOK_SECRET", None)
+# errors worth retrying, see checkout.processors.resilience
+TRANSIENT_ERRORS = (stripe.error.APIConnectionError, stripe.error.APIError)
+# errors after which a payment can't have been taken, so the next attempt
+# may use a new idempotency key; after any other error it must not
+DEFINITE_ERRORS = (
+    stripe.error.CardError,
+    stripe.error.InvalidRequestError,
+    stripe.error.AuthenticationError,
+)
+# seconds a signed webhook stays valid, against replayed requests
+WEBHOOK_TOLERANCE = 300
+
+# event types checkout.webhooks acts on
+WEBHOOK_ACTIONS = {
+    "charge.refunded": "refunded",
+    "charge.dispute.created": "disputed",
+    "invoice.payment_succeeded": "subscription_charged",
+    "customer.subscription.updated": "subscription_updated",
+    "customer.subscription.deleted": "subscription_canceled",
+}
+
+
+def card_details(card):
+    card = card or {}
+    return {
+        "card_brand": card.get("type"),
+        "card_last4": card.get("last4"),
+        "card_exp_month": card.get("exp_month"),
+        "card_exp_year": card.get("exp_year"),
+    }
+
+
+def from_cents(amount):
+    if amount is None:
+        return None
+    return Decimal(amount) / 100
+
+
+def from_timestamp(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp)
+
+
+def customer_result(customer):
+    # the customer response already carries the active card, so there
+    # is no need to retrieve it again
+    return ProcessorResult(True,
+        reference_id=customer["id"],
+        raw=customer,
+        **card_details(customer.get("active_card"))
+    )
 
 
 class Processor:
 
     def __init__(self, **kwargs):
+        configure()
 
         if kwargs.get("user", None):
             self.user = kwargs.pop("user")
@@ -79,7 +179,7 @@ class Processor:
                 customer = stripe.Customer.retrieve(customer_id)
                 customer.card = token
                 customer.save()
-                return True, customer_id, None, customer
+                return customer_result(customer)
             except:
                 pass
         try:
@@ -88,10 +188,13 @@ class Processor:
                 email=data["email"],
                 card=token
             )
-        except:
-            return False, None, _("An error occurred while creating the customer record"), None
+        except Exception as e:
+            return ProcessorResult.failure(
+                _("An error occurred while creating the customer record"),
+                error_code=getattr(e, "code", None)
+            )
 
-        return True, result["id"], None, result
+        return customer_result(result)
 
     def get_customer(self, customer_id):
         return stripe.Customer.retrieve(customer_id)
@@ -100,9 +203,9 @@ class Processor:
         try:
             cu = stripe.Customer.retrieve(customer_id)
             result = cu.delete()
-            return result["deleted"]
-        except:
-            return False
+            return ProcessorResult(result["deleted"], reference_id=customer_id, raw=result)
+        except Exception as e:
+            return ProcessorResult.failure(str(e), error_code=getattr(e, "code", None))
 
     def get_customer_card(self, customer_id):
         try:
@@ -123,59 +226,80 @@ class Processor:
     def get_transaction(self, transaction_id):
         return stripe.Charge.retrieve(transaction_id)
 
-    def charge(self, amount, data=None, customer_id=None, payment_token=None):
+    def charge(self, amount, data=None, customer_id=None, payment_token=None,
+               idempotency_key=None):
 
         result = None
+        # sent as the Idempotency-Key header, so a retried request returns
+        # the original charge instead of charging again
+        options = {}
+        if idempotency_key:
+            options["idempotency_key"] = idempotency_key
 
         # convert our amount to CENTS as integer
         amount = int(amount * 100)
 
-        if customer_id:
-            result = stripe.Charge.create(
-                amount=amount,
-                currency="usd",
-                customer=customer_id
-            )
-
-        elif payment_token:
-            result = stripe.Charge.create(
-                amount=amount,
-                currency="usd",
-                card=payment_token
+        try:
+            if customer_id:
+                result = stripe.Charge.create(
+                    amount=amount,
+                    currency="usd",
+                    customer=customer_id,
+                    **options
+                )
+
+            elif payment_token:
+                result = stripe.Charge.create(
+                    amount=amount,
+                    currency="usd",
+                    card=payment_token,
+                    **options
+                )
+
+            elif data:
+                expire_month = data.get("expiration_date").strftime("%m")
+                expire_year = data.get("expiration_date").strftime("%Y")
+                card_data = {
+                    "name": "{0} {1}".format(data["first_name"], data["last_name"]),
+                    "number": data.get("card_number"),
+                    "exp_month": expire_month,
+                    "exp_year": expire_year,
+                    "cvc": data["ccv"],
+                    "address_line1": data["address1"],
+                    "address_line2": data.get("address2"),
+                    "address_zip": data["postal_code"],
+                    "address_state": data["region"],
+                    "address_country": data["country"],
+                }
+                result = stripe.Charge.create({
+                    "amount": amount or data.get("amount"),
+                    "currency": "usd",
+                    "card": card_data,
+                    "description": data["email"],
+                }, **options)
+        except (stripe.error.CardError, stripe.error.InvalidRequestError) as e:
+            # declines and rejected requests are answers, not errors
+            return ProcessorResult.failure(
+                getattr(e, "user_message", None) or str(e),
+                error_code=getattr(e, "code", None)
             )
 
-        elif data:
-            expire_month = data.get("expiration_date").strftime("%m")
-            expire_year = data.get("expiration_date").strftime("%Y")
-            card_data = {
-                "name": "{0} {1}".format(data["first_name"], data["last_name"]),
-                "number": data.get("card_number"),
-                "exp_month": expire_month,
-                "exp_year": expire_year,
-                "cvc": data["ccv"],
-                "address_line1": data["address1"],
-                "address_line2": data.get("address2"),
-                "address_zip": data["postal_code"],
-                "address_state": data["region"],
-                "address_country": data["country"],
-            }
-            result = stripe.Charge.create({
-                "amount": amount or data.get("amount"),
-                "currency": "usd",
-                "card": card_data,
-                "description": data["email"],
-            })
-
         if result:
-            return result["paid"], result
+            return ProcessorResult(result["paid"],
+                reference_id=result["id"],
+                error=result.get("failure_message"),
+                error_code=result.get("failure_code"),
+                raw=result,
+                **card_details(result.get("card"))
+            )
 
-        return False, "No customer id or data provided"
+        return ProcessorResult.failure("No customer id or data provided")
 
     def refund(self, reference_id, amount=None):
         try:
             ch = stripe.Charge.retrieve(reference_id)
         except:
-            False, "Transaction not found"
+            return ProcessorResult.failure("Transaction not found")
 
         try:
             if amount:
@@ -183,20 +307,26 @@ class Processor:
             else:
                 result = ch.refund()
         except:
-            "Transaction already refunded"
+            return ProcessorResult.failure("Transaction already refunded")
 
-        return result["refunded"], None
+        return ProcessorResult(result["refunded"], reference_id=reference_id, raw=result)
 
     def void(self, reference_id):
         return self.refund(reference_id)
 
-    def create_subscription(self, customer_id, plan_id, **kwargs):
+    def create_subscription(self, customer_id, plan_id, idempotency_key=None, **kwargs):
+        # moving a customer onto the plan they are already on is a no-op,
+        # so retries are safe without an idempotency key
         try:
             cu = stripe.Customer.retrieve(customer_id)
         except:
-            return False, "No matching customer found"
-        cu.update_subscription(plan=plan_id, prorate=PRORATE)
-        return True, cu
+            return ProcessorResult.failure("No matching customer found")
+        try:
+            result = cu.update_subscription(plan=plan_id, prorate=PRORATE)
+        except Exception as e:
+            return ProcessorResult.failure(str(e), error_code=getattr(e, "code", None))
+        # Stripe keeps a single subscription per customer
+        return ProcessorResult(True, reference_id=customer_id, raw=result)
 
     can_prerenew = False
 
@@ -204,6 +334,89 @@ class Processor:
         try:
             cu = stripe.Customer.retrieve(customer_id)
             result = cu.cancel_subscription()
-            return result["status"] == "canceled"
-        except:
-            return False
+            return ProcessorResult(result["status"] == "canceled",
+                reference_id=customer_id, raw=result)
+        except Exception as e:
+            return ProcessorResult.failure(str(e), error_code=getattr(e, "code", None))
+
+    def parse_webhook(self, request):
+        """
+        ``(event id, event type, payload)`` of a webhook request, or None if
+        its Stripe-Signature header doesn't check out
+        """
+        if not WEBHOOK_SECRET:
+            logger.warning("STRIPE_WEBHOOK_SECRET is not set, rejecting webhook")
+            return None
+
+        timestamp = None
+        signatures = []
+        for item in request.META.get("HTTP_STRIPE_SIGNATURE", "").split(","):
+            key, sep, value = item.strip().partition("=")
+            if key == "t":
+                timestamp = value
+            elif key == "v1":
+                signatures.append(value)
+        try:
+            if abs(time.time() - int(timestamp)) > WEBHOOK_TOLERANCE:
+                return None
+        except (TypeError, ValueError):
+            return None
+
+        payload = request.body
+        expected = hmac.new(
+            WEBHOOK_SECRET.encode("utf-8"),
+            timestamp.encode("utf-8") + b"." + payload,
+            hashlib.sha256
+        ).hexdigest()
+        if not any(constant_time_compare(expected, s) for s in signatures):
+            return None
+
+        try:
+            event = json.loads(payload)
+            return event["id"], event["type"], payload
+        except (ValueError, KeyError):
+            return None
+
+    def webhook_details(self, event_type, payload):
+        action = WEBHOOK_ACTIONS.get(event_type)
+        if not action:
+            return None
+        obj = json.loads(payload)["data"]["object"]
+
+        if action == "refunded":
+            return {
+                "action": action,
+                "transaction_id": obj["id"],
+                "customer_id": obj.get("customer"),
+                "amount": from_cents(obj.get("amount_refunded")),
+            }
+        if action == "disputed":
+            return {
+                "action": action,
+                "transaction_id": obj["charge"],
+                "amount": from_cents(obj.get("amount")),
+            }
+        # Stripe keeps a single subscription per customer, so the customer
+        # id is the subscription's reference (see create_subscription)
+        if action == "subscription_charged":
+            return {
+                "action": action,
+                "subscription_id": obj["customer"],
+                "customer_id": obj["customer"],
+                "transaction_id": obj.get("charge"),
+                "amount": from_cents(obj.get("total")),
+                # older API versions have no billing_reason
+                "initial": {
+                    "subscription_create": True,
+                    "subscription_cycle": False,
+                    "subscription_update": False,
+                }.get(obj.get("billing_reason")),
+                "charged": from_timestamp(obj.get("date") or obj.get("created")),
+            }
+        return {
+            "action": action,
+            "subscription_id": obj["customer"],
+            "customer_id": obj["customer"],
+            "status": obj.get("status"),
+            "plan_id": (obj.get("plan") or {}).get("id"),
+        }
@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from checkout.settings import CHECKOUT
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    pass
+
+
+class PooledTransport(object):
+    """
+    A per-process ``requests`` session with keep-alive connection pools,
+    shared by the payment gateway SDKs so checkouts reuse TLS connections
+    instead of opening a new one per call.
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=5, read_timeout=30):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pid = None
+        self._session = None
+        self.requests = 0
+
+    @property
+    def session(self):
+        # connections can't be shared with a forked child
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self._session = self.new_session()
+                    self.pid = os.getpid()
+                    self.requests = 0
+        return self._session
+
+    def new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=self.pool_size,
+            max_retries=0
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @contextmanager
+    def deadline(self, at):
+        """
+        Bound the requests made in this thread inside the block to finish by
+        ``at`` (a ``time.time()`` value)
+        """
+        previous = getattr(self.local, "deadline", None)
+        if previous is not None:
+            at = min(at, previous)
+        self.local.deadline = at
+        try:
+            yield
+        finally:
+            self.local.deadline = previous
+
+    def remaining(self):
+        """
+        Seconds left before this thread's deadline, or None without one
+        """
+        deadline = getattr(self.local, "deadline", None)
+        if deadline is None:
+            return None
+        return deadline - time.time()
+
+    def request(self, method, url, timeout=None, **kwargs):
+        timeout = timeout or self.timeout
+        if not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+        remaining = self.remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                raise DeadlineExceeded("Deadline passed before {0} {1}".format(method, url))
+            timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+
+        session = self.session
+        with self.lock:
+            self.requests += 1
+        return session.request(method, url, timeout=timeout, **kwargs)
+
+    def stats(self):
+        """
+        Counters for this process. ``reused`` is the number of requests
+        that went over an already open connection.
+        """
+        connections = 0
+        if self._session is not None and self.pid == os.getpid():
+            for adapter in set(self._session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        connections += pool.num_connections
+        return {
+            "requests": self.requests,
+            "connections": connections,
+            "reused": max(self.requests - connections, 0),
+        }
+
+
+transport = PooledTransport(
+    pool_size=CHECKOUT["HTTP_POOL_SIZE"],
+    connect_timeout=CHECKOUT["HTTP_CONNECT_TIMEOUT"],
+    read_timeout=CHECKOUT["HTTP_READ_TIMEOUT"]
+)
@@ -0,0 +1,60 @@
+from django.core.cache import cache
+
+from django.contrib.contenttypes.models import ContentType
+
+from checkout.settings import CHECKOUT
+
+
+def product_cache_key(content_type_id, object_id):
+    return "checkout:product:{0}:{1}".format(content_type_id, object_id)
+
+
+def resolve_products(items, timeout=None):
+    """
+    Attach the product of each line item in ``items`` (a queryset or
+    list) using one ``in_bulk`` query per product model, instead of one
+    query per item. Items whose product no longer exists get None.
+
+    Products are cached for ``timeout`` seconds (default
+    ``CHECKOUT["PRODUCT_CACHE_TIMEOUT"]``; 0 disables the cache).
+    Returns the items as a list.
+    """
+    if timeout is None:
+        timeout = CHECKOUT["PRODUCT_CACHE_TIMEOUT"]
+    items = list(items)
+
+    wanted = {}
+    for item in items:
+        if item.content_type_id and not hasattr(item, "_product_cache"):
+            wanted.setdefault(item.content_type_id, set()).add(item.object_id)
+
+    products = {}
+    if timeout:
+        keys = [
+            product_cache_key(content_type_id, object_id)
+            for content_type_id, object_ids in wanted.items()
+            for object_id in object_ids
+        ]
+        products.update(cache.get_many(keys))
+
+    fetched = {}
+    for content_type_id, object_ids in wanted.items():
+        missing = [
+            object_id for object_id in object_ids
+            if product_cache_key(content_type_id, object_id) not in products
+        ]
+        if not missing:
+            continue
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        for object_id, product in model._default_manager.in_bulk(missing).items():
+            fetched[product_cache_key(content_type_id, object_id)] = product
+    products.update(fetched)
+    if timeout and fetched:
+        cache.set_many(fetched, timeout)
+
+    for item in items:
+        if item.content_type_id and not hasattr(item, "_product_cache"):
+            item._product_cache = products.get(
+                product_cache_key(item.content_type_id, item.object_id)
+            )
+    return items
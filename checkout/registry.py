@@ -0,0 +1,81 @@
+"""
+The payment processor and forms named in CHECKOUT, loaded on first use.
+Importing checkout doesn't import (or configure) a gateway SDK, so
+commands and workers that never take a payment don't pay for it.
+"""
+import threading
+
+from django.utils.importlib import import_module
+
+from checkout.settings import CHECKOUT
+from checkout.utils import import_from_string
+
+
+loaded = {}
+lock = threading.Lock()
+
+# names settings may still use for things that have moved
+RENAMED = {
+    # SIGNUP_FORM's default, before the class was built on first use
+    "checkout.forms.PaymentSignupForm": "checkout.forms.payment_signup_form",
+}
+
+
+def load(key, factory):
+    if key not in loaded:
+        with lock:
+            if key not in loaded:
+                loaded[key] = factory()
+    return loaded[key]
+
+
+def payment_module():
+    return import_module(CHECKOUT["PAYMENT_PROCESSOR"])
+
+
+def processor():
+    """
+    The CHECKOUT["PAYMENT_PROCESSOR"] module's Processor, wrapped for
+    deadlines, retries and metrics
+    """
+    def create():
+        from checkout.processors.metrics import instrument
+        from checkout.processors.resilience import resilient_processor
+        return instrument(resilient_processor(payment_module()))
+    return load(("processor", CHECKOUT["PAYMENT_PROCESSOR"]), create)
+
+
+def form(setting):
+    """
+    The form class named by CHECKOUT[setting]. The setting may also name a
+    function that builds the class.
+    """
+    name = RENAMED.get(CHECKOUT[setting], CHECKOUT[setting])
+
+    def resolve():
+        form_class = import_from_string(name)
+        if not isinstance(form_class, type):
+            form_class = form_class()
+        return form_class
+    return load(("form", name), resolve)
+
+
+class LazyProcessor(object):
+    """
+    A class attribute that is ``processor()``
+    """
+
+    def __get__(self, instance, owner):
+        return processor()
+
+
+class LazyForm(object):
+    """
+    A class attribute that is ``form(setting)``
+    """
+
+    def __init__(self, setting):
+        self.setting = setting
+
+    def __get__(self, instance, owner):
+        return form(self.setting)
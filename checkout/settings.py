@@ -21,7 +21,7 @@ CHECKOUT = {
     "ANONYMOUS_CHECKOUT": False,
     "PRERENEWAL_DISCOUNT_CODE": None,
     "BASE_SIGNUP_FORM": "django.contrib.auth.forms.UserCreationForm",
-    "SIGNUP_FORM": "checkout.forms.PaymentSignupForm",
+    "SIGNUP_FORM": "checkout.forms.payment_signup_form",
     "REFERRAL_CHOICES": None,
     "TAX_RATE": 0.8,
     "CREDIT": 1,
@@ -35,6 +35,59 @@ CHECKOUT = {
     ),
     "PAYMENT_PROCESSOR": "checkout.processors.stripe_processor",
     "COOKIE_KEY_ORDER": "ORDER-ID",
+    "DISCOUNT_CACHE_SIZE": 1000,
+    "DISCOUNT_CACHE_TIMEOUT": 300,
+    "DISCOUNT_NEGATIVE_CACHE_TIMEOUT": 60,
+    "DISCOUNT_LOCAL_CACHE_TIMEOUT": 5,
+    "PRODUCT_CACHE_TIMEOUT": 0,
+    "PAYMENT_ATTEMPT_TIMEOUT": 120,
+    "HTTP_POOL_SIZE": 10,
+    "HTTP_CONNECT_TIMEOUT": 5,
+    "HTTP_READ_TIMEOUT": 30,
+    # seconds each processor method may take, retries included
+    "PROCESSOR_DEADLINES": {
+        "default": 20,
+        "create_customer": 30,
+        "charge": 45,
+        "create_subscription": 45,
+    },
+    "PROCESSOR_RETRIES": 2,
+    "PROCESSOR_RETRY_BACKOFF": 0.2,
+    # methods that are always safe to retry; calls made with an
+    # idempotency_key are too
+    "PROCESSOR_SAFE_METHODS": (
+        "get_customer", "get_customer_card", "get_payment_details",
+        "get_transaction", "get_subscription", "find_subscription_id",
+    ),
+    "CIRCUIT_BREAKER_WINDOW": 20,
+    "CIRCUIT_BREAKER_MIN_CALLS": 10,
+    "CIRCUIT_BREAKER_THRESHOLD": 0.5,
+    "CIRCUIT_BREAKER_RESET": 30,
+    "PROCESSOR_LATENCY_BUCKETS": (
+        0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+    ),
+    "WEBHOOK_BATCH_SIZE": 100,
+    "WEBHOOK_MAX_ATTEMPTS": 5,
+    # seconds before a failed event is retried, doubling with each failure
+    "WEBHOOK_RETRY_DELAY": 60,
+    # checkout.processors.fake_processor, an in-memory gateway for load
+    # tests and offline development
+    "FAKE_PROCESSOR": {
+        "SEED": None,
+        # seconds, as ("constant", s), ("uniform", low, high),
+        # ("exponential", mean) or ("lognormal", median, sigma)
+        "LATENCY": {
+            "default": ("lognormal", 0.2, 0.4),
+            "charge": ("lognormal", 0.6, 0.4),
+            "create_subscription": ("lognormal", 0.8, 0.4),
+        },
+        "DECLINE_RATE": 0,
+        # share of calls that hang for TIMEOUT seconds and fail
+        "TIMEOUT_RATE": 0,
+        # share of calls that go through but whose response is lost
+        "LOST_RESPONSE_RATE": 0,
+        "TIMEOUT": 30,
+    },
 }
 
 if hasattr(settings, "CHECKOUT"):
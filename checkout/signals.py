@@ -30,3 +30,19 @@ subscribe = django.dispatch.Signal(
 order_complete = django.dispatch.Signal(
     providing_args=["order", ]
 )
+
+webhook_event = django.dispatch.Signal(
+    providing_args=["event", "details"]
+)
+
+processor_retry = django.dispatch.Signal(
+    providing_args=["method", "attempt", "error"]
+)
+
+circuit_breaker = django.dispatch.Signal(
+    providing_args=["state"]
+)
+
+processor_call = django.dispatch.Signal(
+    providing_args=["processor", "method", "outcome", "duration"]
+)
@@ -0,0 +1,91 @@
+-- Upgrades a django-checkout 0.4.4 database to this release. syncdb only
+-- creates missing tables, so the columns and indexes added to existing
+-- ones have to be added by hand:
+--
+--     mysql <database> < upgrade-from-0.4.4.mysql.sql
+--     python manage.py repair_order_summaries
+--     python manage.py normalize_discount_codes
+--     python manage.py backfill_discount_redemptions
+--
+-- The commands fill in the new denormalized columns for existing rows.
+-- MySQL commits each ALTER TABLE on its own, so a failed run has to be
+-- finished by hand from the statement that failed.
+
+-- Order: a unique key, the denormalized summary and the discount hold.
+-- The (user_id, creation_date) index takes over the user_id foreign
+-- key's index, so it is created first.
+ALTER TABLE `checkout_order`
+    ADD COLUMN `item_count` integer UNSIGNED NOT NULL DEFAULT 0,
+    ADD COLUMN `has_subscription` bool NOT NULL DEFAULT 0,
+    ADD COLUMN `latest_transaction_id` integer,
+    ADD COLUMN `discount_reserved_date` datetime,
+    ADD UNIQUE (`key`),
+    ADD INDEX `checkout_order_280e96d6` (`latest_transaction_id`),
+    ADD INDEX `checkout_order_c8a7d82a` (`discount_reserved_date`),
+    ADD INDEX `checkout_order_dc526f6e` (`user_id`, `creation_date`),
+    ADD INDEX `checkout_order_0d412870` (`status`, `creation_date`);
+ALTER TABLE `checkout_order` DROP INDEX `checkout_order_6340c63c`;
+ALTER TABLE `checkout_order` ADD CONSTRAINT `latest_transaction_id_refs_id_d30b2cc9` FOREIGN KEY (`latest_transaction_id`) REFERENCES `checkout_ordertransaction` (`id`);
+
+-- LineItem
+ALTER TABLE `checkout_lineitem`
+    ADD INDEX `checkout_lineitem_37aaecce` (`order_id`, `content_type_id`, `object_id`);
+ALTER TABLE `checkout_lineitem` DROP INDEX `checkout_lineitem_68d25c7a`;
+
+-- OrderTransaction: the gateway's reference and payment attempts
+ALTER TABLE `checkout_ordertransaction`
+    ADD COLUMN `gateway_reference` varchar(50),
+    ADD COLUMN `attempts` integer UNSIGNED NOT NULL DEFAULT 0,
+    ADD COLUMN `attempt_date` datetime,
+    ADD COLUMN `idempotency_key` varchar(64) UNIQUE,
+    ADD INDEX `checkout_ordertransaction_bbc2c5a3` (`gateway_reference`),
+    ADD INDEX `checkout_ordertransaction_896eb859` (`order_id`, `payment_method`, `creation_date`),
+    ADD INDEX `checkout_ordertransaction_fca5dab8` (`order_id`, `status`, `creation_date`);
+ALTER TABLE `checkout_ordertransaction` DROP INDEX `checkout_ordertransaction_68d25c7a`;
+
+-- Discount: the normalized code lookup and reserved uses
+ALTER TABLE `checkout_discount`
+    ADD COLUMN `normalized_code` varchar(20) UNIQUE,
+    ADD COLUMN `reserved` integer NOT NULL DEFAULT 0;
+
+-- new tables
+CREATE TABLE `checkout_subscription` (
+    `id` integer AUTO_INCREMENT NOT NULL PRIMARY KEY,
+    `customer_id` varchar(50) NOT NULL,
+    `reference_id` varchar(50) NOT NULL UNIQUE,
+    `plan_id` varchar(100) NOT NULL,
+    `status` varchar(20) NOT NULL,
+    `price` numeric(18, 2),
+    `next_billing_date` date,
+    `creation_date` datetime NOT NULL,
+    `modified_date` datetime NOT NULL
+);
+CREATE INDEX `checkout_subscription_7c89a851` ON `checkout_subscription` (`customer_id`, `status`);
+
+CREATE TABLE `checkout_discountredemption` (
+    `id` integer AUTO_INCREMENT NOT NULL PRIMARY KEY,
+    `discount_id` integer NOT NULL,
+    `user_id` integer NOT NULL,
+    `count` integer UNSIGNED NOT NULL,
+    UNIQUE (`discount_id`, `user_id`)
+);
+CREATE INDEX `checkout_discountredemption_6340c63c` ON `checkout_discountredemption` (`user_id`);
+ALTER TABLE `checkout_discountredemption` ADD CONSTRAINT `discount_id_refs_id_a12db4f8` FOREIGN KEY (`discount_id`) REFERENCES `checkout_discount` (`id`);
+ALTER TABLE `checkout_discountredemption` ADD CONSTRAINT `user_id_refs_id_c4269d87` FOREIGN KEY (`user_id`) REFERENCES `auth_user` (`id`);
+
+-- only if checkout.webhooks is in INSTALLED_APPS
+CREATE TABLE `webhooks_webhookevent` (
+    `id` integer AUTO_INCREMENT NOT NULL PRIMARY KEY,
+    `processor` varchar(100) NOT NULL,
+    `event_id` varchar(100) NOT NULL,
+    `event_type` varchar(100) NOT NULL,
+    `payload` longtext NOT NULL,
+    `received_date` datetime NOT NULL,
+    `status` varchar(20) NOT NULL,
+    `attempts` integer UNSIGNED NOT NULL,
+    `processed_date` datetime,
+    `retry_date` datetime,
+    `error` longtext NOT NULL,
+    UNIQUE (`processor`, `event_id`)
+);
+CREATE INDEX `webhooks_webhookevent_74a37575` ON `webhooks_webhookevent` (`processor`, `status`);
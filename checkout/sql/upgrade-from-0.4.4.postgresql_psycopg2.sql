@@ -0,0 +1,100 @@
+-- Upgrades a django-checkout 0.4.4 database to this release. syncdb only
+-- creates missing tables, so the columns and indexes added to existing
+-- ones have to be added by hand:
+--
+--     psql <database> -f upgrade-from-0.4.4.postgresql_psycopg2.sql
+--     python manage.py repair_order_summaries
+--     python manage.py normalize_discount_codes
+--     python manage.py backfill_discount_redemptions
+--
+-- The commands fill in the new denormalized columns for existing rows.
+-- On a busy database, consider building the indexes separately with
+-- CREATE INDEX CONCURRENTLY, outside the transaction.
+
+BEGIN;
+
+-- Order: a unique key, the denormalized summary and the discount hold
+ALTER TABLE "checkout_order"
+    ADD COLUMN "item_count" integer CHECK ("item_count" >= 0) NOT NULL DEFAULT 0,
+    ADD COLUMN "has_subscription" boolean NOT NULL DEFAULT false,
+    ADD COLUMN "latest_transaction_id" integer,
+    ADD COLUMN "discount_reserved_date" timestamp with time zone,
+    ADD CONSTRAINT "checkout_order_key_key" UNIQUE ("key");
+ALTER TABLE "checkout_order"
+    ALTER COLUMN "item_count" DROP DEFAULT,
+    ALTER COLUMN "has_subscription" DROP DEFAULT;
+ALTER TABLE "checkout_order" ADD CONSTRAINT "latest_transaction_id_refs_id_d30b2cc9" FOREIGN KEY ("latest_transaction_id") REFERENCES "checkout_ordertransaction" ("id") DEFERRABLE INITIALLY DEFERRED;
+CREATE INDEX "checkout_order_key_like" ON "checkout_order" ("key" varchar_pattern_ops);
+CREATE INDEX "checkout_order_latest_transaction_id" ON "checkout_order" ("latest_transaction_id");
+CREATE INDEX "checkout_order_discount_reserved_date" ON "checkout_order" ("discount_reserved_date");
+CREATE INDEX "checkout_order_dc526f6e" ON "checkout_order" ("user_id", "creation_date");
+CREATE INDEX "checkout_order_0d412870" ON "checkout_order" ("status", "creation_date");
+DROP INDEX "checkout_order_user_id";
+
+-- LineItem
+CREATE INDEX "checkout_lineitem_37aaecce" ON "checkout_lineitem" ("order_id", "content_type_id", "object_id");
+DROP INDEX "checkout_lineitem_order_id";
+
+-- OrderTransaction: the gateway's reference and payment attempts
+ALTER TABLE "checkout_ordertransaction"
+    ADD COLUMN "gateway_reference" varchar(50),
+    ADD COLUMN "attempts" integer CHECK ("attempts" >= 0) NOT NULL DEFAULT 0,
+    ADD COLUMN "attempt_date" timestamp with time zone,
+    ADD COLUMN "idempotency_key" varchar(64) UNIQUE;
+ALTER TABLE "checkout_ordertransaction" ALTER COLUMN "attempts" DROP DEFAULT;
+CREATE INDEX "checkout_ordertransaction_gateway_reference" ON "checkout_ordertransaction" ("gateway_reference");
+CREATE INDEX "checkout_ordertransaction_gateway_reference_like" ON "checkout_ordertransaction" ("gateway_reference" varchar_pattern_ops);
+CREATE INDEX "checkout_ordertransaction_idempotency_key_like" ON "checkout_ordertransaction" ("idempotency_key" varchar_pattern_ops);
+CREATE INDEX "checkout_ordertransaction_896eb859" ON "checkout_ordertransaction" ("order_id", "payment_method", "creation_date");
+CREATE INDEX "checkout_ordertransaction_fca5dab8" ON "checkout_ordertransaction" ("order_id", "status", "creation_date");
+DROP INDEX "checkout_ordertransaction_order_id";
+
+-- Discount: the normalized code lookup and reserved uses
+ALTER TABLE "checkout_discount"
+    ADD COLUMN "normalized_code" varchar(20) UNIQUE,
+    ADD COLUMN "reserved" integer NOT NULL DEFAULT 0;
+ALTER TABLE "checkout_discount" ALTER COLUMN "reserved" DROP DEFAULT;
+CREATE INDEX "checkout_discount_normalized_code_like" ON "checkout_discount" ("normalized_code" varchar_pattern_ops);
+
+-- new tables
+CREATE TABLE "checkout_subscription" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "customer_id" varchar(50) NOT NULL,
+    "reference_id" varchar(50) NOT NULL UNIQUE,
+    "plan_id" varchar(100) NOT NULL,
+    "status" varchar(20) NOT NULL,
+    "price" numeric(18, 2),
+    "next_billing_date" date,
+    "creation_date" timestamp with time zone NOT NULL,
+    "modified_date" timestamp with time zone NOT NULL
+);
+CREATE INDEX "checkout_subscription_reference_id_like" ON "checkout_subscription" ("reference_id" varchar_pattern_ops);
+CREATE INDEX "checkout_subscription_7c89a851" ON "checkout_subscription" ("customer_id", "status");
+
+CREATE TABLE "checkout_discountredemption" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "discount_id" integer NOT NULL REFERENCES "checkout_discount" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "user_id" integer NOT NULL REFERENCES "auth_user" ("id") DEFERRABLE INITIALLY DEFERRED,
+    "count" integer CHECK ("count" >= 0) NOT NULL,
+    UNIQUE ("discount_id", "user_id")
+);
+CREATE INDEX "checkout_discountredemption_user_id" ON "checkout_discountredemption" ("user_id");
+
+-- only if checkout.webhooks is in INSTALLED_APPS
+CREATE TABLE "webhooks_webhookevent" (
+    "id" serial NOT NULL PRIMARY KEY,
+    "processor" varchar(100) NOT NULL,
+    "event_id" varchar(100) NOT NULL,
+    "event_type" varchar(100) NOT NULL,
+    "payload" text NOT NULL,
+    "received_date" timestamp with time zone NOT NULL,
+    "status" varchar(20) NOT NULL,
+    "attempts" integer CHECK ("attempts" >= 0) NOT NULL,
+    "processed_date" timestamp with time zone,
+    "retry_date" timestamp with time zone,
+    "error" text NOT NULL,
+    UNIQUE ("processor", "event_id")
+);
+CREATE INDEX "webhooks_webhookevent_74a37575" ON "webhooks_webhookevent" ("processor", "status");
+
+COMMIT;
@@ -0,0 +1,86 @@
+-- Upgrades a django-checkout 0.4.4 database to this release. syncdb only
+-- creates missing tables, so the columns and indexes added to existing
+-- ones have to be added by hand:
+--
+--     sqlite3 <database> < upgrade-from-0.4.4.sqlite3.sql
+--     python manage.py repair_order_summaries
+--     python manage.py normalize_discount_codes
+--     python manage.py backfill_discount_redemptions
+--
+-- The commands fill in the new denormalized columns for existing rows.
+
+BEGIN;
+
+-- Order: a unique key, the denormalized summary and the discount hold
+ALTER TABLE "checkout_order" ADD COLUMN "item_count" integer unsigned NOT NULL DEFAULT 0;
+ALTER TABLE "checkout_order" ADD COLUMN "has_subscription" bool NOT NULL DEFAULT 0;
+ALTER TABLE "checkout_order" ADD COLUMN "latest_transaction_id" integer REFERENCES "checkout_ordertransaction" ("id");
+ALTER TABLE "checkout_order" ADD COLUMN "discount_reserved_date" datetime;
+CREATE UNIQUE INDEX "checkout_order_key_uniq" ON "checkout_order" ("key");
+CREATE INDEX "checkout_order_280e96d6" ON "checkout_order" ("latest_transaction_id");
+CREATE INDEX "checkout_order_c8a7d82a" ON "checkout_order" ("discount_reserved_date");
+CREATE INDEX "checkout_order_dc526f6e" ON "checkout_order" ("user_id", "creation_date");
+CREATE INDEX "checkout_order_0d412870" ON "checkout_order" ("status", "creation_date");
+DROP INDEX "checkout_order_6340c63c";
+
+-- LineItem
+CREATE INDEX "checkout_lineitem_37aaecce" ON "checkout_lineitem" ("order_id", "content_type_id", "object_id");
+DROP INDEX "checkout_lineitem_68d25c7a";
+
+-- OrderTransaction: the gateway's reference and payment attempts
+ALTER TABLE "checkout_ordertransaction" ADD COLUMN "gateway_reference" varchar(50);
+ALTER TABLE "checkout_ordertransaction" ADD COLUMN "attempts" integer unsigned NOT NULL DEFAULT 0;
+ALTER TABLE "checkout_ordertransaction" ADD COLUMN "attempt_date" datetime;
+ALTER TABLE "checkout_ordertransaction" ADD COLUMN "idempotency_key" varchar(64);
+CREATE UNIQUE INDEX "checkout_ordertransaction_idempotency_key_uniq" ON "checkout_ordertransaction" ("idempotency_key");
+CREATE INDEX "checkout_ordertransaction_bbc2c5a3" ON "checkout_ordertransaction" ("gateway_reference");
+CREATE INDEX "checkout_ordertransaction_896eb859" ON "checkout_ordertransaction" ("order_id", "payment_method", "creation_date");
+CREATE INDEX "checkout_ordertransaction_fca5dab8" ON "checkout_ordertransaction" ("order_id", "status", "creation_date");
+DROP INDEX "checkout_ordertransaction_68d25c7a";
+
+-- Discount: the normalized code lookup and reserved uses
+ALTER TABLE "checkout_discount" ADD COLUMN "normalized_code" varchar(20);
+ALTER TABLE "checkout_discount" ADD COLUMN "reserved" integer NOT NULL DEFAULT 0;
+CREATE UNIQUE INDEX "checkout_discount_normalized_code_uniq" ON "checkout_discount" ("normalized_code");
+
+-- new tables
+CREATE TABLE "checkout_subscription" (
+    "id" integer NOT NULL PRIMARY KEY,
+    "customer_id" varchar(50) NOT NULL,
+    "reference_id" varchar(50) NOT NULL UNIQUE,
+    "plan_id" varchar(100) NOT NULL,
+    "status" varchar(20) NOT NULL,
+    "price" decimal,
+    "next_billing_date" date,
+    "creation_date" datetime NOT NULL,
+    "modified_date" datetime NOT NULL
+);
+CREATE INDEX "checkout_subscription_7c89a851" ON "checkout_subscription" ("customer_id", "status");
+
+CREATE TABLE "checkout_discountredemption" (
+    "id" integer NOT NULL PRIMARY KEY,
+    "discount_id" integer NOT NULL REFERENCES "checkout_discount" ("id"),
+    "user_id" integer NOT NULL REFERENCES "auth_user" ("id"),
+    "count" integer unsigned NOT NULL,
+    UNIQUE ("discount_id", "user_id")
+);
+CREATE INDEX "checkout_discountredemption_6340c63c" ON "checkout_discountredemption" ("user_id");
+
+-- only if checkout.webhooks is in INSTALLED_APPS
+CREATE TABLE "webhooks_webhookevent" (
+    "id" integer NOT NULL PRIMARY KEY,
+    "processor" varchar(100) NOT NULL,
+    "event_id" varchar(100) NOT NULL,
+    "event_type" varchar(100) NOT NULL,
+    "payload" text NOT NULL,
+    "received_date" datetime NOT NULL,
+    "status" varchar(20) NOT NULL,
+    "attempts" integer unsigned NOT NULL,
+    "processed_date" datetime,
+    "retry_date" datetime,
+    "error" text NOT NULL,
+    UNIQUE ("processor", "event_id")
+);
+CREATE INDEX "webhooks_webhookevent_74a37575" ON "webhooks_webhookevent" ("processor", "status");
+
+COMMIT;
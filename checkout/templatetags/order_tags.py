@@ -0,0 +1,16 @@
+from django import template
+
+from checkout.products import resolve_products
+
+
+register = template.Library()
+
+
+@register.assignment_tag
+def order_items(order):
+    """
+    The order's line items with their products resolved in bulk::
+
+        {% order_items order as items %}
+    """
+    return resolve_products(order.items.all())
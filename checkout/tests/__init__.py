@@ -0,0 +1,2 @@
+from checkout.tests.benchmarks import FlowBudgetTests
+from checkout.tests.query_plans import QueryPlanTests
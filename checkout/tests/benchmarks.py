@@ -0,0 +1,23 @@
+from django.test import TestCase
+
+from checkout import benchmark
+
+
+class FlowBudgetTests(TestCase):
+    """
+    The checkout flows against benchmark_budgets.json. After an intended
+    change, refresh the budgets with ``checkout_benchmark --update-budgets``.
+    """
+
+    def test_flows_within_budget(self):
+        budgets = benchmark.load_budgets()
+        over = {}
+        with benchmark.benchmark_environment():
+            for name, setup, run in benchmark.flows():
+                if setup is None or name not in budgets:
+                    continue
+                result = benchmark.measure(setup, run)
+                failures = benchmark.over_budget(result, budgets[name])
+                if failures:
+                    over[name] = failures
+        self.assertEqual(over, {})
@@ -0,0 +1,22 @@
+from django.db import connection
+from django.test import TestCase
+from django.utils import unittest
+
+from checkout import benchmark
+
+
+@unittest.skipUnless(connection.vendor == "sqlite",
+    "the plans are read with SQLite's EXPLAIN QUERY PLAN")
+class QueryPlanTests(TestCase):
+    """
+    The hot lookups are answered from an index, without scanning a table
+    or sorting in a temporary b-tree
+    """
+
+    def test_hot_queries_use_an_index(self):
+        unindexed = {}
+        for name, queryset, forbidden in benchmark.hot_queries():
+            steps = benchmark.unindexed(benchmark.explain(queryset), forbidden)
+            if steps:
+                unindexed[name] = steps
+        self.assertEqual(unindexed, {})
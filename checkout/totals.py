@@ -0,0 +1,91 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import connection
+
+
+CENT = Decimal("0.01")
+ZERO = Decimal("0.00")
+
+
+def to_decimal(value):
+    """
+    Coerce a monetary value to a Decimal rounded to cents. Floats go
+    through ``str`` so that 0.1 becomes Decimal("0.10") rather than its
+    binary approximation.
+    """
+    if value is None or value == "":
+        return ZERO
+    if isinstance(value, float):
+        value = str(value)
+    return Decimal(value).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+class OrderTotals(object):
+    """
+    Running line item sums for an order.
+
+    ``subtotal`` is the sum of quantity * item price and ``line_total``
+    the sum of the line totals (which include per-item tax). Lines are
+    added and removed incrementally; ``apply`` folds in the order level
+    discount, tax and shipping.
+    """
+
+    def __init__(self, subtotal=ZERO, line_total=ZERO):
+        self.subtotal = to_decimal(subtotal)
+        self.line_total = to_decimal(line_total)
+
+    @classmethod
+    def from_lines(cls, lines):
+        totals = cls()
+        for item in lines:
+            totals.add(item)
+        return totals
+
+    @classmethod
+    def from_database(cls, order):
+        """
+        Recompute the sums with a single aggregate query
+        """
+        if not order.pk:
+            return cls()
+        from checkout.models import LineItem
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT SUM({0} * {1}), SUM({2}) FROM {3} WHERE {4} = %s".format(
+                qn("quantity"),
+                qn("item_price"),
+                qn("total"),
+                qn(LineItem._meta.db_table),
+                qn("order_id")
+            ),
+            [order.pk]
+        )
+        # some backends (e.g. SQLite) return floats for SUM(), which
+        # to_decimal rounds back to cents
+        return cls(*cursor.fetchone())
+
+    def add(self, item):
+        self.subtotal += (item.quantity or 0) * to_decimal(item.item_price)
+        self.line_total += to_decimal(item.total)
+
+    def remove(self, item):
+        self.subtotal -= (item.quantity or 0) * to_decimal(item.item_price)
+        self.line_total -= to_decimal(item.total)
+
+    def apply(self, order):
+        """
+        Set ``order.subtotal`` and ``order.total`` from the running sums
+        and the order's discount, tax and shipping
+        """
+        discount = order.discount
+        total = self.line_total
+        if order.discount_amount:
+            total = max(self.subtotal - to_decimal(order.discount_amount), ZERO)
+        if order.tax and not (discount and discount.no_tax):
+            total += to_decimal(order.tax)
+        if order.shipping and not (discount and discount.free_shipping):
+            total += to_decimal(order.shipping)
+        order.subtotal = self.subtotal
+        order.total = total
+        return total
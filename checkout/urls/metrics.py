@@ -0,0 +1,6 @@
+from django.conf.urls.defaults import patterns
+
+
+urlpatterns = patterns("checkout.views",
+    (r"^$", "processor_metrics", {}, "checkout_processor_metrics"),
+)
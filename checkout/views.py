@@ -1,11 +1,13 @@
 import json
+from datetime import datetime
 from decimal import Decimal
 
+from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.db.models import Q
+from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import get_object_or_404, redirect, render_to_response
 from django.template import RequestContext
-from django.utils.importlib import import_module
 from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.http import require_POST
 from django.views.generic import TemplateView
@@ -15,17 +17,19 @@ from django.contrib import messages, auth
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 
+import requests
+
 from checkout.models import Discount, Order as OrderModel, OrderTransaction
 from checkout.order import Order
+from checkout.processors.base import ProcessorResult, ProcessorUnavailable
+from checkout.processors.metrics import render_prometheus
+from checkout.products import resolve_products
 from checkout.forms import CustomItemForm, SubscriptionForm
 from checkout.settings import CHECKOUT
-from checkout import signals
-from checkout.utils import import_from_string
+from checkout.totals import to_decimal
+from checkout import registry, signals
 
 
-payment_module = import_module(CHECKOUT["PAYMENT_PROCESSOR"])
-PaymentForm = import_from_string(CHECKOUT["PAYMENT_FORM"])
-SignupForm = import_from_string(CHECKOUT["SIGNUP_FORM"])
 ORDER_ID = CHECKOUT["COOKIE_KEY_ORDER"]
 
 
@@ -38,21 +42,26 @@ class CheckoutView(FormView):
     template_name = "checkout/form.html"
     template_name_ajax = "checkout/form.html"
     empty_redirect = "home"
-    form_class = PaymentForm
-    form_class_signup = SignupForm
-    processor = payment_module.Processor()
+    form_class = registry.LazyForm("PAYMENT_FORM")
+    form_class_signup = registry.LazyForm("SIGNUP_FORM")
+    processor = registry.LazyProcessor()
     method = "direct"
     success_url = "checkout_confirm"
     messages = {
         "customer_info_error": {
             "level": messages.ERROR,
             "text": _("The payment information could not be validated")
+        },
+        "processor_unavailable": {
+            "level": messages.ERROR,
+            "text": _("We can't process payments right now, please try again in a few minutes")
         }
     }
 
     def get(self, *args, **kwargs):
-        self.order_obj = Order(self.request)
-        if not self.order_obj.order.items.count():
+        if not getattr(self, "order_obj", None):
+            self.order_obj = Order(self.request)
+        if not self.order_obj.item_count:
             return redirect(self.empty_redirect)
         if (not self.request.user.is_authenticated() and
             not CHECKOUT["ANONYMOUS_CHECKOUT"]):
@@ -60,29 +69,33 @@ class CheckoutView(FormView):
         return super(CheckoutView, self).get(*args, **kwargs)
 
     def post(self, *args, **kwargs):
-        self.order_obj = Order(self.request)
-        if (not self.request.user.is_authenticated() and
-            not CHECKOUT["ANONYMOUS_CHECKOUT"]):
-            self.form_class = self.form_class_signup
-        incoming = self.retrieve_item()
-
-        if self.request.POST.get("discount_code"):
-            self.order_obj.apply_discount(self.request.POST.get("discount_code"))
-            if self.order_obj.total == 0:
-                self.order_obj.update_status(OrderModel.PENDING_PAYMENT)
-                # goal: remove payment-related requirements if
-                # no payment is necessary
-                for field in self.form_class.base_fields.keys():
-                    if field in PaymentForm.base_fields.keys():
-                        self.form_class.base_fields[field].required = False
-
-        return self.post_handler(incoming, *args, **kwargs)
+        self.order_obj = Order(self.request, deferred=True)
+        try:
+            if (not self.request.user.is_authenticated() and
+                not CHECKOUT["ANONYMOUS_CHECKOUT"]):
+                self.form_class = self.form_class_signup
+            incoming = self.retrieve_item()
+
+            if self.request.POST.get("discount_code"):
+                self.order_obj.apply_discount(self.request.POST.get("discount_code"))
+                if self.order_obj.total == 0:
+                    self.order_obj.update_status(OrderModel.PENDING_PAYMENT)
+                    # goal: remove payment-related requirements if
+                    # no payment is necessary
+                    payment_fields = registry.form("PAYMENT_FORM").base_fields
+                    for field in self.form_class.base_fields.keys():
+                        if field in payment_fields.keys():
+                            self.form_class.base_fields[field].required = False
+
+            return self.post_handler(incoming, *args, **kwargs)
+        finally:
+            self.order_obj.flush()
 
     def post_handler(self, incoming, *args, **kwargs):
         if incoming:
             form = self.get_form_class()(initial=self.get_initial())
             return self.render_to_response(self.get_context_data(form=form))
-        elif not self.order_obj.order.items.count():
+        elif not self.order_obj.item_count:
             return redirect(self.empty_redirect)
 
         return super(CheckoutView, self).post(*args, **kwargs)
@@ -109,8 +122,8 @@ class CheckoutView(FormView):
                 "billing_last_name": self.request.user.last_name
             })
         initial["amount"] = self.order_obj.total
-        if self.order_obj.get_transactions().count():
-            billing_data = self.order_obj.get_transactions().latest()
+        billing_data = self.order_obj.order.latest_transaction
+        if billing_data:
             for field_name in self.form_class().fields:
                 if hasattr(billing_data, field_name):
                     initial[field_name] = getattr(billing_data, field_name)
@@ -134,7 +147,7 @@ class CheckoutView(FormView):
             self.order_obj.add_referral(referral)
 
         self.order_obj.order.email = form.cleaned_data["email"]
-        self.order_obj.order.save()
+        self.order_obj.save("email")
 
         if (not self.request.user.is_authenticated() and
             not CHECKOUT["ANONYMOUS_CHECKOUT"]):
@@ -145,7 +158,7 @@ class CheckoutView(FormView):
             )
             auth.login(self.request, user)
             self.order_obj.order.user = user
-            self.order_obj.order.save()
+            self.order_obj.save("user")
             self.after_signup(user, form)
 
         form_data = form.cleaned_data
@@ -155,10 +168,20 @@ class CheckoutView(FormView):
 
         # if payment is needed
         if self.order_obj.order.total > 0:
-            success = self.save_customer_info(form_data)
+            try:
+                success = self.save_customer_info(form_data)
+            except ProcessorUnavailable:
+                messages.add_message(
+                    self.request,
+                    self.messages["processor_unavailable"]["level"],
+                    self.messages["processor_unavailable"]["text"]
+                )
+                return self.form_invalid(form)
         else:  # no payment needed, e.g. full discount
             success = True
         if success:
+            # receivers may read the order back from the database
+            self.order_obj.flush()
             signals.form_complete.send(
                 sender=None,
                 order=self.order_obj.order,
@@ -207,7 +230,7 @@ class CheckoutView(FormView):
         return user
 
     def after_signup(self, user, form):
-        signals.user_signed_up.send(sender=SignupForm, user=user, form=form)
+        signals.user_signed_up.send(sender=self.form_class_signup, user=user, form=form)
 
     def save_customer_info(self, payment_data):
         if self.request.user.is_authenticated():
@@ -217,30 +240,35 @@ class CheckoutView(FormView):
                 "last_name": self.request.user.last_name,
             })
 
-        success, reference_id, error, results = self.processor.create_customer(
+        result = self.processor.create_customer(
             payment_data,
             customer_id=self.order_obj.order.customer_id
         )
+        success = result.success
+        reference_id = result.reference_id
 
         signals.post_create_customer.send(
             sender=None,
             user=self.request.user,
             success=success,
             reference_id=reference_id,
-            error=error,
-            results=results
+            error=result.error,
+            results=result.raw
         )
 
         if success:
             self.order_obj.order.customer_id = reference_id
-            self.order_obj.order.save()
-            card_details = self.processor.get_customer_card(reference_id)
+            self.order_obj.save("customer_id")
+            last_four = result.card_last4
+            if last_four is None:
+                card_details = self.processor.get_customer_card(reference_id)
+                last_four = self.processor.get_card_last4(card_details)
 
             OrderTransaction.objects.get_or_create(
                 order=self.order_obj.order,
                 amount=self.order_obj.order.total,
                 payment_method=OrderTransaction.CREDIT,
-                last_four=self.processor.get_card_last4(card_details),
+                last_four=last_four,
                 reference_number=reference_id,
                 billing_first_name=payment_data.get("billing_first_name") or\
                     payment_data.get("first_name") or\
@@ -283,7 +311,17 @@ class SubscribeView(CheckoutView):
                 plan_opts = CHECKOUT["PLAN_OPTIONS_GENERATOR"](
                     Decimal(self.request.POST.get("custom_amount"))
                 )
-                plan = self.processor.create_plan(**plan_opts)
+                try:
+                    plan = self.processor.create_plan(**plan_opts)
+                except ProcessorUnavailable:
+                    messages.add_message(
+                        self.request,
+                        self.messages["processor_unavailable"]["level"],
+                        self.messages["processor_unavailable"]["text"]
+                    )
+                    # the post was for a plan, not payment: show the form
+                    # again rather than validating it
+                    return True
             if plan:
                 self.order_obj.clear()
                 self.order_obj.add(
@@ -304,31 +342,34 @@ class CartCheckoutView(CheckoutView):
         from cart.cart import CART_ID
         from cart.models import Cart as CartModel
 
-        self.order_obj = Order(self.request)
+        self.order_obj = Order(self.request, deferred=True)
         # clear pre-existing items
         self.order_obj.clear()
         if CART_ID in self.request.session and CartModel.objects.filter(
             pk=self.request.session[CART_ID]
         ).count():
             cart = CartModel.objects.get(pk=self.request.session[CART_ID])
+            lines = []
             for item in cart.item_set.all():
                 try:
-                    self.order_obj.add(
-                        item.unit_price,
-                        product=item.product,
-                        attributes=item.attributes,
-                        quantity=item.quantity
-                    )
+                    lines.append({
+                        "item_price": item.unit_price,
+                        "product": item.product,
+                        "attributes": item.attributes,
+                        "quantity": item.quantity
+                    })
                 except:
-                    self.order_obj.add(
-                        item["amount"],
-                        attributes=item.get("attributes", ""),
-                        description=item["description"],
-                        quantity=item.get("quantity", 1)
-                    )
+                    lines.append({
+                        "item_price": item["amount"],
+                        "attributes": item.get("attributes", ""),
+                        "description": item["description"],
+                        "quantity": item.get("quantity", 1)
+                    })
+            self.order_obj.add_many(lines)
 
             self.order_obj.update_totals()
-        if not self.order_obj.order.items.count():
+        self.order_obj.flush()
+        if not self.order_obj.item_count:
             return redirect(self.empty_redirect)
         return super(CartCheckoutView, self).get(*args, **kwargs)
 
@@ -341,7 +382,7 @@ class ConfirmView(TemplateView):
 
     template_name = "checkout/confirm.html"
     template_name_ajax = "checkout/confirm.html"
-    processor = payment_module.Processor()
+    processor = registry.LazyProcessor()
     success_url = "checkout_confirm"  # redirects to order page
     messages = {
         "invalid_order": {
@@ -351,6 +392,18 @@ class ConfirmView(TemplateView):
         "processing_failed": {
             "level": messages.WARNING,
             "text": _("We were unable to process your card for the following reason: {0}")
+        },
+        "discount_unavailable": {
+            "level": messages.WARNING,
+            "text": _("The discount code on this order is no longer available")
+        },
+        "payment_in_progress": {
+            "level": messages.INFO,
+            "text": _("Your payment is already being processed")
+        },
+        "processor_unavailable": {
+            "level": messages.ERROR,
+            "text": _("We can't process payments right now, please try again in a few minutes")
         }
     }
 
@@ -358,38 +411,81 @@ class ConfirmView(TemplateView):
         self.order_obj = Order(self.request)
         if not self.order_obj.can_complete():
             return self.invalid_order()
-        try:
-            self.transaction = self.order_obj.get_transactions().latest()
-        except:
-            # this may not be acceptable
-            self.transaction = None
+        # this may be None, which may not be acceptable
+        self.transaction = self.order_obj.order.latest_transaction
 
         return super(ConfirmView, self).get(*args, **kwargs)
 
     def post(self, *args, **kwargs):
-        self.order_obj = Order(self.request)
+        self.order_obj = Order(self.request, deferred=True)
         try:
-            self.transaction = self.order_obj.get_transactions().latest()
-        except:
-            # this may not be acceptable
-            self.transaction = None
-        if not self.order_obj.can_complete():
+            return self.post_handler(*args, **kwargs)
+        finally:
+            self.order_obj.flush()
+
+    def post_handler(self, *args, **kwargs):
+        # this may be None, which may not be acceptable
+        self.transaction = self.order_obj.order.latest_transaction
+        if self.transaction is None or not self.order_obj.can_complete():
             return self.invalid_order()
 
-        if self.order_obj.total == 0:
-            success = True
-        elif self.order_obj.order.is_subscription:
-            item = self.order_obj.order.items.all()[0]
-            success, data = self.processor.create_subscription(
-                customer_id=self.transaction.reference_number,
-                plan_id=item.subscription_plan,
-                price=self.transaction.amount
+        if not self.order_obj.reserve_discount():
+            messages.add_message(
+                self.request,
+                self.messages["discount_unavailable"]["level"],
+                self.messages["discount_unavailable"]["text"]
             )
-        else:
-            success, data = self.processor.charge(
-                self.order_obj.total,
-                customer_id=self.transaction.reference_number
+            return self.render_to_response(self.get_context_data())
+
+        try:
+            return self.take_payment()
+        finally:
+            # on every exit but success, including errors raised by signal
+            # receivers; a completed order has already committed the use
+            self.order_obj.release_discount()
+
+    def take_payment(self):
+        # a double click or retried request must not charge twice
+        idempotency_key = self.transaction.begin_attempt(self.order_obj.order.key)
+        if idempotency_key is None:
+            return self.attempt_in_progress()
+
+        try:
+            if self.order_obj.total == 0:
+                result = ProcessorResult(True)
+            elif self.order_obj.is_subscription:
+                item = self.order_obj.lines[0]
+                result = self.processor.create_subscription(
+                    customer_id=self.transaction.reference_number,
+                    plan_id=item.subscription_plan,
+                    price=self.transaction.amount,
+                    idempotency_key=idempotency_key
+                )
+            else:
+                result = self.processor.charge(
+                    self.order_obj.total,
+                    customer_id=self.transaction.reference_number,
+                    idempotency_key=idempotency_key
+                )
+        except self.definite_errors() as e:
+            # the gateway refused the request, so nothing was charged and
+            # retrying with the same key would only replay this error
+            self.transaction.fail_attempt(str(e))
+            raise
+        except Exception as e:
+            # the charge may have gone through, so retrying uses the same
+            # key and the gateway can't charge twice
+            self.transaction.interrupt_attempt()
+            if not isinstance(e, self.unavailable_errors()):
+                raise
+            messages.add_message(
+                self.request,
+                self.messages["processor_unavailable"]["level"],
+                self.messages["processor_unavailable"]["text"]
             )
+            return self.render_to_response(self.get_context_data())
+        success = result.success
+        data = result.raw if success else result.error
 
         if not success:
             self.transaction.status = self.transaction.FAILED
@@ -407,8 +503,9 @@ class ConfirmView(TemplateView):
             )
         else:
             self.transaction.status = self.transaction.COMPLETE
+            self.transaction.gateway_reference = result.reference_id
             self.transaction.save()
-            if self.order_obj.order.is_subscription:
+            if self.order_obj.is_subscription:
                 signals.subscribe.send(
                     sender=ConfirmView,
                     order=self.order_obj.order,
@@ -424,6 +521,7 @@ class ConfirmView(TemplateView):
                 )
 
             self.order_obj.update_status(OrderModel.COMPLETE)
+            self.order_obj.flush()
             signals.order_complete.send(
                 sender=ConfirmView,
                 order=self.order_obj.order
@@ -437,6 +535,38 @@ class ConfirmView(TemplateView):
 
         return self.render_to_response(self.get_context_data())
 
+    def definite_errors(self):
+        """
+        Errors after which no payment can have been taken. Any other error
+        may have come after a charge went through.
+        """
+        return tuple(getattr(registry.payment_module(), "DEFINITE_ERRORS", ()))
+
+    def unavailable_errors(self):
+        """
+        Errors that mean the gateway can't be reached right now, shown to
+        the customer as such rather than as a server error
+        """
+        return (ProcessorUnavailable, requests.exceptions.RequestException) + \
+            tuple(getattr(registry.payment_module(), "TRANSIENT_ERRORS", ()))
+
+    def attempt_in_progress(self):
+        """
+        Another request is paying for this order: send the customer on to
+        the order if it has completed
+        """
+        self.transaction = OrderTransaction.objects.get(pk=self.transaction.pk)
+        if self.transaction.status == OrderTransaction.COMPLETE:
+            if ORDER_ID in self.request.session:
+                del self.request.session[ORDER_ID]
+            return redirect(self.get_success_url(self.order_obj.order))
+        messages.add_message(
+            self.request,
+            self.messages["payment_in_progress"]["level"],
+            self.messages["payment_in_progress"]["text"]
+        )
+        return self.render_to_response(self.get_context_data())
+
     def get_context_data(self, **kwargs):
         ctx = kwargs
         ctx.update({
@@ -479,14 +609,70 @@ class CartConfirmView(ConfirmView):
             del self.request.session["cart_count"]
 
 
+ORDER_CURSOR_FORMAT = "%Y%m%d%H%M%S%f"
+ORDER_SUMMARY_FIELDS = (
+    "key", "creation_date", "status", "subtotal", "total",
+    "item_count", "has_subscription",
+)
+
+
+def order_cursor(order):
+    return "{0}.{1}".format(order.creation_date.strftime(ORDER_CURSOR_FORMAT), order.pk)
+
+
+def parse_order_cursor(cursor):
+    try:
+        timestamp, pk = cursor.split(".")
+        return datetime.strptime(timestamp, ORDER_CURSOR_FORMAT), int(pk)
+    except (AttributeError, ValueError):
+        return None
+
+
 @login_required
 def order_list(request, **kwargs):
+    """
+    A page of the user's orders, newest first. Pages are keyed on
+    (creation_date, pk) via the ``before`` query parameter rather than
+    an offset, so every page costs the same. With ``summary=True`` only
+    the fields needed for a listing are loaded and line items are not
+    prefetched.
+    """
 
     template_name = kwargs.pop("template_name", "checkout/order_list.html")
-    orders = OrderModel.objects.filter(user=request.user).order_by('-creation_date')
+    paginate_by = kwargs.pop("paginate_by", 20)
+    summary = kwargs.pop("summary", False)
+
+    orders = OrderModel.objects.filter(
+        user=request.user
+    ).order_by("-creation_date", "-pk")
+    if summary:
+        orders = orders.only(*ORDER_SUMMARY_FIELDS)
+    else:
+        orders = orders.select_related(
+            "latest_transaction"
+        ).prefetch_related("items")
+
+    cursor = parse_order_cursor(request.GET.get("before"))
+    if cursor:
+        creation_date, pk = cursor
+        orders = orders.filter(
+            Q(creation_date__lt=creation_date) |
+            Q(creation_date=creation_date, pk__lt=pk)
+        )
+
+    # fetch one extra row to know whether there is a next page
+    orders = list(orders[:paginate_by + 1])
+    next_cursor = None
+    if len(orders) > paginate_by:
+        orders = orders[:paginate_by]
+        next_cursor = order_cursor(orders[-1])
+    if not summary:
+        resolve_products(item for order in orders for item in order.items.all())
 
     return render_to_response(template_name, {
         "orders": orders,
+        "next_cursor": next_cursor,
+        "summary": summary,
     }, context_instance=RequestContext(request))
 
 
@@ -494,16 +680,15 @@ def order_details(request, key, **kwargs):
 
     template_name = kwargs.pop("template_name", "checkout/order_detail.html")
     if request.user.is_authenticated():
-        order = get_object_or_404(request.user.orders, key=key)
-    else:
-        order = get_object_or_404(OrderModel.objects.all(), key=key)
-    if order.transactions.count():
-        transaction = order.transactions.latest()
+        orders = request.user.orders.all()
     else:
-        transaction = None
+        orders = OrderModel.objects.all()
+    order = get_object_or_404(orders.select_related("latest_transaction"), key=key)
+    transaction = order.latest_transaction
 
     return render_to_response(template_name, {
         "order": order,
+        "items": resolve_products(order.items.all()),
         "transaction": transaction
     }, context_instance=RequestContext(request))
 
@@ -511,12 +696,26 @@ def order_details(request, key, **kwargs):
 @require_POST
 def lookup_discount_code(request):
     amount = 0
-    order_obj = Order(request)
+    order_obj = Order(request, deferred=True)
     total = order_obj.total
     order_obj.apply_discount(request.POST.get("discount_code"))
+    order_obj.flush()
     new_total = order_obj.total
-    amount = float(total) - float(new_total)
+    amount = to_decimal(total) - to_decimal(new_total)
     ret = {"amount": str(amount), "total": str(new_total)}
     if order_obj.order.discount:
         ret.update({"description": order_obj.order.discount.description})
     return HttpResponse(json.dumps(ret), mimetype="application/json")
+
+
+def processor_metrics(request):
+    """
+    Processor latency and transport metrics of this process, for Prometheus
+    to scrape. Open to staff and to settings.INTERNAL_IPS.
+    """
+    user = getattr(request, "user", None)
+    if not ((user and user.is_staff) or
+            request.META.get("REMOTE_ADDR") in settings.INTERNAL_IPS):
+        return HttpResponseForbidden()
+    return HttpResponse(render_prometheus(),
+        content_type="text/plain; version=0.0.4; charset=utf-8")
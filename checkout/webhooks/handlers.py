@@ -0,0 +1,177 @@
+from datetime import datetime, timedelta
+
+from checkout.models import Order, OrderTransaction, Subscription
+from checkout.settings import CHECKOUT
+from checkout.signals import webhook_event
+
+
+# copied from the original transaction onto subscription renewals
+RENEWAL_FIELDS = (
+    "payment_method", "last_four", "reference_number",
+    "billing_first_name", "billing_last_name", "billing_address1",
+    "billing_address2", "billing_city", "billing_region",
+    "billing_postal_code", "billing_country",
+)
+
+
+def apply_events(processor, events):
+    """
+    Apply a batch of webhook events to orders, transactions and the
+    subscription index.
+
+    The processor's ``webhook_details`` turns each event into a dict with
+    an ``action`` (refunded, disputed, subscription_charged,
+    subscription_updated or subscription_canceled) and the gateway ids it
+    concerns; events it returns None for are ignored. A refund's
+    ``amount`` is the total refunded so far. A subscription charge may say
+    whether it is the ``initial`` one, made at checkout, and when it was
+    ``charged``.
+    """
+    applied = []
+    for event in events:
+        details = processor.webhook_details(event.event_type, event.payload)
+        if details:
+            applied.append((event, details))
+
+    by_action = {}
+    for event, details in applied:
+        by_action.setdefault(details["action"], []).append(details)
+
+    record_refunds(by_action.get("refunded", []))
+    set_transaction_status(by_action.get("disputed", []), OrderTransaction.DISPUTED)
+    record_renewals(by_action.get("subscription_charged", []))
+
+    # in order, as later changes to a subscription win
+    for event, details in applied:
+        if details["action"] in ("subscription_updated", "subscription_canceled"):
+            update_subscription(details)
+
+    for event, details in applied:
+        webhook_event.send(sender=None, event=event, details=details)
+
+
+def set_transaction_status(changes, status):
+    references = [d["transaction_id"] for d in changes if d.get("transaction_id")]
+    if references:
+        OrderTransaction.objects.filter(
+            gateway_reference__in=references
+        ).update(status=status)
+
+
+def record_refunds(refunds):
+    """
+    Mark refunded transactions, and orders whose payments have all been
+    refunded. A refund of less than the transaction's amount is partial.
+    """
+    refunded = {}
+    for details in refunds:
+        if details.get("transaction_id"):
+            # amounts are running totals, so the largest is the latest
+            amount = details.get("amount")
+            previous = refunded.get(details["transaction_id"], 0)
+            refunded[details["transaction_id"]] = (
+                None if amount is None or previous is None
+                else max(amount, previous)
+            )
+    if not refunded:
+        return
+
+    order_ids = set()
+    for transaction in OrderTransaction.objects.filter(
+        gateway_reference__in=list(refunded)
+    ).exclude(status=OrderTransaction.REFUNDED):
+        amount = refunded[transaction.gateway_reference]
+        if amount is not None and transaction.amount and amount < transaction.amount:
+            status = OrderTransaction.PARTIALLY_REFUNDED
+        else:
+            status = OrderTransaction.REFUNDED
+            order_ids.add(transaction.order_id)
+        OrderTransaction.objects.filter(pk=transaction.pk).update(status=status)
+
+    # a subscription order stays complete while a renewal is left unrefunded
+    paid = OrderTransaction.objects.filter(
+        order__in=order_ids,
+        status__in=[OrderTransaction.COMPLETE, OrderTransaction.PARTIALLY_REFUNDED]
+    ).exclude(
+        payment_method=OrderTransaction.DISCOUNT
+    ).values_list("order_id", flat=True)
+    Order.objects.filter(
+        pk__in=order_ids - set(paid),
+        status=Order.COMPLETE
+    ).update(status=Order.REFUNDED)
+
+
+def is_initial_charge(details, original):
+    """
+    Whether a subscription charge is the one made when the subscription
+    was created at checkout, and so already recorded by ``original``
+    """
+    if details.get("initial") is not None:
+        return details["initial"]
+    if not details.get("charged"):
+        return False
+    # checkout charges within the payment attempt
+    started = original.attempt_date or original.creation_date
+    return details["charged"] <= started + timedelta(
+        seconds=CHECKOUT["PAYMENT_ATTEMPT_TIMEOUT"]
+    )
+
+
+def record_renewals(renewals):
+    """
+    Add a completed transaction to the subscription's order for each
+    renewal charge not already recorded
+    """
+    renewals = [d for d in renewals if d.get("transaction_id")]
+    if not renewals:
+        return
+
+    # the latest transaction for each subscription wins
+    originals = {}
+    for original in OrderTransaction.objects.filter(
+        gateway_reference__in=set(d["subscription_id"] for d in renewals),
+        status=OrderTransaction.COMPLETE
+    ).order_by("creation_date"):
+        originals[original.gateway_reference] = original
+
+    seen = set(OrderTransaction.objects.filter(
+        gateway_reference__in=[d["transaction_id"] for d in renewals]
+    ).values_list("gateway_reference", flat=True))
+
+    for details in renewals:
+        original = originals.get(details["subscription_id"])
+        if (original is None or details["transaction_id"] in seen or
+            is_initial_charge(details, original)):
+            continue
+        seen.add(details["transaction_id"])
+        renewal = OrderTransaction(
+            order_id=original.order_id,
+            status=OrderTransaction.COMPLETE,
+            amount=details.get("amount"),
+            description="Subscription renewal",
+            gateway_reference=details["transaction_id"]
+        )
+        for field in RENEWAL_FIELDS:
+            setattr(renewal, field, getattr(original, field))
+        renewal.save()
+
+
+def update_subscription(details):
+    fields = {}
+    if details["action"] == "subscription_canceled":
+        fields["status"] = Subscription.CANCELED
+    elif details.get("status"):
+        fields["status"] = details["status"]
+    if details.get("plan_id"):
+        fields["plan_id"] = details["plan_id"]
+    if not fields:
+        return
+
+    if details.get("customer_id"):
+        Subscription.objects.record(
+            details["subscription_id"], details["customer_id"], **fields
+        )
+    else:
+        Subscription.objects.filter(
+            reference_id=details["subscription_id"]
+        ).update(modified_date=datetime.now(), **fields)
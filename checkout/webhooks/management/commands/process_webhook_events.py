@@ -0,0 +1,121 @@
+import logging
+import time
+import traceback
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from checkout import registry
+from checkout.settings import CHECKOUT
+from checkout.webhooks.handlers import apply_events
+from checkout.webhooks.models import WebhookEvent
+
+logger = logging.getLogger("checkout.webhooks")
+
+
+class Command(BaseCommand):
+
+    help = ("Applies received webhook events to orders and transactions in "
+            "batches. Events that fail are retried after a growing delay "
+            "(CHECKOUT['WEBHOOK_RETRY_DELAY']) up to "
+            "CHECKOUT['WEBHOOK_MAX_ATTEMPTS'] times.")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size",
+            dest="batch_size",
+            type="int",
+            default=CHECKOUT["WEBHOOK_BATCH_SIZE"],
+            help="Events applied per transaction"
+        ),
+        make_option("--loop",
+            action="store_true",
+            dest="loop",
+            default=False,
+            help="Keep polling for new events instead of exiting when done"
+        ),
+        make_option("--sleep",
+            dest="sleep",
+            type="float",
+            default=1,
+            help="Seconds to wait for new events when looping"
+        ),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get("verbosity", 1))
+        processor_name = CHECKOUT["PAYMENT_PROCESSOR"]
+        processor = registry.processor()
+        pending = WebhookEvent.objects.pending(
+            processor_name, CHECKOUT["WEBHOOK_MAX_ATTEMPTS"]
+        )
+
+        processed = failed = 0
+        last = 0
+        while True:
+            # failed events are retried once their retry_date passes, not
+            # in this pass
+            events = list(pending.filter(pk__gt=last)[:options["batch_size"]])
+            if not events:
+                if not options["loop"]:
+                    break
+                time.sleep(options["sleep"])
+                last = 0
+                continue
+            last = events[-1].pk
+
+            batch_failed = self.process_batch(processor, events)
+            processed += len(events) - batch_failed
+            failed += batch_failed
+            if verbosity > 1:
+                self.stdout.write("{0} events processed, {1} failed\n".format(
+                    processed, failed
+                ))
+
+        self.stdout.write("{0} events processed, {1} failed\n".format(
+            processed, failed
+        ))
+
+    def process_batch(self, processor, events):
+        """
+        Apply ``events`` in one transaction. If that fails they are applied
+        one at a time so a single bad event doesn't hold up the rest.
+        Returns the number of events that failed.
+        """
+        try:
+            self.apply(processor, events)
+            return 0
+        except Exception:
+            if len(events) == 1:
+                self.record_failure(events[0])
+                return 1
+
+        failed = 0
+        for event in events:
+            try:
+                self.apply(processor, [event])
+            except Exception:
+                self.record_failure(event)
+                failed += 1
+        return failed
+
+    def apply(self, processor, events):
+        with transaction.commit_on_success():
+            apply_events(processor, events)
+            WebhookEvent.objects.filter(pk__in=[e.pk for e in events]).update(
+                status=WebhookEvent.PROCESSED,
+                processed_date=datetime.now(),
+                attempts=F("attempts") + 1,
+                error=""
+            )
+
+    def record_failure(self, event):
+        logger.exception("Webhook event {0} failed".format(event.event_id))
+        WebhookEvent.objects.filter(pk=event.pk).update(
+            status=WebhookEvent.FAILED,
+            attempts=F("attempts") + 1,
+            retry_date=WebhookEvent.next_retry(event.attempts + 1),
+            error=traceback.format_exc()
+        )
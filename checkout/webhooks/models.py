@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q
+
+from checkout.settings import CHECKOUT
+
+
+class WebhookEventManager(models.Manager):
+
+    def append(self, processor, event_id, event_type, payload):
+        """
+        Store a received event. Returns False if it was already received,
+        since gateways redeliver events they aren't sure arrived.
+        """
+        sid = transaction.savepoint()
+        try:
+            self.create(
+                processor=processor,
+                event_id=event_id,
+                event_type=event_type,
+                payload=payload
+            )
+            transaction.savepoint_commit(sid)
+            return True
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return False
+
+    def pending(self, processor, max_attempts):
+        """
+        Events still to be applied, oldest first, including failed ones
+        that haven't used up their attempts and are due for a retry
+        """
+        return self.filter(
+            Q(status=self.model.PENDING) |
+            Q(status=self.model.FAILED, retry_date__lte=datetime.now()),
+            processor=processor,
+            attempts__lt=max_attempts
+        ).order_by("pk")
+
+
+class WebhookEvent(models.Model):
+    """
+    A verified webhook event as received from the payment gateway. Events
+    are only ever appended; processing just records its outcome.
+    """
+    PENDING = "pending"
+    PROCESSED = "processed"
+    FAILED = "failed"
+
+    # indexed by unique_together in Meta
+    processor = models.CharField(max_length=100, db_index=False)
+    event_id = models.CharField(max_length=100)
+    event_type = models.CharField(max_length=100)
+    payload = models.TextField()
+    received_date = models.DateTimeField()
+
+    status = models.CharField(max_length=20, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    processed_date = models.DateTimeField(blank=True, null=True)
+    # when a failed event is next retried
+    retry_date = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True)
+
+    objects = WebhookEventManager()
+
+    class Meta:
+        unique_together = ("processor", "event_id")
+        index_together = [
+            ("processor", "status"),
+        ]
+
+    def __unicode__(self):
+        return u"{0} {1} ({2})".format(self.event_type, self.event_id, self.status)
+
+    @staticmethod
+    def next_retry(attempts):
+        """
+        When to retry an event that has failed ``attempts`` times: the
+        delay doubles with each failure
+        """
+        return datetime.now() + timedelta(
+            seconds=CHECKOUT["WEBHOOK_RETRY_DELAY"] * 2 ** (attempts - 1)
+        )
+
+    def save(self, **kwargs):
+        if not self.pk:
+            self.received_date = datetime.now()
+        super(WebhookEvent, self).save(**kwargs)
@@ -0,0 +1,6 @@
+from django.conf.urls.defaults import patterns
+
+
+urlpatterns = patterns("checkout.webhooks.views",
+    (r"^$", "receive_event", {}, "checkout_webhook"),
+)
@@ -0,0 +1,35 @@
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed
+from django.views.decorators.csrf import csrf_exempt
+
+from checkout import registry
+from checkout.settings import CHECKOUT
+from checkout.webhooks.models import WebhookEvent
+
+
+@csrf_exempt
+def receive_event(request):
+    """
+    Verifies and stores a webhook event, and acknowledges it straight away.
+    Events are applied later, in batches, by process_webhook_events.
+    """
+    processor = registry.processor()
+
+    if request.method == "GET":
+        # gateways that verify the endpoint first (Braintree)
+        challenge = getattr(processor, "webhook_challenge", None)
+        if challenge and request.GET:
+            return HttpResponse(challenge(request), content_type="text/plain")
+        return HttpResponseNotAllowed(["POST"])
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    event = processor.parse_webhook(request)
+    if event is None:
+        return HttpResponseForbidden()
+
+    event_id, event_type, payload = event
+    # a redelivered event is acknowledged like a new one
+    WebhookEvent.objects.append(
+        CHECKOUT["PAYMENT_PROCESSOR"], event_id, event_type, payload
+    )
+    return HttpResponse(status=200)
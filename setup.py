@@ -11,9 +11,12 @@ setup(
     license = "MIT",
     url = "http://github.com/pullswitch/django-checkout",
     packages = find_packages(),
+    package_data = {"checkout": ["sql/*.sql", "benchmark_budgets.json"]},
     install_requires = [
+        "Django>=1.5,<1.6",
         "django-form-utils==0.2.0",
-        "pytz"
+        "pytz",
+        "requests>=2.4",
     ],
     classifiers = [
         "Development Status :: 4 - Beta",